@@ -0,0 +1,186 @@
+"""
+Compares the input-to-paint latency of drag events handled one by one
+with drags coalesced to the frame rate (Application.request_frame).
+
+No display is needed: a stand-in for Tk's event loop feeds motion events
+at a fixed rate through the GUI's own request_frame & run_frame. It
+works like Tk in three ways:
+
+  * it handles input & timers before it goes idle
+  * it redraws only when idle
+  * motion events waiting in the queue are collapsed into the newest
+
+The handler & redraw costs are synthetic busy waits. Set them to the
+apply_* latencies from the GUI's profiling report for a given image.
+
+Every motion event's latency runs from its arrival to the end of the
+first redraw that shows it or a newer position. Latencies are recorded
+with profiling.Profiler, whose report also includes the handler calls &
+the GUI's own <frame>_input_to_paint intervals (measured from when an
+event is handled rather than from its arrival).
+
+Usage: python benchmarks/bench_frame_coalescing.py [--rate HZ]
+       [--seconds N] [--handler-ms N] [--paint-ms N]
+"""
+import argparse
+import collections
+import heapq
+import itertools
+import os
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def busy_wait(ms):
+    end = time.perf_counter() + ms / 1000.0
+    while time.perf_counter() < end:
+        pass
+
+
+class SimulatedApp(object):
+    """
+    Stand-in for the Application's Tk event loop, with the GUI's frame
+    scheduling methods.
+
+    Args:
+        profiler: profiling.Profiler recording the latencies
+        mode: 'per_event' or 'coalesced'
+        handler_ms: cost of applying a drag position
+        paint_ms: cost of a redraw
+    """
+
+    def __init__(self, profiler, mode, handler_ms, paint_ms):
+        import image_subregion_detector
+
+        app_class = image_subregion_detector.Application
+        self.request_frame = app_class.request_frame.__get__(self)
+        self.run_frame = app_class.run_frame.__get__(self)
+
+        self.profiler = profiler
+        self.mode = mode
+        self.handler_ms = handler_ms
+        self.paint_ms = paint_ms
+
+        self.frame_jobs = {}
+        self.frame_times = {}
+        self.input_times = {}
+
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._idle = []
+        self._dirty = False
+
+        # arrival times of the events handled but not yet applied, and
+        # of those applied but not yet painted
+        self._unapplied = []
+        self._unpainted = []
+
+    def after(self, ms, func, *args):
+        timer_id = next(self._timer_ids)
+        heapq.heappush(
+            self._timers,
+            (time.perf_counter() + ms / 1000.0, timer_id, func, args)
+        )
+
+        return timer_id
+
+    def after_idle(self, func, *args):
+        self._idle.append((func, args))
+
+    def apply_drag(self):
+        self.profiler.measure(
+            'apply_' + self.mode,
+            busy_wait,
+            self.handler_ms
+        )
+
+        # the latest position includes every event handled so far
+        self._unpainted.extend(self._unapplied)
+        del self._unapplied[:]
+        self._dirty = True
+
+    def on_motion(self):
+        if self.mode == 'per_event':
+            self.apply_drag()
+        else:
+            self.request_frame('pan', self.apply_drag)
+
+    def run(self, arrivals):
+        """
+        Runs the event loop until all motion events are painted.
+
+        Args:
+            arrivals: sorted time.perf_counter times of the motion events
+        """
+        arrivals = collections.deque(arrivals)
+
+        while arrivals or self._timers or self._idle or self._dirty:
+            now = time.perf_counter()
+            next_input = arrivals[0] if arrivals else float('inf')
+            next_timer = self._timers[0][0] if self._timers else float('inf')
+
+            # input & timers are handled first, oldest first
+            if min(next_input, next_timer) <= now:
+                if next_input <= next_timer:
+                    while arrivals and arrivals[0] <= now:
+                        self._unapplied.append(arrivals.popleft())
+                    self.on_motion()
+                else:
+                    due, timer_id, func, args = heapq.heappop(self._timers)
+                    func(*args)
+                continue
+
+            # idle: redraw, then the idle callbacks
+            if self._dirty:
+                busy_wait(self.paint_ms)
+                self._dirty = False
+                for arrival in self._unpainted:
+                    self.profiler.record_interval(
+                        self.mode + '_arrival_to_paint',
+                        arrival
+                    )
+                del self._unpainted[:]
+
+            idle, self._idle = self._idle, []
+            for func, args in idle:
+                func(*args)
+
+            next_due = min(next_input, next_timer)
+            if not idle and next_due != float('inf'):
+                time.sleep(max(next_due - now, 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rate', type=float, default=500.0)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--handler-ms', type=float, default=3.0)
+    parser.add_argument('--paint-ms', type=float, default=6.0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    from isd_lib import profiling
+
+    profiler = profiling.Profiler()
+    profiler.enable(use_cprofile=False)
+
+    count = int(args.rate * args.seconds)
+    for mode in ('per_event', 'coalesced'):
+        start = time.perf_counter() + 0.05
+        arrivals = [start + i / args.rate for i in range(count)]
+
+        app = SimulatedApp(profiler, mode, args.handler_ms, args.paint_ms)
+        app.run(arrivals)
+
+    print("%d motion events at %.0f Hz, handler %.1f ms, redraw %.1f ms" % (
+        count, args.rate, args.handler_ms, args.paint_ms
+    ))
+    print(profiler.report())
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
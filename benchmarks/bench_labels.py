@@ -0,0 +1,78 @@
+"""
+Compares color labeling through HSV with the direct RGB lookup table.
+
+Reports the one time cost of building the 2^24 entry table, and for a
+random noise image (every pixel a different color, the worst case for
+any shortcut) the time of each path. The lookup is run in verify mode,
+so the benchmark fails if any label differs from the HSV path.
+
+Usage: python benchmarks/bench_labels.py [--size N] [--runs N]
+"""
+import argparse
+import statistics
+import sys
+import time
+
+
+def median_ms(func, runs):
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000.0)
+
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', type=int, default=4000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    import cv2
+    import numpy as np
+    from isd_lib import utils
+
+    rng = np.random.RandomState(0)
+    rgb_img = rng.randint(
+        0,
+        256,
+        (args.size, args.size, 3)
+    ).astype(np.uint8)
+
+    start = time.perf_counter()
+    utils.get_rgb_label_table()
+    table_ms = (time.perf_counter() - start) * 1000.0
+
+    try:
+        utils.get_rgb_color_labels(rgb_img, verify=True)
+    except ValueError as e:
+        print("verification failed: %s" % e)
+        return 1
+
+    hsv_ms = median_ms(
+        lambda: utils.get_color_labels(
+            cv2.cvtColor(rgb_img, cv2.COLOR_RGB2HSV)
+        ),
+        args.runs
+    )
+    lut_ms = median_ms(
+        lambda: utils.get_rgb_color_labels(rgb_img),
+        args.runs
+    )
+
+    print("%dx%d random RGB image, labels verified identical" % (
+        args.size, args.size
+    ))
+    print("%-22s %8.1f ms (once per process)" % (
+        'build lookup table', table_ms
+    ))
+    print("%-22s %8.1f ms" % ('RGB -> HSV -> labels', hsv_ms))
+    print("%-22s %8.1f ms" % ('RGB -> labels (table)', lut_ms))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+Times the scoring of candidate regions against a target signature.
+
+Draws --candidates small red disks onto a white image, traces them like
+find_regions does & reports the time of score_regions with & without
+shape moments, and of rasterizing the candidates into the label image
+(one drawContours call per candidate), which is included in both. The
+vectorized Hu moments are checked against cv2.moments of each contour,
+so the benchmark fails if any differs.
+
+Usage: python benchmarks/bench_scoring.py [--width N] [--height N]
+       [--candidates N] [--runs N]
+"""
+import argparse
+import statistics
+import sys
+import time
+
+
+def median_ms(func, runs):
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000.0)
+
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=2000)
+    parser.add_argument('--candidates', type=int, default=6000)
+    parser.add_argument('--runs', type=int, default=7)
+    args = parser.parse_args()
+
+    import cv2
+    import numpy as np
+    from isd_lib import utils
+
+    rng = np.random.RandomState(0)
+    bgr_img = np.full((args.height, args.width, 3), 255, np.uint8)
+    for i in range(args.candidates):
+        center = (
+            int(rng.randint(10, args.width - 10)),
+            int(rng.randint(10, args.height - 10))
+        )
+        cv2.circle(bgr_img, center, int(rng.randint(3, 8)), (0, 0, 200), -1)
+    hsv_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2HSV)
+
+    mask = cv2.inRange(bgr_img, (0, 0, 150), (80, 80, 255))
+    contours = [
+        c for c, area in utils.iter_blobs_by_size(mask, 10, mask.size)
+    ]
+
+    target_bgr = np.full((30, 30, 3), 255, np.uint8)
+    cv2.circle(target_bgr, (15, 15), 8, (0, 0, 200), -1)
+    target_img = cv2.cvtColor(target_bgr, cv2.COLOR_BGR2HSV)
+    target_mask = cv2.inRange(target_bgr, (0, 0, 150), (80, 80, 255))
+
+    expected = np.array(
+        [utils.get_hu_moments(cv2.moments(c)) for c in contours]
+    )
+    if not np.array_equal(utils.get_contour_hu_moments(contours), expected):
+        print("verification failed: Hu moments differ from cv2.moments")
+        return 1
+
+    labels_ms = median_ms(
+        lambda: utils.get_region_labels(hsv_img.shape, contours),
+        args.runs
+    )
+    hist_ms = median_ms(
+        lambda: utils.score_regions(
+            hsv_img,
+            contours,
+            target_img,
+            target_mask
+        ),
+        args.runs
+    )
+    shape_ms = median_ms(
+        lambda: utils.score_regions(
+            hsv_img,
+            contours,
+            target_img,
+            target_mask,
+            use_shape=True
+        ),
+        args.runs
+    )
+
+    print("%dx%d image, %d candidates, Hu moments verified identical" % (
+        args.width, args.height, len(contours)
+    ))
+    print("%-22s %8.1f ms" % ('label image', labels_ms))
+    print("%-22s %8.1f ms" % ('histogram score', hist_ms))
+    print("%-22s %8.1f ms" % ('histogram & shape', shape_ms))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
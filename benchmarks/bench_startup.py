@@ -0,0 +1,115 @@
+"""
+Measures startup time of the detection library in fresh interpreters.
+
+Two timings are reported, each as the median of several runs:
+
+  * 'import isd_lib', relative to an empty interpreter start
+  * a single CLI detection run on a small synthetic image
+
+Exits with a non-zero status if either exceeds its budget.
+
+Usage: python benchmarks/bench_startup.py [--runs N]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# budgets in milliseconds
+IMPORT_BUDGET_MS = 20.0
+CLI_DETECT_BUDGET_MS = 1000.0
+
+
+def time_command(args, runs):
+    """
+    Returns the median wall time in milliseconds of running a command.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_DIR] + [p for p in [env.get('PYTHONPATH')] if p]
+    )
+
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call(
+            args,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            cwd=REPO_DIR
+        )
+        timings.append((time.perf_counter() - start) * 1000.0)
+
+    return statistics.median(timings)
+
+
+def write_test_image(file_path, size=512):
+    """
+    Writes a synthetic image of red & blue disks on a white background.
+    """
+    import cv2
+    import numpy as np
+
+    rng = np.random.RandomState(0)
+    img = np.full((size, size, 3), 235, dtype=np.uint8)
+
+    for i in range(40):
+        x, y = rng.randint(20, size - 20, 2)
+        color = (30, 30, 200) if i % 2 else (200, 30, 30)
+        cv2.circle(img, (int(x), int(y)), 12, color, -1)
+
+    cv2.imwrite(file_path, img)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=7)
+    args = parser.parse_args()
+
+    python = sys.executable
+
+    baseline = time_command([python, '-c', 'pass'], args.runs)
+    import_ms = time_command(
+        [python, '-c', 'import isd_lib'],
+        args.runs
+    ) - baseline
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        image_path = os.path.join(tmp_dir, 'startup.png')
+        write_test_image(image_path)
+
+        cli_ms = time_command(
+            [
+                python, '-m', 'isd_lib', 'detect', image_path,
+                '--target-rect', '0,0,512,512',
+                '--bg-colors', 'white',
+                '--min-area', '0.001'
+            ],
+            args.runs
+        )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    failed = False
+    for name, value, budget in [
+        ('import isd_lib', import_ms, IMPORT_BUDGET_MS),
+        ('cli detect', cli_ms, CLI_DETECT_BUDGET_MS)
+    ]:
+        status = 'ok' if value <= budget else 'OVER BUDGET'
+        failed = failed or value > budget
+        print("%-16s %8.1f ms  (budget %6.1f ms)  %s" % (
+            name, value, budget, status
+        ))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Measures memory use of detection with & without a reused workspace.
+
+Each mode runs in a fresh interpreter, which detects regions in several
+same sized synthetic images & reports:
+
+  * peak RSS growth over the RSS after the images were created
+  * peak traced allocations (NumPy arrays incl. OpenCV outputs) per image,
+    after the first image
+  * # of workspace buffer allocations (with a workspace only)
+  * mean detection time per image
+
+Usage: python benchmarks/bench_workspace.py [--size N] [--images N]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_image(size, seed):
+    """
+    Returns a synthetic HSV image of red & blue disks on a white background.
+    """
+    import cv2
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+    img = np.full((size, size, 3), 235, dtype=np.uint8)
+
+    for i in range(size * size // 20000):
+        x, y = rng.randint(20, size - 20, 2)
+        color = (30, 30, 200) if i % 2 else (200, 30, 30)
+        cv2.circle(img, (int(x), int(y)), int(rng.randint(8, 16)), color, -1)
+
+    return cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+
+
+def current_rss_kb():
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def run_child(size, n_images, use_workspace):
+    import tracemalloc
+    from isd_lib import utils
+    from isd_lib import workspace
+
+    images = [make_image(size, seed) for seed in range(n_images)]
+    target = images[0][:64, :64].copy()
+    target[16:48, 16:48] = images[0][0, 0]
+    target[24:40, 24:40] = (0, 200, 200)
+
+    ws = workspace.Workspace() if use_workspace else None
+
+    # warm up on a tiny image, so library initialization isn't counted
+    utils.find_regions(target, target, bg_colors=['white'], workspace=ws)
+
+    rss_before = current_rss_kb()
+
+    tracemalloc.start()
+    traced_peaks = []
+    seconds = 0.0
+
+    for img in images:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        utils.find_regions(img, target, bg_colors=['white'], workspace=ws)
+        seconds += time.perf_counter() - start
+
+        traced_peaks.append(tracemalloc.get_traced_memory()[1] - base)
+
+    tracemalloc.stop()
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        'rss_growth_kb': max(max_rss - rss_before, 0),
+        'traced_peak_bytes': max(traced_peaks[1:] or traced_peaks),
+        'workspace_allocations': ws.allocations if ws is not None else None,
+        'seconds_per_image': seconds / n_images
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', type=int, default=4000)
+    parser.add_argument('--images', type=int, default=8)
+    parser.add_argument('--child', choices=['plain', 'workspace'])
+    args = parser.parse_args()
+
+    if args.child is not None:
+        result = run_child(
+            args.size,
+            args.images,
+            args.child == 'workspace'
+        )
+        json.dump(result, sys.stdout)
+        return 0
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_DIR] + [p for p in [env.get('PYTHONPATH')] if p]
+    )
+
+    print("%d images of %dx%d pixels" % (args.images, args.size, args.size))
+
+    for mode in ['plain', 'workspace']:
+        output = subprocess.check_output(
+            [
+                sys.executable, os.path.abspath(__file__),
+                '--child', mode,
+                '--size', str(args.size),
+                '--images', str(args.images)
+            ],
+            env=env
+        )
+        result = json.loads(output.decode('utf-8'))
+
+        allocations = result['workspace_allocations']
+        print(
+            "%-10s peak RSS +%7.1f MB  traced peak %7.1f MB/image  "
+            "%5.1f ms/image  buffer allocations: %s" % (
+                mode,
+                result['rss_growth_kb'] / 1024.0,
+                result['traced_peak_bytes'] / 1024.0 ** 2,
+                1000.0 * result['seconds_per_image'],
+                '-' if allocations is None else allocations
+            )
+        )
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
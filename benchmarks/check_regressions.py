@@ -0,0 +1,618 @@
+"""
+Checks detection results against golden outputs & between equivalent paths.
+
+A corpus of small synthetic images (disks, rings with holes, touching &
+elongated blobs, color noise, a shaded background) is generated from
+fixed seeds. For each image, the outputs of find_regions (with several
+parameter sets, scoring & ROIs), get_color_profile & create_mask are
+reduced to digests and compared with the golden outputs recorded in
+golden_regions.json, so any change in which regions are returned fails.
+
+Each golden output records the commit it was recorded from. Outputs
+that the original code could produce were recorded from (and verified
+identical at) the baseline commit, those of scoring & ROI cases from
+the commits that introduced them. --record only re-records changed or
+new outputs, from the current commit.
+
+Optimized paths are also checked against their reference paths on the
+same corpus, both for exactly equal results & for speed:
+
+  * color labels looked up from RGB vs. classified from HSV
+  * detection on color labels vs. on HSV
+  * detection with a reused workspace vs. without
+  * a whole image ROI vs. no ROI
+  * summed-area table color profiles vs. get_color_profile
+  * export masks from a region label image vs. from each contour
+
+A speed check fails if the optimized path takes longer than the
+reference path times its allowed ratio (scaled by --slack).
+
+Everything runs offline on the CPU, it takes a few seconds. The golden &
+equivalence checks also run with the tests (tests/test_regressions.py).
+
+Usage: python benchmarks/check_regressions.py [--record] [--slack N]
+"""
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+GOLDEN_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'golden_regions.json'
+)
+
+# (name, width, height, seed) of the corpus images
+CORPUS = [
+    ('disks', 640, 480, 0),
+    ('rings', 640, 480, 1),
+    ('touching', 800, 600, 2),
+    ('noise', 640, 480, 3),
+    ('shaded', 800, 600, 4),
+]
+
+# find_regions keyword arguments checked for every corpus image, the
+# target & ROIs are added by the harness
+DETECTION_CASES = [
+    ('auto_bg', {}),
+    ('white_bg', {'bg_colors': ['white']}),
+    ('morphology', {'bg_colors': ['white'], 'pre_erode': 1, 'dilate': 3}),
+    ('wide_area', {'bg_colors': ['white'], 'min_area': 0.1, 'max_area': 8}),
+    ('score', {'bg_colors': ['white'], 'min_score': 0.2}),
+    ('score_shape', {'min_score': 0.1, 'use_shape': True}),
+    ('roi_rect', {'bg_colors': ['white'], 'roi': 'rect'}),
+    ('roi_polygon', {'bg_colors': ['white'], 'roi': 'polygon'}),
+]
+
+# (name, allowed ratio of optimized to reference time)
+SPEED_LIMITS = {
+    'labels_lookup': 1.0,
+    'detect_labels': 1.0,
+    'detect_workspace': 1.25,
+    'rect_profile': 1.0,
+    'export_masks': 1.25,
+}
+
+RED = (200, 30, 30)
+BLUE = (30, 30, 200)
+WHITE = (235, 235, 235)
+
+# center & radius of the disk every target is cropped around
+TARGET_DISK = ((40, 40), 12)
+
+
+def make_image(kind, width, height, seed):
+    """
+    Returns a synthetic RGB corpus image.
+    """
+    import cv2
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = WHITE
+
+    if kind == 'shaded':
+        # a horizontal light falloff across the white background
+        shade = np.linspace(0, 40, width).astype(np.uint8)
+        img -= shade[np.newaxis, :, np.newaxis]
+
+    n = width * height // 4000
+    for i in range(n):
+        x = int(rng.randint(20, width - 20))
+        y = int(rng.randint(20, height - 20))
+        radius = int(rng.randint(6, 16))
+        color = RED if i % 2 else BLUE
+
+        if kind == 'rings':
+            cv2.circle(img, (x, y), radius, color, max(radius // 3, 2))
+        elif kind == 'touching' and i % 3 == 0:
+            cv2.ellipse(
+                img,
+                (x, y),
+                (radius * 2, radius // 2),
+                float(rng.randint(0, 180)),
+                0,
+                360,
+                color,
+                -1
+            )
+            cv2.circle(img, (x + radius * 2, y), radius, color, -1)
+        else:
+            cv2.circle(img, (x, y), radius, color, -1)
+
+    if kind == 'noise':
+        points = rng.randint(0, min(width, height), (n * 10, 2))
+        img[points[:, 1], points[:, 0]] = rng.randint(0, 256, (n * 10, 3))
+
+    cv2.circle(img, TARGET_DISK[0], TARGET_DISK[1], RED, -1)
+
+    return img
+
+
+def get_rois(width, height):
+    import numpy as np
+
+    return {
+        'rect': (width // 8, height // 6, width // 2, height // 2),
+        'polygon': np.array(
+            [
+                [width // 10, height // 10],
+                [width - width // 5, height // 4],
+                [width // 2, height - height // 10],
+                [width // 6, height // 2],
+            ],
+            dtype=np.int32
+        )
+    }
+
+
+def digest(*arrays):
+    """
+    Returns a short hex digest of the data of NumPy arrays.
+    """
+    import numpy as np
+
+    sha = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        sha.update(str(a.shape).encode('ascii'))
+        sha.update(a.tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+def contours_digest(contours):
+    import cv2
+    import numpy as np
+
+    if len(contours) == 0:
+        return digest(np.zeros(0, dtype=np.int32))
+
+    return digest(
+        np.concatenate([c.reshape(-1, 2) for c in contours]),
+        np.array([len(c) for c in contours]),
+        np.array([cv2.contourArea(c) for c in contours])
+    )
+
+
+def load_corpus():
+    import cv2
+    from isd_lib import utils
+
+    corpus = []
+    for name, width, height, seed in CORPUS:
+        rgb_img = make_image(name, width, height, seed)
+        hsv_img = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2HSV)
+
+        (cx, cy), radius = TARGET_DISK
+        size = radius * 3
+        target = hsv_img[cy - size:cy + size, cx - size:cx + size].copy()
+
+        corpus.append(
+            {
+                'name': name,
+                'rgb': rgb_img,
+                'hsv': hsv_img,
+                'labels': utils.get_color_labels(hsv_img),
+                'target': target,
+                'rois': get_rois(width, height)
+            }
+        )
+
+    return corpus
+
+
+def detection_kwargs(image, kwargs):
+    kwargs = dict(kwargs)
+    if 'roi' in kwargs:
+        kwargs['roi'] = image['rois'][kwargs['roi']]
+
+    return kwargs
+
+
+def get_outputs(corpus):
+    """
+    Returns a dictionary of output digests by check name.
+    """
+    import numpy as np
+    from isd_lib import utils
+
+    outputs = {}
+
+    for image in corpus:
+        name = image['name']
+
+        for case, kwargs in DETECTION_CASES:
+            contours = utils.find_regions(
+                image['hsv'],
+                image['target'],
+                **detection_kwargs(image, kwargs)
+            )
+            outputs['%s/find_regions/%s' % (name, case)] = {
+                'count': len(contours),
+                'digest': contours_digest(contours)
+            }
+
+        profile = utils.get_color_profile(image['hsv'])
+        outputs['%s/get_color_profile' % name] = {
+            color: int(count) for color, count in profile.items()
+        }
+
+        for colors in (['red'], ['blue'], ['red', 'blue'], ['white']):
+            mask = utils.create_mask(image['hsv'], colors)
+            outputs['%s/create_mask/%s' % (name, '+'.join(colors))] = {
+                'count': int(np.count_nonzero(mask)),
+                'digest': digest(mask)
+            }
+
+    return outputs
+
+
+def get_commit():
+    """
+    Returns the short hash of the checked out commit, with a '+dirty'
+    suffix if isd_lib has uncommitted changes, or 'unknown' outside of a
+    git checkout.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=root,
+            stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+        changes = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--', 'isd_lib'],
+            cwd=root,
+            stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return commit + '+dirty' if changes.strip() else commit
+
+
+def load_golden():
+    """
+    Returns the golden outputs, a dictionary of {'commit', 'output'}
+    dictionaries by check name.
+    """
+    with open(GOLDEN_FILE) as f:
+        return json.load(f)
+
+
+def record_golden(outputs):
+    """
+    Writes the golden outputs, keeping the commits of unchanged outputs.
+
+    Returns:
+        The # of changed or new outputs
+    """
+    try:
+        golden = load_golden()
+    except (IOError, OSError):
+        golden = {}
+
+    commit = get_commit()
+    recorded = {}
+    changed = 0
+
+    for key, output in outputs.items():
+        entry = golden.get(key)
+        if entry is None or entry['output'] != output:
+            entry = {'commit': commit, 'output': output}
+            changed += 1
+        recorded[key] = entry
+
+    with open(GOLDEN_FILE, 'w') as f:
+        json.dump(recorded, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+    return changed
+
+
+def check_golden(corpus, failures):
+    golden = {
+        key: entry['output'] for key, entry in load_golden().items()
+    }
+
+    outputs = get_outputs(corpus)
+
+    for key in sorted(set(golden) | set(outputs)):
+        if golden.get(key) != outputs.get(key):
+            failures.append(
+                "%s: expected %s, got %s" % (
+                    key, golden.get(key), outputs.get(key)
+                )
+            )
+
+    return len(outputs)
+
+
+def check_equivalence(corpus, failures):
+    """
+    Compares optimized paths with their reference paths on the corpus.
+    """
+    import numpy as np
+    from isd_lib import export
+    from isd_lib import utils
+    from isd_lib import workspace
+
+    checks = 0
+    ws = workspace.Workspace()
+
+    def expect(condition, message):
+        if not condition:
+            failures.append(message)
+
+    for image in corpus:
+        name = image['name']
+        height, width = image['labels'].shape
+
+        labels = utils.get_rgb_color_labels(image['rgb'])
+        expect(
+            np.array_equal(labels, image['labels']),
+            "%s: RGB lookup labels differ from HSV labels" % name
+        )
+        checks += 1
+
+        for case, kwargs in DETECTION_CASES:
+            kwargs = detection_kwargs(image, kwargs)
+            expected = contours_digest(
+                utils.find_regions(image['hsv'], image['target'], **kwargs)
+            )
+
+            variants = [
+                ('workspace', image['hsv'], dict(kwargs, workspace=ws))
+            ]
+            if 'min_score' not in kwargs:
+                variants.append(('labels', image['labels'], kwargs))
+            if 'roi' not in kwargs:
+                full_roi = (0, 0, width, height)
+                variants.append(
+                    ('full_roi', image['hsv'], dict(kwargs, roi=full_roi))
+                )
+
+            for variant, src_img, variant_kwargs in variants:
+                result = contours_digest(
+                    utils.find_regions(
+                        src_img,
+                        image['target'],
+                        **variant_kwargs
+                    )
+                )
+                expect(
+                    result == expected,
+                    "%s/%s: %s results differ" % (name, case, variant)
+                )
+                checks += 1
+
+        integrals = utils.get_label_integrals(image['labels'])
+        rng = np.random.RandomState(0)
+        for i in range(20):
+            x, y = rng.randint(0, width - 1), rng.randint(0, height - 1)
+            w = rng.randint(1, width - x + 1)
+            h = rng.randint(1, height - y + 1)
+            expected = {
+                color: int(count) for color, count in utils.get_color_profile(
+                    image['hsv'][y:y + h, x:x + w]
+                ).items()
+            }
+            expect(
+                utils.get_rect_color_profile(
+                    image['labels'],
+                    integrals,
+                    (x, y, w, h)
+                ) == expected,
+                "%s: color profile of %s differs" % (name, (x, y, w, h))
+            )
+            checks += 1
+
+        regions = [
+            utils.make_region(c) for c in utils.find_regions(
+                image['hsv'],
+                image['target'],
+                bg_colors=['white'],
+                min_area=0.1,
+                max_area=8
+            )
+        ]
+        region_labels = utils.get_region_labels(
+            image['hsv'].shape,
+            [r['contour'] for r in regions]
+        )
+        for i, region in enumerate(regions):
+            expected = export.get_masked_region(image['hsv'], region)
+            region['label'] = i + 1
+            expect(
+                np.array_equal(
+                    export.get_masked_region(
+                        image['hsv'],
+                        region,
+                        region_labels
+                    ),
+                    expected
+                ),
+                "%s: export mask of region %d differs" % (name, i)
+            )
+            checks += 1
+
+    return checks
+
+
+def median_ms(func, runs):
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000.0)
+
+    return statistics.median(timings)
+
+
+def check_speed(corpus, runs, slack, failures):
+    """
+    Times optimized paths against their reference paths on the largest
+    corpus image.
+    """
+    import cv2
+    from isd_lib import export
+    from isd_lib import utils
+    from isd_lib import workspace
+
+    image = max(corpus, key=lambda i: i['labels'].size)
+    hsv_img = image['hsv']
+    target = image['target']
+    ws = workspace.Workspace()
+
+    regions = [
+        utils.make_region(c) for c in utils.find_regions(
+            hsv_img,
+            target,
+            bg_colors=['white']
+        )
+    ]
+    region_labels = utils.get_region_labels(
+        hsv_img.shape,
+        [r['contour'] for r in regions]
+    )
+    labeled = [dict(r, label=i + 1) for i, r in enumerate(regions)]
+
+    # the lookup table is built once per process, outside of the timing
+    utils.get_rgb_label_table()
+
+    rect = (10, 10, hsv_img.shape[1] // 2, hsv_img.shape[0] // 2)
+    x, y, w, h = rect
+    integrals = utils.get_label_integrals(image['labels'])
+
+    pairs = [
+        (
+            'labels_lookup',
+            lambda: utils.get_color_labels(
+                cv2.cvtColor(image['rgb'], cv2.COLOR_RGB2HSV)
+            ),
+            lambda: utils.get_rgb_color_labels(image['rgb'])
+        ),
+        (
+            'detect_labels',
+            lambda: utils.find_regions(hsv_img, target, bg_colors=['white']),
+            lambda: utils.find_regions(
+                image['labels'],
+                target,
+                bg_colors=['white']
+            )
+        ),
+        (
+            'detect_workspace',
+            lambda: utils.find_regions(hsv_img, target, bg_colors=['white']),
+            lambda: utils.find_regions(
+                hsv_img,
+                target,
+                bg_colors=['white'],
+                workspace=ws
+            )
+        ),
+        (
+            'rect_profile',
+            lambda: utils.get_color_profile(hsv_img[y:y + h, x:x + w]),
+            lambda: utils.get_rect_color_profile(
+                image['labels'],
+                integrals,
+                rect
+            )
+        ),
+        (
+            'export_masks',
+            lambda: [export.get_masked_region(hsv_img, r) for r in regions],
+            lambda: [
+                export.get_masked_region(hsv_img, r, region_labels)
+                for r in labeled
+            ]
+        ),
+    ]
+
+    for name, reference, optimized in pairs:
+        # warm up both paths (workspace buffers, lazy imports)
+        reference()
+        optimized()
+
+        reference_ms = median_ms(reference, runs)
+        optimized_ms = median_ms(optimized, runs)
+        limit = SPEED_LIMITS[name] * slack
+
+        ok = optimized_ms <= reference_ms * limit
+        print(
+            "%-18s reference %8.2f ms  optimized %8.2f ms  "
+            "(limit %.2fx) %s" % (
+                name,
+                reference_ms,
+                optimized_ms,
+                limit,
+                'ok' if ok else 'FAIL'
+            )
+        )
+        if not ok:
+            failures.append(
+                "%s: %.2f ms is over %.2fx the reference %.2f ms" % (
+                    name, optimized_ms, limit, reference_ms
+                )
+            )
+
+    return len(pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--record',
+        action='store_true',
+        help="re-record changed golden outputs from the current code"
+    )
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument(
+        '--slack',
+        type=float,
+        default=1.0,
+        help="factor applied to all speed limits, e.g. for noisy machines"
+    )
+    parser.add_argument('--skip-speed', action='store_true')
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+
+    if args.record:
+        changed = record_golden(get_outputs(corpus))
+        print("recorded %d changed golden outputs in %s" % (
+            changed, GOLDEN_FILE
+        ))
+        return 0
+
+    failures = []
+
+    count = check_golden(corpus, failures)
+    print("golden outputs: %d checked" % count)
+
+    count = check_equivalence(corpus, failures)
+    print("equivalence: %d checked" % count)
+
+    if not args.skip_speed:
+        check_speed(corpus, args.runs, args.slack, failures)
+
+    for failure in failures:
+        print("FAIL %s" % failure)
+
+    if failures:
+        return 1
+
+    print("all checks passed")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,11 +4,18 @@ from tkinter import messagebox
 from PIL import ImageTk
 import PIL.Image
 import os
-import re
-import cv2
+import itertools
+import time
 import numpy as np
 
+from isd_lib import cache
+from isd_lib import contours
+from isd_lib import export
+from isd_lib import loader
+from isd_lib import profiling
+from isd_lib import session
 from isd_lib import utils
+from isd_lib import workspace
 
 BACKGROUND_COLOR = '#ededed'
 
@@ -17,6 +24,11 @@ WINDOW_HEIGHT = 720
 
 PREVIEW_SIZE = 256  # height & width of preview in pixels
 
+# drag positions (pan & preview navigation) are applied at most once per
+# frame at 60 Hz, motion events arriving in between only update the
+# pending position
+FRAME_INTERVAL_MS = 16
+
 PAD_SMALL = 2
 PAD_MEDIUM = 4
 PAD_LARGE = 8
@@ -25,6 +37,19 @@ PAD_EXTRA_LARGE = 14
 DEFAULT_ERODE_ITER = 0
 DEFAULT_DILATE_ITER = 2
 
+# outline colors of regions found for each target (cycled through)
+TARGET_COLORS = [
+    '#00ff00',
+    '#ff00ff',
+    '#00ffff',
+    '#ffff00',
+    '#ff8000',
+    '#0080ff'
+]
+
+# outline color of the analysis ROI
+ROI_COLOR = '#ff0000'
+
 COLOR_NAMES = [
     'red',
     'yellow',
@@ -46,12 +71,29 @@ class Application(tkinter.Frame):
 
         self.image_name = None
         self.image_dir = None
+        self.image_path = None
         self.bg_colors = None
 
+        # records handler latencies while profiling is toggled on
+        self.profiler = profiling.Profiler(listener=self.show_frame_time)
+
         # Detected regions will be saved as a dictionary with the bounding
-        # rectangles canvas ID as the key. The value will be another dictionary
-        # containing the contour itself and the rectangle coordinates
+        # rectangles canvas ID as the key. The value is the region's index
+        # in the contour store, which holds the contours, rectangles & areas
         self.regions = None
+        self.contour_store = None
+
+        # canvas IDs of the region rectangles by contour store index, and
+        # the undo/redo history of which regions are active. Deleted
+        # regions are only hidden, so they can be restored.
+        self.region_items = None
+        self.region_history = None
+
+        # region label image of the contour store (see
+        # utils.get_region_labels), built on the first export & reused by
+        # later ones. It's only used when the regions can't overlap.
+        self.region_labels = None
+        self.use_region_labels = False
 
         self.region_count = tkinter.IntVar()
         self.region_min = tkinter.DoubleVar()
@@ -103,6 +145,21 @@ class Application(tkinter.Frame):
         )
         file_chooser_button.pack(side=tkinter.LEFT)
 
+        # sessions keep detected regions & parameters between runs
+        save_session_button = tkinter.Button(
+            file_chooser_frame,
+            text='Save Session...',
+            command=self.save_session
+        )
+        save_session_button.pack(side=tkinter.LEFT)
+
+        load_session_button = tkinter.Button(
+            file_chooser_frame,
+            text='Load Session...',
+            command=self.load_session
+        )
+        load_session_button.pack(side=tkinter.LEFT)
+
         self.export_format = tkinter.StringVar()
         self.export_format.set('numpy')
         format_label = tkinter.Label(
@@ -118,6 +175,23 @@ class Application(tkinter.Frame):
             "both"
         )
         export_fmt_combo.config(width=6)
+
+        # keeps the 16-bit data of 16-bit images for TIFF export, read when
+        # an image is opened
+        self.keep_16bit = tkinter.IntVar()
+        self.keep_16bit.set(0)
+        keep_16bit_cb = tkinter.Checkbutton(
+            file_chooser_frame,
+            text='16-bit',
+            variable=self.keep_16bit,
+            bg=BACKGROUND_COLOR
+        )
+        keep_16bit_cb.config(
+            borderwidth=0,
+            highlightthickness=0
+        )
+
+        keep_16bit_cb.pack(side=tkinter.RIGHT)
         export_fmt_combo.pack(side=tkinter.RIGHT)
         format_label.pack(side=tkinter.RIGHT)
 
@@ -243,6 +317,21 @@ class Application(tkinter.Frame):
             )
             cb.pack(anchor=tkinter.W, pady=PAD_SMALL, padx=PAD_MEDIUM)
 
+        # auto mode estimates the background color from a pixel sample
+        self.auto_bg_color = tkinter.IntVar()
+        self.auto_bg_color.set(0)
+        auto_cb = tkinter.Checkbutton(
+            bg_cb_frame,
+            text='auto',
+            variable=self.auto_bg_color,
+            bg=BACKGROUND_COLOR
+        )
+        auto_cb.config(
+            borderwidth=0,
+            highlightthickness=0
+        )
+        auto_cb.pack(anchor=tkinter.W, pady=PAD_SMALL, padx=PAD_MEDIUM)
+
         erode_frame = tkinter.Frame(self.right_frame, bg=BACKGROUND_COLOR)
         erode_frame.pack(
             fill=tkinter.BOTH,
@@ -331,6 +420,42 @@ class Application(tkinter.Frame):
         max_area_label_entry.pack(side=tkinter.RIGHT, anchor=tkinter.N)
         max_area_label.pack(side=tkinter.RIGHT, anchor=tkinter.N)
 
+        # minimum similarity score, scoring is skipped if left blank
+        min_score_frame = tkinter.Frame(self.right_frame, bg=BACKGROUND_COLOR)
+        min_score_frame.pack(
+            fill=tkinter.BOTH,
+            expand=False,
+            anchor=tkinter.N,
+            pady=PAD_MEDIUM
+        )
+        self.min_score = tkinter.StringVar()
+        self.min_score.set('')
+        self.use_shape = tkinter.IntVar()
+        self.use_shape.set(0)
+        min_score_label = tkinter.Label(
+            min_score_frame,
+            text="Minimum score: ",
+            bg=BACKGROUND_COLOR
+        )
+        min_score_label_entry = tkinter.Entry(
+            min_score_frame,
+            textvariable=self.min_score
+        )
+        min_score_label_entry.config(width=4)
+        use_shape_cb = tkinter.Checkbutton(
+            min_score_frame,
+            text='shape',
+            variable=self.use_shape,
+            bg=BACKGROUND_COLOR
+        )
+        use_shape_cb.config(
+            borderwidth=0,
+            highlightthickness=0
+        )
+        use_shape_cb.pack(side=tkinter.RIGHT, anchor=tkinter.N)
+        min_score_label_entry.pack(side=tkinter.RIGHT, anchor=tkinter.N)
+        min_score_label.pack(side=tkinter.RIGHT, anchor=tkinter.N)
+
         region_buttons_frame = tkinter.Frame(
             self.right_frame,
             bg=BACKGROUND_COLOR
@@ -352,10 +477,92 @@ class Application(tkinter.Frame):
         clear_regions_button = tkinter.Button(
             region_buttons_frame,
             text='Clear Regions',
-            command=self.clear_rectangles
+            command=self.clear_regions
         )
         clear_regions_button.pack(side=tkinter.LEFT, anchor=tkinter.N)
 
+        redo_button = tkinter.Button(
+            region_buttons_frame,
+            text='Redo',
+            command=self.redo
+        )
+        redo_button.pack(side=tkinter.RIGHT, anchor=tkinter.N)
+
+        undo_button = tkinter.Button(
+            region_buttons_frame,
+            text='Undo',
+            command=self.undo
+        )
+        undo_button.pack(side=tkinter.RIGHT, anchor=tkinter.N)
+
+        # multiple targets can be collected & found together in one pass
+        target_buttons_frame = tkinter.Frame(
+            self.right_frame,
+            bg=BACKGROUND_COLOR
+        )
+        target_buttons_frame.pack(
+            fill=tkinter.BOTH,
+            expand=False,
+            anchor=tkinter.N,
+            pady=PAD_MEDIUM
+        )
+
+        add_target_button = tkinter.Button(
+            target_buttons_frame,
+            text='Add Target',
+            command=self.add_target
+        )
+        add_target_button.pack(side=tkinter.LEFT, anchor=tkinter.N)
+
+        clear_targets_button = tkinter.Button(
+            target_buttons_frame,
+            text='Clear Targets',
+            command=self.clear_targets
+        )
+        clear_targets_button.pack(side=tkinter.LEFT, anchor=tkinter.N)
+
+        self.target_count = tkinter.IntVar()
+        self.target_count.set(0)
+        target_count_label = tkinter.Label(
+            target_buttons_frame,
+            textvariable=self.target_count,
+            bg=BACKGROUND_COLOR
+        )
+        target_count_label.pack(side=tkinter.RIGHT, anchor=tkinter.N)
+
+        # an analysis ROI limits detection to part of the image
+        roi_buttons_frame = tkinter.Frame(
+            self.right_frame,
+            bg=BACKGROUND_COLOR
+        )
+        roi_buttons_frame.pack(
+            fill=tkinter.BOTH,
+            expand=False,
+            anchor=tkinter.N,
+            pady=PAD_MEDIUM
+        )
+
+        set_roi_button = tkinter.Button(
+            roi_buttons_frame,
+            text='Set ROI',
+            command=self.set_roi
+        )
+        set_roi_button.pack(side=tkinter.LEFT, anchor=tkinter.N)
+
+        load_roi_button = tkinter.Button(
+            roi_buttons_frame,
+            text='Load ROI...',
+            command=self.load_roi
+        )
+        load_roi_button.pack(side=tkinter.LEFT, anchor=tkinter.N)
+
+        clear_roi_button = tkinter.Button(
+            roi_buttons_frame,
+            text='Clear ROI',
+            command=self.clear_roi
+        )
+        clear_roi_button.pack(side=tkinter.LEFT, anchor=tkinter.N)
+
         # frame showing various stats about found regions
         stats_frame = tkinter.Frame(
             self.right_frame,
@@ -466,6 +673,42 @@ class Application(tkinter.Frame):
         )
         region_avg_label.pack(side=tkinter.RIGHT, anchor=tkinter.N)
 
+        # profiling toggle & the latency of the last handler call
+        profile_frame = tkinter.Frame(
+            self.right_frame,
+            bg=BACKGROUND_COLOR
+        )
+        profile_frame.pack(
+            fill=tkinter.X,
+            expand=False,
+            anchor=tkinter.S,
+            side=tkinter.BOTTOM,
+            pady=PAD_SMALL
+        )
+
+        self.profiling = tkinter.IntVar()
+        self.profiling.set(0)
+        profiling_cb = tkinter.Checkbutton(
+            profile_frame,
+            text='Profile',
+            variable=self.profiling,
+            command=self.toggle_profiling,
+            bg=BACKGROUND_COLOR
+        )
+        profiling_cb.config(
+            borderwidth=0,
+            highlightthickness=0
+        )
+        profiling_cb.pack(side=tkinter.LEFT, anchor=tkinter.N)
+
+        self.frame_time = tkinter.StringVar()
+        frame_time_label = tkinter.Label(
+            profile_frame,
+            textvariable=self.frame_time,
+            bg=BACKGROUND_COLOR
+        )
+        frame_time_label.pack(side=tkinter.RIGHT, anchor=tkinter.N)
+
         # preview frame holding small full-size depiction of chosen image
         preview_frame = tkinter.Frame(
             self.right_frame,
@@ -500,29 +743,73 @@ class Application(tkinter.Frame):
 
         self.canvas.bind("<Configure>", self.canvas_size_changed)
 
-        self.scrollbar_h.bind("<B1-Motion>", self.update_preview)
-        self.scrollbar_h.bind("<ButtonRelease-1>", self.update_preview)
-        self.scrollbar_v.bind("<B1-Motion>", self.update_preview)
-        self.scrollbar_v.bind("<ButtonRelease-1>", self.update_preview)
+        self.master.bind("<Control-z>", self.undo)
+        self.master.bind("<Control-y>", self.redo)
+        self.master.bind("<Control-p>", self.toggle_profiling_key)
+
+        self.scrollbar_h.bind("<B1-Motion>", self.on_scrollbar_move)
+        self.scrollbar_h.bind("<ButtonRelease-1>", self.on_scrollbar_move)
+        self.scrollbar_v.bind("<B1-Motion>", self.on_scrollbar_move)
+        self.scrollbar_v.bind("<ButtonRelease-1>", self.on_scrollbar_move)
 
         self.preview_canvas.bind("<ButtonPress-1>", self.move_preview_rectangle)
         self.preview_canvas.bind("<B1-Motion>", self.move_preview_rectangle)
 
         self.rect = None
 
+        # targets added for multi-target detection, each a dictionary with
+        # the HSV target 'image' & its 'min_area' & 'max_area'
+        self.targets = []
+
+        # analysis ROI, a rectangle (x, y, width, height) or an (N, 2)
+        # polygon array, or None to analyze the whole image
+        self.roi = None
+
         self.start_x = None
         self.start_y = None
 
         self.pan_start_x = None
         self.pan_start_y = None
 
+        # latest pointer positions of the pan & preview drags, applied by
+        # the next frame (see request_frame)
+        self.pan_position = None
+        self.preview_position = None
+
+        # pending frame callback IDs, the time each frame kind last ran &
+        # the time of the oldest input not yet applied, by frame name
+        self.frame_jobs = {}
+        self.frame_times = {}
+        self.input_times = {}
+
         self.image = None
+        self.rgb_img = None
+        self.rgb_img_16bit = None
+        self.hsv_img = None
+        self.color_labels = None
+        self.file_hash = None
+
+        # target image of the last detection, saved with sessions
+        self.detection_target = None
+
+        # per color summed-area table of the color label tiles, computed
+        # when the image is opened so the selection's color profile can be
+        # updated on every mouse move
+        self.label_integrals = None
         self.tk_image = None
         self.preview_image = None
         self.preview_rectangle = None
 
+        # derived image data (HSV, color labels, preview) is cached on disk
+        # so re-opening an image skips recomputing it
+        self.derived_cache = cache.DerivedDataCache()
+
+        # work buffers reused by each Find Regions run
+        self.workspace = workspace.Workspace()
+
         self.pack()
 
+    @profiling.profiled
     def on_draw_button_press(self, event):
         # starting coordinates
         self.start_x = self.canvas.canvasx(event.x)
@@ -539,6 +826,7 @@ class Application(tkinter.Frame):
                 width=2
             )
 
+    @profiling.profiled
     def on_draw_move(self, event):
         cur_x = self.canvas.canvasx(event.x)
         cur_y = self.canvas.canvasy(event.y)
@@ -546,24 +834,37 @@ class Application(tkinter.Frame):
         # update rectangle size with mouse position
         self.canvas.coords(self.rect, self.start_x, self.start_y, cur_x, cur_y)
 
+        self.update_selection_profile()
+
     # noinspection PyUnusedLocal
+    @profiling.profiled
     def on_draw_release(self, event):
-        if self.rect is None or self.image is None:
-            return
-
-        corners = self.canvas.coords(self.rect)
-        corners = tuple([int(c) for c in corners])
-        region = self.image.crop(corners)
+        self.update_selection_profile()
 
-        if 0 in region.size:
-            # either height or width is zero, do nothing
+    @profiling.profiled
+    def update_selection_profile(self):
+        """
+        Shows the color profile of the selection rectangle, looked up in
+        the label tiles' summed-area table
+        """
+        if self.rect is None or self.label_integrals is None:
             return
 
-        target = cv2.cvtColor(np.array(region), cv2.COLOR_RGB2HSV)
+        x1, y1, x2, y2 = [int(c) for c in self.canvas.coords(self.rect)]
+        x1, x2 = sorted((x1, x2))
+        y1, y2 = sorted((y1, y2))
+
+        color_profile = utils.get_rect_color_profile(
+            self.color_labels,
+            self.label_integrals,
+            (x1, y1, x2 - x1, y2 - y1)
+        )
 
-        color_profile = utils.get_color_profile(target)
+        total_pixels = sum(color_profile.values())
 
-        total_pixels = (corners[2] - corners[0]) * (corners[3] - corners[1])
+        if total_pixels == 0:
+            # either height or width is zero, do nothing
+            return
 
         for color in COLOR_NAMES:
             color_percent = (float(color_profile[color]) / total_pixels) * 100
@@ -579,9 +880,16 @@ class Application(tkinter.Frame):
         self.pan_start_y = int(self.canvas.canvasy(event.y))
 
     def pan_image(self, event):
+        self.pan_position = (event.x, event.y)
+        self.request_frame('pan', self.apply_pan)
+
+    @profiling.profiled
+    def apply_pan(self):
+        x, y = self.pan_position
+
         self.canvas.scan_dragto(
-            event.x - self.pan_start_x,
-            event.y - self.pan_start_y,
+            x - self.pan_start_x,
+            y - self.pan_start_y,
             gain=1
         )
         self.update_preview(None)
@@ -590,6 +898,7 @@ class Application(tkinter.Frame):
     def on_pan_button_release(self, event):
         self.canvas.config(cursor='cross')
 
+    @profiling.profiled
     def on_right_button_press(self, event):
         # have to translate our event position to our current panned location
         selection = self.canvas.find_closest(
@@ -605,19 +914,96 @@ class Application(tkinter.Frame):
                 # this isn't a rectangle object, do nothing
                 continue
 
-            self.canvas.delete(item)
-            self.regions.pop(item)
+            index = self.regions[item]
+            if not self.region_history.active[index]:
+                # already deleted
+                continue
+
+            self.region_history.remove([index])
+            self.canvas.itemconfigure(item, state=tkinter.HIDDEN)
+
+        self.update_region_stats()
 
+    @profiling.profiled
+    def clear_regions(self):
+        """
+        Deletes all regions as a single undoable edit
+        """
+        self.canvas.delete(self.rect)
+        self.rect = None
+        self.reset_color_profile()
+
+        if self.region_history is None:
+            return
+
+        self.show_regions(self.region_history.clear(), False)
+
+    # noinspection PyUnusedLocal
+    @profiling.profiled
+    def undo(self, event=None):
+        if self.region_history is None:
+            return
+
+        change = self.region_history.undo()
+        if change is not None:
+            self.show_regions(*change)
+
+    # noinspection PyUnusedLocal
+    @profiling.profiled
+    def redo(self, event=None):
+        if self.region_history is None:
+            return
+
+        change = self.region_history.redo()
+        if change is not None:
+            self.show_regions(*change)
+
+    @profiling.profiled
+    def show_regions(self, indices, visible):
+        """
+        Shows or hides the rectangles of regions & updates the stats
+        """
+        state = tkinter.NORMAL if visible else tkinter.HIDDEN
+
+        for index in indices:
+            self.canvas.itemconfigure(self.region_items[index], state=state)
+
+        self.update_region_stats()
+
+    def update_region_stats(self):
+        areas = self.contour_store.areas[self.region_history.active]
+
+        if len(areas) == 0:
+            self.region_count.set(0)
+            self.region_min.set(0.0)
+            self.region_max.set(0.0)
+            self.region_avg.set(0.0)
+            return
+
+        self.region_count.set(len(areas))
+        self.region_min.set(areas.min())
+        self.region_max.set(areas.max())
+        self.region_avg.set(np.round(areas.mean(), decimals=1))
+
+    @profiling.profiled
     def find_regions(self):
-        if self.rect is None or self.image is None:
+        if self.image is None:
             return
 
-        corners = self.canvas.coords(self.rect)
-        corners = tuple([int(c) for c in corners])
-        region = self.image.crop(corners)
+        if self.rect is None and len(self.targets) == 0:
+            return
 
-        hsv_img = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2HSV)
-        target = cv2.cvtColor(np.array(region), cv2.COLOR_RGB2HSV)
+        hsv_img = self.hsv_img
+
+        if self.auto_bg_color.get() == 1:
+            # only the pixels around the ROI count towards the background
+            bg_color, fraction, margin = utils.estimate_dominant_color(
+                utils.crop_roi(hsv_img, self.roi)[0]
+            )
+
+            # show the estimated color in the background color check boxes
+            for color, cb_var in self.bg_color_vars.items():
+                cb_var.set(1 if color == bg_color else 0)
 
         bg_colors = []
         for color, cb_var in self.bg_color_vars.items():
@@ -631,40 +1017,249 @@ class Application(tkinter.Frame):
             )
             return
 
-        contours = utils.find_regions(
-            hsv_img,
-            target,
-            bg_colors=bg_colors,
-            pre_erode=self.erode_iter.get(),
-            dilate=self.dilate_iter.get(),
-            min_area=self.min_area.get(),
-            max_area=self.max_area.get()
-        )
+        if len(self.targets) > 0:
+            # all added targets share one pass over the source image
+            results = utils.find_regions_multi(
+                hsv_img,
+                self.targets,
+                bg_colors=bg_colors,
+                pre_erode=self.erode_iter.get(),
+                dilate=self.dilate_iter.get(),
+                roi=self.roi,
+                workspace=self.workspace
+            )
+            regions = itertools.chain.from_iterable(results)
+            self.detection_target = self.targets[0]['image']
+
+            # regions of different targets can overlap, so they're masked
+            # by their own contours on export
+            use_region_labels = False
+        else:
+            target = self.get_selection_target()
+            if target is None:
+                return
+
+            self.detection_target = target
+            use_region_labels = True
+
+            min_score = self.min_score.get().strip()
+            if min_score == '':
+                min_score = None
+            else:
+                try:
+                    min_score = float(min_score)
+                except ValueError:
+                    messagebox.showwarning(
+                        'Minimum Score',
+                        'Minimum score must be a number between 0 and 1.'
+                    )
+                    return
+
+            if min_score is None:
+                # regions are drawn as they are found
+                regions = utils.iter_regions(
+                    hsv_img,
+                    target,
+                    bg_colors=bg_colors,
+                    pre_erode=self.erode_iter.get(),
+                    dilate=self.dilate_iter.get(),
+                    min_area=self.min_area.get(),
+                    max_area=self.max_area.get(),
+                    roi=self.roi,
+                    workspace=self.workspace
+                )
+            else:
+                # scoring needs all the candidates before they can be ranked
+                contours = utils.find_regions(
+                    hsv_img,
+                    target,
+                    bg_colors=bg_colors,
+                    pre_erode=self.erode_iter.get(),
+                    dilate=self.dilate_iter.get(),
+                    min_area=self.min_area.get(),
+                    max_area=self.max_area.get(),
+                    min_score=min_score,
+                    use_shape=self.use_shape.get() == 1,
+                    roi=self.roi,
+                    workspace=self.workspace
+                )
+                regions = (utils.make_region(c) for c in contours)
 
         # make sure we have at least one detected region
-        if len(contours) > 0:
-            self.create_regions(contours)
+        first_region = next(regions, None)
+        if first_region is not None:
+            self.create_regions(
+                itertools.chain([first_region], regions),
+                use_region_labels=use_region_labels
+            )
         else:
             self.region_count.set(0)
             self.region_min.set(0.0)
             self.region_max.set(0.0)
             self.region_avg.set(0.0)
 
-    def create_regions(self, contours):
+    def get_selection_target(self):
+        """
+        Returns the current selection rectangle as an HSV target image, or
+        None if the selection is empty
+        """
+        x1, y1, x2, y2 = [int(c) for c in self.canvas.coords(self.rect)]
+        x1, x2 = sorted((max(x1, 0), max(x2, 0)))
+        y1, y2 = sorted((max(y1, 0), max(y2, 0)))
+
+        # a view into the HSV image, no pixels are copied or converted
+        target = self.hsv_img[y1:y2, x1:x2]
+
+        if target.size == 0:
+            return None
+
+        return target
+
+    def add_target(self):
+        if self.rect is None or self.image is None:
+            return
+
+        target = self.get_selection_target()
+        if target is None:
+            return
+
+        self.targets.append(
+            {
+                'image': target,
+                'min_area': self.min_area.get(),
+                'max_area': self.max_area.get()
+            }
+        )
+
+        # keep the target outlined in its color & free up the selection
+        # rectangle for drawing the next target
+        corners = self.canvas.coords(self.rect)
+        target_color = TARGET_COLORS[
+            (len(self.targets) - 1) % len(TARGET_COLORS)
+        ]
+        self.canvas.create_rectangle(
+            *corners,
+            outline=target_color,
+            dash=(4, 4),
+            width=2,
+            tag='target'
+        )
+        self.canvas.delete(self.rect)
+        self.rect = None
+
+        self.target_count.set(len(self.targets))
+
+    def clear_targets(self):
+        self.canvas.delete('target')
+        self.targets = []
+        self.target_count.set(0)
+
+    def set_roi(self):
+        """
+        Uses the current selection rectangle as the analysis ROI
+        """
+        if self.rect is None or self.image is None:
+            return
+
+        x1, y1, x2, y2 = [int(c) for c in self.canvas.coords(self.rect)]
+        x1, x2 = sorted((x1, x2))
+        y1, y2 = sorted((y1, y2))
+
+        if x2 - x1 <= 0 or y2 - y1 <= 0:
+            return
+
+        self.canvas.delete(self.rect)
+        self.rect = None
+
+        self.draw_roi((x1, y1, x2 - x1, y2 - y1))
+
+    def load_roi(self):
+        """
+        Loads the analysis ROI from a JSON or .npy file (see utils.load_roi)
+        """
+        if self.image is None:
+            return
+
+        roi_file = filedialog.askopenfilename(
+            filetypes=[('ROI files', '*.json *.npy'), ('All files', '*')]
+        )
+
+        if not roi_file:
+            # user cancelled file dialog
+            return
+
+        try:
+            roi = utils.load_roi(roi_file)
+        except (IOError, ValueError) as e:
+            messagebox.showwarning('Load ROI', str(e))
+            return
+
+        self.draw_roi(roi)
+
+    def draw_roi(self, roi):
+        self.canvas.delete('roi')
+        self.roi = roi
+
+        roi = np.asarray(roi)
+        if roi.ndim == 1:
+            x, y, width, height = roi
+            self.canvas.create_rectangle(
+                x,
+                y,
+                x + width,
+                y + height,
+                outline=ROI_COLOR,
+                dash=(8, 4),
+                width=2,
+                tag='roi'
+            )
+        else:
+            self.canvas.create_polygon(
+                *roi.ravel().tolist(),
+                outline=ROI_COLOR,
+                fill='',
+                dash=(8, 4),
+                width=2,
+                tag='roi'
+            )
+
+    def clear_roi(self):
+        self.canvas.delete('roi')
+        self.roi = None
+
+    @profiling.profiled
+    def create_regions(self, regions, use_region_labels=False):
         """
         Creates regions (self.regions) & draws bounding rectangles on canvas
 
         Args:
-            contours: list of OpenCV contours
+            regions: iterable of region dictionaries (see utils.make_region),
+                consumed one at a time
+            use_region_labels: whether the regions can't overlap, so they
+                can be masked by a region label image on export
         """
         self.clear_rectangles()
         self.regions = {}  # reset regions dictionary
-
-        region_areas = []
-
-        for c in contours:
-            region_areas.append(cv2.contourArea(c))
-            rect = cv2.boundingRect(c)
+        self.region_items = []
+        self.contour_store = contours.ContourStore()
+        self.region_labels = None
+        self.use_region_labels = use_region_labels
+
+        # region size stats are accumulated as regions arrive
+        area_count = 0
+        area_min = None
+        area_max = None
+        area_sum = 0.0
+
+        for region in regions:
+            rect = region['rectangle']
+
+            area_count += 1
+            area_sum += region['area']
+            if area_min is None or region['area'] < area_min:
+                area_min = region['area']
+            if area_max is None or region['area'] > area_max:
+                area_max = region['area']
 
             # using a custom fully transparent bitmap for the stipple, b/c
             # if the rectangle has no fill we cannot catch mouse clicks
@@ -675,28 +1270,40 @@ class Application(tkinter.Frame):
                 rect[1],
                 rect[0] + rect[2],
                 rect[1] + rect[3],
-                outline='#00ff00',
+                outline=TARGET_COLORS[
+                    region.get('target', 0) % len(TARGET_COLORS)
+                ],
                 fill='gray',
                 stipple='@trans.xbm',
                 width=2,
                 tag='rect'
             )
 
-            self.regions[rect_id] = {
-                'contour': c,
-                'rectangle': rect
-            }
+            self.regions[rect_id] = self.contour_store.append(
+                region['contour'],
+                region['area']
+            )
+            self.region_items.append(rect_id)
 
-        self.region_count.set(len(contours))
-        self.region_min.set(min(region_areas))
-        self.region_max.set(max(region_areas))
-        self.region_avg.set(np.round(np.mean(region_areas), decimals=1))
+        # a new detection starts a new edit history
+        self.region_history = contours.RegionHistory(area_count)
+
+        if area_count == 0:
+            return
+
+        self.region_count.set(area_count)
+        self.region_min.set(area_min)
+        self.region_max.set(area_max)
+        self.region_avg.set(np.round(area_sum / area_count, decimals=1))
 
     def reset_color_profile(self):
         for color in COLOR_NAMES:
             self.color_profile_vars[color].set("0.0%")
 
     def clear_rectangles(self):
+        """
+        Removes all region rectangles from the canvas, clearing the stats
+        """
         self.canvas.delete("rect")
         self.canvas.delete(self.rect)
         self.rect = None
@@ -721,13 +1328,16 @@ class Application(tkinter.Frame):
         )
 
     # noinspection PyUnusedLocal
+    @profiling.profiled
     def update_preview(self, event):
         if self.preview_rectangle is None:
             # do nothing
             return
 
-        x1, x2 = self.scrollbar_h.get()
-        y1, y2 = self.scrollbar_v.get()
+        # the canvas view is current right after scrolling, the scrollbars
+        # are only updated when Tk is idle
+        x1, x2 = self.canvas.xview()
+        y1, y2 = self.canvas.yview()
 
         # current rectangle position
         rx1, ry1, rx2, ry2 = self.preview_canvas.coords(
@@ -743,25 +1353,38 @@ class Application(tkinter.Frame):
             delta_y
         )
 
+    # noinspection PyUnusedLocal
+    def on_scrollbar_move(self, event):
+        # the scrollbar scrolls the canvas after this binding runs, so the
+        # preview is updated in the next frame
+        self.request_frame('scroll', lambda: self.update_preview(None))
+
     def move_preview_rectangle(self, event):
+        self.preview_position = (event.x, event.y)
+        self.request_frame('navigate', self.apply_preview_position)
+
+    @profiling.profiled
+    def apply_preview_position(self):
         if self.preview_rectangle is None:
             # do nothing
             return
 
+        event_x, event_y = self.preview_position
+
         x1, y1, x2, y2 = self.preview_canvas.coords(self.preview_rectangle)
 
         half_width = float(x2 - x1) / 2
         half_height = float(y2 - y1) / 2
 
-        if event.x + half_width >= PREVIEW_SIZE - 1:
+        if event_x + half_width >= PREVIEW_SIZE - 1:
             new_x = PREVIEW_SIZE - (half_width * 2) - 1
         else:
-            new_x = event.x - half_width
+            new_x = event_x - half_width
 
-        if event.y + half_height >= PREVIEW_SIZE - 1:
+        if event_y + half_height >= PREVIEW_SIZE - 1:
             new_y = PREVIEW_SIZE - (half_height * 2) - 1
         else:
-            new_y = event.y - half_height
+            new_y = event_y - half_height
 
         self.canvas.xview(
             tkinter.MOVETO,
@@ -773,14 +1396,93 @@ class Application(tkinter.Frame):
             float(new_y) / PREVIEW_SIZE
         )
 
-        self.update()
         self.update_preview(None)
 
+    def request_frame(self, name, callback):
+        """
+        Schedules a callback applying the latest input of a drag, at most
+        once per frame. While a frame is pending, further requests are
+        merged into it, so fast motion events don't queue up redraws.
+
+        Args:
+            name: frame name, each name is throttled separately
+            callback: function applying the latest input
+        """
+        now = time.perf_counter()
+        self.input_times.setdefault(name, now)
+
+        if name in self.frame_jobs:
+            return
+
+        elapsed_ms = (now - self.frame_times.get(name, 0.0)) * 1000.0
+        delay_ms = int(max(FRAME_INTERVAL_MS - elapsed_ms, 0))
+
+        self.frame_jobs[name] = self.after(
+            delay_ms,
+            self.run_frame,
+            name,
+            callback
+        )
+
+    def run_frame(self, name, callback):
+        del self.frame_jobs[name]
+        self.frame_times[name] = time.perf_counter()
+
+        input_time = self.input_times.pop(name)
+        callback()
+
+        if self.profiler.enabled:
+            # Tk redraws when idle, so idle callbacks queued now run after
+            # the redraw showing this input
+            self.after_idle(
+                self.profiler.record_interval,
+                name + '_input_to_paint',
+                input_time
+            )
+
     # noinspection PyUnusedLocal
+    @profiling.profiled
     def canvas_size_changed(self, event):
         self.preview_canvas.delete('preview_rect')
         self.set_preview_rectangle()
 
+    def toggle_profiling(self):
+        if self.profiling.get() == 1:
+            self.profiler.enable()
+            self.frame_time.set('')
+            return
+
+        self.profiler.disable()
+        self.frame_time.set('')
+
+        if not self.profiler.stats:
+            return
+
+        base_path = filedialog.asksaveasfilename(
+            initialfile='isd_profile',
+            title='Save Profile (.txt, .trace.json & .prof files)'
+        )
+
+        if not base_path:
+            # user cancelled file dialog, the results are discarded
+            return
+
+        self.profiler.dump(os.path.splitext(base_path)[0])
+
+    # noinspection PyUnusedLocal
+    def toggle_profiling_key(self, event):
+        self.profiling.set(1 - self.profiling.get())
+        self.toggle_profiling()
+
+    def show_frame_time(self, handler, ms):
+        """
+        Shows the latency of the last handler call while profiling.
+        """
+        slow = ms > self.profiler.slow_ms
+        self.frame_time.set(
+            "%s %.1f ms%s" % (handler, ms, ' (slow)' if slow else '')
+        )
+
     def choose_files(self):
         selected_file = filedialog.askopenfile('r')
 
@@ -788,22 +1490,52 @@ class Application(tkinter.Frame):
             # do nothing, user cancelled file dialog
             return
 
+        self.open_image(selected_file.name)
+
+    @profiling.profiled
+    def open_image(self, file_path):
         self.canvas.delete('all')
         self.rect = None
+        self.targets = []
+        self.target_count.set(0)
+        self.roi = None
+        self.regions = None
+        self.region_items = None
+        self.region_history = None
+        self.region_labels = None
+        self.detection_target = None
         self.region_count.set(0)
         self.region_min.set(0.0)
         self.region_max.set(0.0)
         self.region_avg.set(0.0)
 
         # some of the files may be 3-channel 16-bit/chan TIFFs, which
-        # PIL doesn't support. OpenCV can read these, but converts them
-        # to 8-bit/chan. So, we'll open all images in OpenCV first,
-        # then create a PIL Image to finally create an ImageTk PhotoImage
-        cv_img = cv2.imread(selected_file.name)
-
-        self.image = PIL.Image.fromarray(
-            cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB),
-            'RGB'
+        # PIL doesn't support. The loader decodes every file once with
+        # OpenCV, scales 16-bit data to 8-bit/chan & optionally keeps the
+        # 16-bit data for export. The PIL Image is only needed to create
+        # the ImageTk PhotoImage, everything else uses views of the arrays
+        rgb_img, self.rgb_img_16bit = loader.load_rgb(
+            file_path,
+            keep_16bit=self.keep_16bit.get() == 1
+        )
+
+        self.rgb_img = rgb_img
+        self.image = PIL.Image.fromarray(rgb_img, 'RGB')
+
+        file_hash = self.derived_cache.file_hash(file_path)
+        derived = cache.get_derived_data(
+            self.derived_cache,
+            file_hash,
+            lambda: rgb_img,
+            thumbnail_size=(PREVIEW_SIZE, PREVIEW_SIZE)
+        )
+        self.hsv_img = derived['hsv']
+        self.color_labels = derived['labels']
+        self.file_hash = file_hash
+        self.label_integrals = cache.get_label_integrals(
+            self.derived_cache,
+            file_hash,
+            self.color_labels
         )
         height, width = self.image.size
         self.canvas.config(scrollregion=(0, 0, height, width))
@@ -815,10 +1547,7 @@ class Application(tkinter.Frame):
         # drawing the preview rectangle
         self.update()
 
-        tmp_preview_image = self.image.resize(
-            (PREVIEW_SIZE, PREVIEW_SIZE),
-            PIL.Image.ANTIALIAS
-        )
+        tmp_preview_image = PIL.Image.fromarray(derived['thumbnail'], 'RGB')
         self.preview_canvas.delete('all')
         self.preview_image = ImageTk.PhotoImage(tmp_preview_image)
         self.preview_canvas.create_image(
@@ -829,14 +1558,151 @@ class Application(tkinter.Frame):
         )
         self.set_preview_rectangle()
 
-        self.image_name = os.path.basename(selected_file.name)
-        self.image_dir = os.path.dirname(selected_file.name)
+        self.image_path = file_path
+        self.image_name = os.path.basename(file_path)
+        self.image_dir = os.path.dirname(file_path)
+
+    def get_params(self):
+        """
+        Returns the detection parameters for saving in a session
+        """
+        return {
+            'bg_colors': [
+                color for color, cb_var in self.bg_color_vars.items()
+                if cb_var.get() == 1
+            ],
+            'auto_bg_color': self.auto_bg_color.get(),
+            'erode': self.erode_iter.get(),
+            'dilate': self.dilate_iter.get(),
+            'min_area': self.min_area.get(),
+            'max_area': self.max_area.get(),
+            'min_score': self.min_score.get(),
+            'use_shape': self.use_shape.get()
+        }
+
+    def set_params(self, params):
+        """
+        Sets the detection parameters from a session, which may have been
+        saved by the command line tool (see cli.get_params)
+        """
+        bg_colors = params.get('bg_colors') or []
+        for color, cb_var in self.bg_color_vars.items():
+            cb_var.set(1 if color in bg_colors else 0)
+
+        self.auto_bg_color.set(
+            params.get('auto_bg_color', int(not bg_colors))
+        )
+        self.erode_iter.set(params.get('erode', DEFAULT_ERODE_ITER))
+        self.dilate_iter.set(params.get('dilate', DEFAULT_DILATE_ITER))
+        self.min_area.set(params.get('min_area', 0.5))
+        self.max_area.set(params.get('max_area', 2.0))
+        min_score = params.get('min_score')
+        self.min_score.set('' if min_score is None else min_score)
+        self.use_shape.set(int(params.get('use_shape', 0)))
+
+    def save_session(self):
+        if self.image_path is None or self.region_history is None:
+            return
+
+        session_file = filedialog.asksaveasfilename(
+            defaultextension='.npz',
+            filetypes=[('Session files', '*.npz')]
+        )
+
+        if not session_file:
+            # user cancelled file dialog
+            return
+
+        session.save_session(
+            session_file,
+            self.image_path,
+            self.contour_store,
+            active=self.region_history.active,
+            target=self.detection_target,
+            roi=self.roi,
+            params=self.get_params(),
+            file_hash=self.file_hash
+        )
+
+    def load_session(self):
+        session_file = filedialog.askopenfilename(
+            filetypes=[('Session files', '*.npz'), ('All files', '*')]
+        )
 
+        if not session_file:
+            # user cancelled file dialog
+            return
+
+        try:
+            saved = session.load_session(session_file)
+        except (IOError, ValueError, KeyError) as e:
+            messagebox.showwarning('Load Session', str(e))
+            return
+
+        if not os.path.exists(saved['image_path']):
+            messagebox.showwarning(
+                'Load Session',
+                'Image not found: %s' % saved['image_path']
+            )
+            return
+
+        self.open_image(saved['image_path'])
+
+        if saved['file_hash'] not in (None, self.file_hash):
+            messagebox.showwarning(
+                'Load Session',
+                'The image has changed since the session was saved.'
+            )
+
+        self.set_params(saved['params'])
+        self.detection_target = saved['target']
+
+        if saved['roi'] is not None:
+            self.draw_roi(saved['roi'])
+
+        self.restore_regions(saved['contour_store'], saved['active'])
+
+    @profiling.profiled
+    def restore_regions(self, contour_store, active):
+        """
+        Draws the regions of a contour store, e.g. from a saved session,
+        without re-detecting them. Inactive regions are drawn hidden, so
+        their deletion can still be undone.
+        """
+        self.clear_rectangles()
+        self.regions = {}
+        self.region_items = []
+        self.contour_store = contour_store
+        self.region_labels = None
+        self.use_region_labels = False
+
+        for index, rect in enumerate(contour_store.rectangles.tolist()):
+            rect_id = self.canvas.create_rectangle(
+                rect[0],
+                rect[1],
+                rect[0] + rect[2],
+                rect[1] + rect[3],
+                outline=TARGET_COLORS[0],
+                fill='gray',
+                stipple='@trans.xbm',
+                width=2,
+                tag='rect',
+                state=tkinter.NORMAL if active[index] else tkinter.HIDDEN
+            )
+            self.regions[rect_id] = index
+            self.region_items.append(rect_id)
+
+        self.region_history = contours.RegionHistory(len(contour_store))
+        self.region_history.active[:] = active
+
+        self.update_region_stats()
+
+    @profiling.profiled
     def export_sub_regions(self):
-        if not self.regions:
+        if self.region_history is None:
             return
 
-        if len(self.regions) == 0:
+        if len(self.region_history) == 0:
             return
 
         if self.export_string.get() == '':
@@ -848,6 +1714,10 @@ class Application(tkinter.Frame):
 
         export_format = self.export_format.get()
 
+        rgb_img = self.rgb_img
+        if self.rgb_img_16bit is not None:
+            rgb_img = self.rgb_img_16bit
+
         output_dir = "/".join(
             [
                 self.image_dir,
@@ -855,65 +1725,43 @@ class Application(tkinter.Frame):
             ]
         )
 
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        hsv_img = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2HSV)
+        indices = self.region_history.active_indices()
+        regions = self.contour_store.iter_regions(indices)
 
-        for k, v in self.regions.items():
-            x1 = v['rectangle'][0]
-            y1 = v['rectangle'][1]
-            x2 = v['rectangle'][0] + v['rectangle'][2]
-            y2 = v['rectangle'][1] + v['rectangle'][3]
+        if self.use_region_labels and export_format != 'tiff':
+            if self.region_labels is None:
+                self.region_labels = utils.get_region_labels(
+                    self.hsv_img.shape,
+                    [
+                        self.contour_store.contour(i)
+                        for i in range(len(self.contour_store))
+                    ]
+                )
 
-            # build base file name for output files
-            match = re.search('(.+)\.(.+)$', self.image_name)
-            output_filename = "".join(
-                [
-                    match.groups()[0],
-                    '_',
-                    str(x1),
-                    ',',
-                    str(y1)
-                ]
-            )
+            regions = self.iter_labeled_regions(indices)
 
-            if export_format == 'tiff' or export_format == 'both':
-                region = self.image.crop((x1, y1, x2, y2))
-                tif_filename = ".".join([output_filename, 'tif'])
-                tif_file_path = "/".join([output_dir, tif_filename])
-                region.save(tif_file_path)
+        export.export_regions(
+            regions,
+            self.image_name,
+            output_dir,
+            self.hsv_img,
+            rgb_img=rgb_img,
+            export_format=export_format,
+            region_labels=self.region_labels
+        )
 
-            if export_format == 'numpy' or export_format == 'both':
-                # extract sub-region from original image using rectangle
-                hsv_region = hsv_img[y1:y2, x1:x2]
+    def iter_labeled_regions(self, indices):
+        """
+        Yields the region dictionaries of the given contour store indices
+        with their label in the region label image.
+        """
+        for index in indices:
+            region = self.contour_store.region(index)
+            region['label'] = index + 1
+            yield region
 
-                # subtract the rect coordinates from the contour
-                local_contour = v['contour'] - [x1, y1]
 
-                # create a mask from the new contour
-                new_mask = np.zeros(
-                    (v['rectangle'][3], v['rectangle'][2]),
-                    dtype=np.uint8
-                )
-                cv2.drawContours(new_mask, [local_contour], 0, 255, -1)
-
-                # mask the extracted sub-region & convert to int16
-                # to use -1 for non-contour pixels
-                masked_region = cv2.bitwise_and(
-                    hsv_region,
-                    hsv_region,
-                    mask=new_mask
-                ).astype(np.int16)
-
-                # set non-contour areas to -1
-                masked_region[new_mask == 0] = -1
-
-                # save sub-region to file as NumPy array
-                npy_filename = ".".join([output_filename, 'npy'])
-                npy_file_path = "/".join([output_dir, npy_filename])
-                np.save(npy_file_path, masked_region)
-
-root = tkinter.Tk()
-app = Application(root)
-root.mainloop()
+if __name__ == '__main__':
+    root = tkinter.Tk()
+    app = Application(root)
+    root.mainloop()
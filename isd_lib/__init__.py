@@ -0,0 +1,33 @@
+"""
+Library for finding image sub-regions similar to a target region.
+
+Submodules are imported on first access (e.g. isd_lib.utils), so importing
+the package itself does not load NumPy, OpenCV or any GUI toolkit.
+"""
+import importlib
+
+__all__ = [
+    'cache',
+    'cli',
+    'contours',
+    'export',
+    'loader',
+    'manifest',
+    'pipeline',
+    'profiling',
+    'sequence',
+    'server',
+    'session',
+    'shm',
+    'utils',
+    'workspace'
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+
+    raise AttributeError(
+        "module %r has no attribute %r" % (__name__, name)
+    )
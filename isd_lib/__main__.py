@@ -0,0 +1,5 @@
+import sys
+
+from isd_lib import cli
+
+sys.exit(cli.main())
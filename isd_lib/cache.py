@@ -0,0 +1,333 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+
+from isd_lib import utils
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'),
+    '.cache',
+    'image_subregion_detector'
+)
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3  # 4 GiB
+
+HASH_CHUNK_SIZE = 4 * 1024 ** 2
+
+# suffix of the temporary files entries are written to before they're
+# renamed into place
+TMP_SUFFIX = '.npy.tmp'
+
+# temporary files older than this were left behind by a killed writer
+STALE_TMP_SECONDS = 3600
+
+
+def hash_file(file_path):
+    """
+    Returns the SHA-256 hex digest of a file's contents.
+    """
+    sha = hashlib.sha256()
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def hash_params(params):
+    """
+    Returns a short hex digest for a dictionary of JSON serializable
+    parameters. NumPy arrays are converted to lists.
+    """
+    def to_json(value):
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        raise TypeError(repr(value))
+
+    text = json.dumps(params, sort_keys=True, default=to_json)
+
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def hash_palette(hsv_ranges=None):
+    """
+    Returns a short hex digest of the color palette used for color labels.
+    """
+    if hsv_ranges is None:
+        hsv_ranges = utils.HSV_RANGES
+
+    return hash_params(hsv_ranges)
+
+
+class DerivedDataCache(object):
+    """
+    Size bounded, least recently used on-disk cache of NumPy arrays derived
+    from images (HSV conversions, color labels, thumbnails, etc.).
+
+    Each entry is a single .npy file so it can be memory-mapped on load.
+    Keys combine the image content hash with the name of the derived data
+    and a hash of the parameters it was computed with, so changing one
+    stage's parameters only invalidates that stage.
+    """
+
+    def __init__(
+            self,
+            cache_dir=DEFAULT_CACHE_DIR,
+            max_bytes=DEFAULT_MAX_BYTES
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        # file hashes are remembered per (path, size, mtime) to avoid
+        # re-reading large files that haven't changed
+        self._file_hashes = {}
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def file_hash(self, file_path):
+        """
+        Returns the content hash for an image file.
+        """
+        stat = os.stat(file_path)
+        file_id = (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+
+        if file_id not in self._file_hashes:
+            self._file_hashes[file_id] = hash_file(file_path)
+
+        return self._file_hashes[file_id]
+
+    @staticmethod
+    def key(file_hash, name, params=None):
+        """
+        Builds a cache key for derived data of an image.
+
+        Args:
+            file_hash: content hash of the image file
+            name: name of the derived data, e.g. 'hsv' or 'labels'
+            params: optional dictionary of parameters the data depends on
+
+        Returns:
+            Cache key string
+        """
+        if params is None:
+            params = {}
+
+        return '-'.join([file_hash, name, hash_params(params)])
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def load(self, key):
+        """
+        Loads a cached array as a read-only memory-map, or returns None if
+        the key is not in the cache.
+        """
+        path = self._path(key)
+
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+
+        # mark the entry as recently used, unless another process evicted
+        # it meanwhile (the memory-map stays valid)
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return array
+
+    def save(self, key, array):
+        """
+        Saves an array to the cache, evicting least recently used entries
+        if the cache grows beyond its maximum size.
+        """
+        path = self._path(key)
+
+        # write to a temporary file of its own first, so readers never see
+        # partial data & concurrent writers of the same key don't mix
+        fd, tmp_path = tempfile.mkstemp(
+            suffix=TMP_SUFFIX,
+            prefix=key + '-',
+            dir=self.cache_dir
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        self.evict()
+
+    def get(self, key, compute):
+        """
+        Returns the cached array for key, computing & caching it with the
+        given function on a miss.
+        """
+        array = self.load(key)
+
+        if array is None:
+            array = compute()
+            self.save(key, array)
+
+        return array
+
+    def size(self):
+        """
+        Returns the total size of all cache entries in bytes.
+        """
+        return sum(size for path, size, mtime in self._entries())
+
+    def _entries(self):
+        entries = []
+
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.npy'):
+                continue
+
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed by another process
+                continue
+
+            entries.append((path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+    def _remove_stale_tmp_files(self):
+        min_mtime = time.time() - STALE_TMP_SECONDS
+
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(TMP_SUFFIX):
+                continue
+
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                if os.stat(path).st_mtime < min_mtime:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits within
+        its maximum size, and temporary files left behind by writers that
+        were killed (see STALE_TMP_SECONDS).
+        """
+        self._remove_stale_tmp_files()
+
+        entries = self._entries()
+        total = sum(size for path, size, mtime in entries)
+
+        for path, size, mtime in sorted(entries, key=lambda e: e[2]):
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            total -= size
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        for path, size, mtime in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_derived_data(cache, file_hash, load_rgb, thumbnail_size=None):
+    """
+    Returns the derived data for an image, reusing cached stages.
+
+    Args:
+        cache: DerivedDataCache instance
+        file_hash: content hash of the image file
+        load_rgb: function returning the image as a 3-D NumPy array in RGB,
+            only called if a stage needs to be computed
+        thumbnail_size: optional (width, height) of an RGB thumbnail
+
+    Returns:
+        Dictionary with 'hsv', 'labels' & 'color_profile' entries, plus
+        'thumbnail' if thumbnail_size was given. Cached arrays are returned
+        as read-only memory-maps.
+    """
+    palette = {'palette': hash_palette()}
+    rgb = []
+
+    def rgb_img():
+        if len(rgb) == 0:
+            rgb.append(load_rgb())
+        return rgb[0]
+
+    derived = {
+        'hsv': cache.get(
+            cache.key(file_hash, 'hsv'),
+            lambda: cv2.cvtColor(rgb_img(), cv2.COLOR_RGB2HSV)
+        )
+    }
+
+    def labels():
+        # classifying RGB directly is faster, if it's already loaded
+        if len(rgb) > 0:
+            return utils.get_rgb_color_labels(rgb[0])
+        return utils.get_color_labels(derived['hsv'])
+
+    derived['labels'] = cache.get(
+        cache.key(file_hash, 'labels', palette),
+        labels
+    )
+    counts = cache.get(
+        cache.key(file_hash, 'color_profile', palette),
+        lambda: np.bincount(
+            derived['labels'].ravel(),
+            minlength=len(utils.COLOR_LABELS)
+        )
+    )
+    derived['color_profile'] = {
+        color: int(counts[i]) for i, color in enumerate(utils.COLOR_LABELS)
+    }
+
+    if thumbnail_size is not None:
+        derived['thumbnail'] = cache.get(
+            cache.key(file_hash, 'thumbnail', {'size': list(thumbnail_size)}),
+            lambda: cv2.resize(
+                rgb_img(),
+                tuple(thumbnail_size),
+                interpolation=cv2.INTER_AREA
+            )
+        )
+
+    return derived
+
+
+def get_label_integrals(cache, file_hash, labels):
+    """
+    Returns the per color summed-area table of the tiles of an image's
+    color labels (see utils.get_label_integrals). The table has one entry
+    per tile, so it's a small fraction of the size of the labels.
+    """
+    params = {'palette': hash_palette(), 'tile_size': utils.LABEL_TILE_SIZE}
+
+    return cache.get(
+        cache.key(file_hash, 'label_integrals', params),
+        lambda: utils.get_label_integrals(labels)
+    )
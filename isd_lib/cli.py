@@ -0,0 +1,657 @@
+"""
+Command line interface, run with: python -m isd_lib <command> ...
+
+NumPy & OpenCV are only imported once a command runs, so argument parsing
+and --help stay fast.
+"""
+import argparse
+import json
+import os
+import sys
+
+# defaults of the sequence command (see sequence.TILE_SIZE &
+# sequence.CHANGE_THRESHOLD), repeated so --help doesn't import NumPy
+DEFAULT_TILE_SIZE = 64
+DEFAULT_CHANGE_THRESHOLD = 8
+
+
+def parse_rect(text):
+    """
+    Parses an 'x,y,width,height' rectangle argument.
+    """
+    try:
+        rect = tuple(int(v) for v in text.split(','))
+    except ValueError:
+        rect = ()
+
+    if len(rect) != 4:
+        raise argparse.ArgumentTypeError(
+            "rectangle must be given as x,y,width,height"
+        )
+
+    return rect
+
+
+def parse_roi(text):
+    """
+    Parses an ROI argument, either an 'x,y,width,height' rectangle or the
+    path of a JSON or .npy polygon file (see utils.load_roi).
+    """
+    if os.path.exists(text):
+        from isd_lib import utils
+
+        try:
+            return utils.load_roi(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
+    return parse_rect(text)
+
+
+def parse_colors(text):
+    """
+    Parses a comma separated list of color names.
+    """
+    return [c.strip() for c in text.split(',') if c.strip() != '']
+
+
+def parse_chunk(text):
+    """
+    Parses an 'I/N' chunk argument (see manifest.parse_chunk).
+    """
+    from isd_lib import manifest
+
+    try:
+        return manifest.parse_chunk(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def add_detection_args(parser):
+    """
+    Adds the arguments shared by commands that run region detection.
+    """
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument(
+        '--target',
+        help='image file of the target region'
+    )
+    target_group.add_argument(
+        '--target-rect',
+        type=parse_rect,
+        help='target region in the source image as x,y,width,height'
+    )
+    parser.add_argument(
+        '--bg-colors',
+        type=parse_colors,
+        default=None,
+        help='comma separated background colors (default: auto)'
+    )
+    parser.add_argument(
+        '--roi',
+        type=parse_roi,
+        default=None,
+        help='only analyze this area, given as x,y,width,height or a JSON '
+             'or .npy polygon file'
+    )
+    parser.add_argument('--erode', type=int, default=0)
+    parser.add_argument('--dilate', type=int, default=2)
+    parser.add_argument('--min-area', type=float, default=0.5)
+    parser.add_argument('--max-area', type=float, default=2.0)
+    parser.add_argument('--min-score', type=float, default=None)
+    parser.add_argument('--use-shape', action='store_true')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='isd_lib',
+        description='Find image sub-regions similar to a target region.'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    detect_parser = subparsers.add_parser(
+        'detect',
+        help='find regions in an image & print them as JSON'
+    )
+    detect_parser.add_argument('image', help='source image file')
+    add_detection_args(detect_parser)
+    detect_parser.add_argument(
+        '--contours',
+        action='store_true',
+        help='include contour points in the output'
+    )
+    detect_parser.add_argument(
+        '--export-dir',
+        default=None,
+        help='export the regions to this directory'
+    )
+    detect_parser.add_argument(
+        '--format',
+        default='numpy',
+        choices=['numpy', 'tiff', 'both'],
+        help='export format'
+    )
+    detect_parser.add_argument(
+        '--keep-16bit',
+        action='store_true',
+        help='export TIFFs of 16-bit images at 16 bits per channel'
+    )
+    detect_parser.add_argument(
+        '--save-session',
+        default=None,
+        help='save the regions & parameters to this session file'
+    )
+    detect_parser.set_defaults(func=run_detect)
+
+    export_session_parser = subparsers.add_parser(
+        'export-session',
+        help='export the regions of a saved session without re-detecting'
+    )
+    export_session_parser.add_argument('session', help='session file')
+    export_session_parser.add_argument(
+        '--export-dir',
+        required=True,
+        help='export the regions to this directory'
+    )
+    export_session_parser.add_argument(
+        '--format',
+        default='numpy',
+        choices=['numpy', 'tiff', 'both'],
+        help='export format'
+    )
+    export_session_parser.add_argument(
+        '--image',
+        default=None,
+        help='source image file, if moved since the session was saved'
+    )
+    export_session_parser.set_defaults(func=run_export_session)
+
+    batch_parser = subparsers.add_parser(
+        'batch',
+        help='find & export regions for many images'
+    )
+    batch_parser.add_argument('images', nargs='+', help='source image files')
+    add_detection_args(batch_parser)
+    batch_parser.add_argument(
+        '--label',
+        default=None,
+        help='export label, regions are exported to <image dir>/<label>'
+    )
+    batch_parser.add_argument(
+        '--format',
+        default='numpy',
+        choices=['numpy', 'tiff', 'both'],
+        help='export format'
+    )
+    batch_parser.add_argument(
+        '--depth',
+        type=int,
+        default=4,
+        help='# of images queued between pipeline stages'
+    )
+    batch_parser.add_argument(
+        '--detect-workers',
+        type=int,
+        default=1,
+        help='# of detection threads'
+    )
+    batch_parser.add_argument(
+        '--manifest',
+        default=None,
+        help='JSON Lines file recording each image\'s outcome, images '
+             'already done with the same parameters are skipped'
+    )
+    batch_parser.add_argument(
+        '--chunk',
+        type=parse_chunk,
+        default=None,
+        help='only process chunk I of N of the images, given as I/N, e.g. '
+             'to split a batch across machines sharing the manifest'
+    )
+    batch_parser.add_argument(
+        '--skip-failed',
+        action='store_true',
+        help='don\'t retry images that failed with the same parameters'
+    )
+    batch_parser.set_defaults(func=run_batch)
+
+    sequence_parser = subparsers.add_parser(
+        'sequence',
+        help='find & track regions in a frame sequence, printing one JSON '
+             'line per frame'
+    )
+    sequence_parser.add_argument(
+        'source',
+        help='directory of frame images, multi-page TIFF stack or video'
+    )
+    add_detection_args(sequence_parser)
+    sequence_parser.add_argument(
+        '--contours',
+        action='store_true',
+        help='include contour points in the output'
+    )
+    sequence_parser.add_argument(
+        '--tile-size',
+        type=int,
+        default=DEFAULT_TILE_SIZE,
+        help='change detection tile size in pixels'
+    )
+    sequence_parser.add_argument(
+        '--change-threshold',
+        type=int,
+        default=DEFAULT_CHANGE_THRESHOLD,
+        help='only relabel tiles where a pixel value changed by more than '
+             'this, 0 for exact per-frame results'
+    )
+    sequence_parser.set_defaults(func=run_sequence)
+
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help='run a local HTTP detection service'
+    )
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='# of worker processes (default: # of CPUs)'
+    )
+    serve_parser.add_argument(
+        '--max-pending',
+        type=int,
+        default=16,
+        help='maximum # of queued & running requests'
+    )
+    serve_parser.set_defaults(func=run_serve)
+
+    return parser
+
+
+def read_image(file_path):
+    """
+    Reads an image file as a BGR NumPy array.
+    """
+    from isd_lib import loader
+
+    return loader.read_image(file_path)[0]
+
+
+def load_image(file_path):
+    """
+    Loads an image file as RGB & HSV NumPy arrays.
+    """
+    import cv2
+
+    bgr_img = read_image(file_path)
+
+    return (
+        cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB),
+        cv2.cvtColor(bgr_img, cv2.COLOR_BGR2HSV)
+    )
+
+
+def get_target(args, bgr_img):
+    """
+    Returns the HSV target image given on the command line, for
+    --target-rect cut from the given BGR source image.
+    """
+    import cv2
+
+    if args.target_rect is not None:
+        x, y, width, height = args.target_rect
+        return cv2.cvtColor(
+            bgr_img[y:y + height, x:x + width],
+            cv2.COLOR_BGR2HSV
+        )
+
+    return load_image(args.target)[1]
+
+
+def region_to_json(region, include_contour=False):
+    """
+    Converts a region dictionary to a JSON serializable dictionary.
+    """
+    result = {
+        'rectangle': [int(v) for v in region['rectangle']],
+        'area': float(region['area'])
+    }
+    if include_contour:
+        result['contour'] = region['contour'].reshape(-1, 2).tolist()
+
+    return result
+
+
+def detect(args, hsv_img, target, roi=None):
+    """
+    Runs region detection on an image using the detection arguments.
+
+    Returns:
+        List of region dictionaries (see utils.make_region)
+    """
+    from isd_lib import utils
+
+    contours = utils.find_regions(
+        hsv_img,
+        target,
+        bg_colors=args.bg_colors,
+        pre_erode=args.erode,
+        dilate=args.dilate,
+        min_area=args.min_area,
+        max_area=args.max_area,
+        min_score=args.min_score,
+        use_shape=args.use_shape,
+        roi=roi
+    )
+
+    return [utils.make_region(c) for c in contours]
+
+
+def run_detect(args):
+    import cv2
+    from isd_lib import loader
+    from isd_lib import utils
+
+    keep_16bit = args.keep_16bit and args.format != 'numpy'
+    bgr_img, bgr_img_16bit = loader.read_image(args.image, keep_16bit)
+    target = get_target(args, bgr_img)
+
+    # with an ROI, only its bounding rectangle is converted & searched
+    bgr_img, offset, roi_mask = utils.crop_roi(bgr_img, args.roi)
+    if bgr_img_16bit is not None:
+        bgr_img_16bit = utils.crop_roi(bgr_img_16bit, args.roi)[0]
+    roi = None
+    if args.roi is not None:
+        roi = utils.offset_roi(args.roi, (-offset[0], -offset[1]))
+
+    hsv_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2HSV)
+
+    regions = detect(args, hsv_img, target, roi=roi)
+
+    if args.export_dir is not None:
+        from isd_lib import export
+
+        rgb_img = None
+        if bgr_img_16bit is not None:
+            rgb_img = cv2.cvtColor(bgr_img_16bit, cv2.COLOR_BGR2RGB)
+        elif args.format != 'numpy':
+            rgb_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
+
+        export.export_regions(
+            regions,
+            os.path.basename(args.image),
+            args.export_dir,
+            hsv_img,
+            rgb_img=rgb_img,
+            export_format=args.format,
+            offset=offset
+        )
+
+    regions = [utils.offset_region(r, offset) for r in regions]
+
+    if args.save_session is not None:
+        save_session(args, regions, target)
+
+    json.dump(
+        {
+            'image': args.image,
+            'regions': [
+                region_to_json(r, include_contour=args.contours)
+                for r in regions
+            ]
+        },
+        sys.stdout
+    )
+    sys.stdout.write('\n')
+
+    return 0
+
+
+def get_params(args):
+    """
+    Returns the detection arguments as a JSON serializable dictionary.
+    """
+    return {
+        'bg_colors': args.bg_colors,
+        'erode': args.erode,
+        'dilate': args.dilate,
+        'min_area': args.min_area,
+        'max_area': args.max_area,
+        'min_score': args.min_score,
+        'use_shape': args.use_shape
+    }
+
+
+def save_session(args, regions, target):
+    from isd_lib import cache
+    from isd_lib import contours
+    from isd_lib import session
+
+    contour_store = contours.ContourStore()
+    contour_store.extend(regions)
+
+    session.save_session(
+        args.save_session,
+        args.image,
+        contour_store,
+        target=target,
+        roi=args.roi,
+        params=get_params(args),
+        file_hash=cache.hash_file(args.image)
+    )
+
+
+def run_export_session(args):
+    import cv2
+    from isd_lib import cache
+    from isd_lib import export
+    from isd_lib import session
+
+    saved = session.load_session(args.session)
+
+    image_path = args.image or saved['image_path']
+    if saved['file_hash'] is not None:
+        if cache.hash_file(image_path) != saved['file_hash']:
+            sys.stderr.write(
+                "warning: %s has changed since the session was saved\n" %
+                image_path
+            )
+
+    bgr_img = read_image(image_path)
+
+    rgb_img = None
+    if args.format != 'numpy':
+        rgb_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
+
+    count = export.export_regions(
+        session.iter_active_regions(saved),
+        os.path.basename(image_path),
+        args.export_dir,
+        cv2.cvtColor(bgr_img, cv2.COLOR_BGR2HSV),
+        rgb_img=rgb_img,
+        export_format=args.format
+    )
+
+    sys.stdout.write("%s: %d regions exported\n" % (image_path, count))
+
+    return 0
+
+
+def get_batch_params_hash(args, target):
+    """
+    Returns the hash of everything that determines a batch image's
+    results: the detection arguments, the target's pixels, the ROI & the
+    export label & format.
+    """
+    import hashlib
+    from isd_lib import cache
+
+    params = get_params(args)
+    params.update(
+        {
+            'target': hashlib.sha256(target.tobytes()).hexdigest(),
+            'target_shape': list(target.shape),
+            'roi': args.roi,
+            'label': args.label,
+            'format': args.format
+        }
+    )
+
+    return cache.hash_params(params)
+
+
+def run_batch(args):
+    from isd_lib import pipeline
+
+    if args.target_rect is not None:
+        # the target rectangle is taken from the first image
+        target = get_target(args, read_image(args.images[0]))
+    else:
+        target = get_target(args, None)
+
+    batch_manifest = None
+    if args.manifest is not None:
+        from isd_lib import manifest
+
+        batch_manifest = manifest.Manifest(args.manifest, chunk=args.chunk)
+
+    image_paths = args.images
+    if args.chunk is not None:
+        from isd_lib import manifest
+
+        # with a manifest, chunks are dealt by the images' paths relative
+        # to it, the same on every machine sharing it
+        image_paths = manifest.select_chunk(
+            image_paths,
+            *args.chunk,
+            key=batch_manifest.key if batch_manifest is not None else None
+        )
+
+    params_hash = None
+    if batch_manifest is not None:
+        params_hash = get_batch_params_hash(args, target)
+
+        pending = batch_manifest.pending(
+            image_paths,
+            params_hash,
+            retry_failed=not args.skip_failed
+        )
+        if len(pending) < len(image_paths):
+            sys.stderr.write(
+                "%d of %d images already processed, skipped\n" % (
+                    len(image_paths) - len(pending), len(image_paths)
+                )
+            )
+        image_paths = pending
+
+    try:
+        results, stats = pipeline.run_batch(
+            image_paths,
+            target,
+            bg_colors=args.bg_colors,
+            pre_erode=args.erode,
+            dilate=args.dilate,
+            min_area=args.min_area,
+            max_area=args.max_area,
+            min_score=args.min_score,
+            use_shape=args.use_shape,
+            label=args.label,
+            export_format=args.format,
+            roi=args.roi,
+            depth=args.depth,
+            detect_workers=args.detect_workers,
+            manifest=batch_manifest,
+            params_hash=params_hash
+        )
+    finally:
+        if batch_manifest is not None:
+            batch_manifest.close()
+
+    failed = 0
+    for image_path, region_count, error in results:
+        if error is not None:
+            failed += 1
+            sys.stderr.write("%s: %s\n" % (image_path, error))
+        else:
+            sys.stdout.write("%s: %d regions\n" % (image_path, region_count))
+
+    for stage_stats in stats:
+        sys.stderr.write("%s\n" % stage_stats)
+
+    return 1 if failed > 0 else 0
+
+
+def run_sequence(args):
+    import itertools
+    import time
+    from isd_lib import sequence
+
+    frames = sequence.iter_frames(args.source)
+
+    if args.target_rect is not None:
+        # the target rectangle is taken from the first frame
+        first_frame = next(frames, None)
+        if first_frame is None:
+            sys.stderr.write("%s: no frames\n" % args.source)
+            return 1
+
+        target = get_target(args, first_frame)
+        frames = itertools.chain([first_frame], frames)
+    else:
+        target = get_target(args, None)
+
+    detector = sequence.SequenceDetector(
+        target,
+        bg_colors=args.bg_colors,
+        pre_erode=args.erode,
+        dilate=args.dilate,
+        min_area=args.min_area,
+        max_area=args.max_area,
+        min_score=args.min_score,
+        use_shape=args.use_shape,
+        roi=args.roi,
+        tile_size=args.tile_size,
+        change_threshold=args.change_threshold
+    )
+
+    start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        result = {'frame': i, 'regions': []}
+        for region in detector.detect(frame):
+            region_json = region_to_json(region, args.contours)
+            region_json['track'] = region['track']
+            result['regions'].append(region_json)
+
+        json.dump(result, sys.stdout)
+        sys.stdout.write('\n')
+
+    if detector.frames > 0:
+        sys.stderr.write(
+            "%s  %.1f ms/frame\n" % (
+                detector,
+                1000.0 * (time.perf_counter() - start) / detector.frames
+            )
+        )
+
+    return 0
+
+
+def run_serve(args):
+    from isd_lib import server
+
+    server.serve(
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        max_pending=args.max_pending
+    )
+
+    return 0
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    return args.func(args)
@@ -0,0 +1,378 @@
+import cv2
+import numpy as np
+
+INITIAL_CAPACITY = 4096  # initial # of points in the coordinate buffer
+
+INT16_MAX = np.iinfo(np.int16).max
+
+
+class ContourStore(object):
+    """
+    Compact storage for many contours.
+
+    Contour points are kept in one flat (N, 2) int32 coordinate buffer with
+    an offsets array marking where each contour starts, instead of one
+    (N, 1, 2) array (plus dictionary) per region. Bounding rectangles &
+    areas are kept in parallel arrays.
+
+    If a tolerance is given, contours are simplified with the
+    Douglas-Peucker algorithm (cv2.approxPolyDP) before being stored. The
+    rectangle & area are always computed from the original contour.
+    """
+
+    def __init__(self, tolerance=None):
+        self.tolerance = tolerance
+
+        self._coords = np.empty((INITIAL_CAPACITY, 2), dtype=np.int32)
+        self._offsets = np.zeros(INITIAL_CAPACITY + 1, dtype=np.int64)
+        self._rectangles = np.empty((INITIAL_CAPACITY, 4), dtype=np.int32)
+        self._areas = np.empty(INITIAL_CAPACITY, dtype=np.float64)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def coords(self):
+        """
+        Flat (N, 2) array of all stored contour points
+        """
+        return self._coords[:self._offsets[self._count]]
+
+    @property
+    def offsets(self):
+        """
+        Offsets of each contour in coords, with a final end offset
+        """
+        return self._offsets[:self._count + 1]
+
+    @property
+    def rectangles(self):
+        """
+        (count, 4) array of bounding rectangles (x, y, width, height)
+        """
+        return self._rectangles[:self._count]
+
+    @property
+    def areas(self):
+        """
+        Array of contour areas
+        """
+        return self._areas[:self._count]
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes used by the stored data (excluding spare capacity)
+        """
+        return (
+            self.coords.nbytes +
+            self.offsets.nbytes +
+            self.rectangles.nbytes +
+            self.areas.nbytes
+        )
+
+    def _reserve(self, n_contours, n_points):
+        if n_points > len(self._coords):
+            coords = np.empty(
+                (max(n_points, 2 * len(self._coords)), 2),
+                dtype=np.int32
+            )
+            coords[:len(self._coords)] = self._coords
+            self._coords = coords
+
+        if n_contours > len(self._areas):
+            capacity = max(n_contours, 2 * len(self._areas))
+
+            offsets = np.zeros(capacity + 1, dtype=np.int64)
+            offsets[:len(self._offsets)] = self._offsets
+            self._offsets = offsets
+
+            rectangles = np.empty((capacity, 4), dtype=np.int32)
+            rectangles[:self._count] = self.rectangles
+            self._rectangles = rectangles
+
+            areas = np.empty(capacity, dtype=np.float64)
+            areas[:self._count] = self.areas
+            self._areas = areas
+
+    def append(self, contour, area=None):
+        """
+        Adds an OpenCV contour to the store.
+
+        Args:
+            contour: OpenCV contour, (N, 1, 2) array of points
+            area: contour area if already known
+
+        Returns:
+            Index of the stored contour
+        """
+        if area is None:
+            area = cv2.contourArea(contour)
+        rectangle = cv2.boundingRect(contour)
+
+        if self.tolerance is not None:
+            contour = cv2.approxPolyDP(contour, self.tolerance, True)
+
+        points = contour.reshape(-1, 2)
+        start = self._offsets[self._count]
+        end = start + len(points)
+
+        self._reserve(self._count + 1, end)
+
+        self._coords[start:end] = points
+        self._rectangles[self._count] = rectangle
+        self._areas[self._count] = area
+        self._offsets[self._count + 1] = end
+
+        self._count += 1
+
+        return self._count - 1
+
+    def extend(self, regions):
+        """
+        Adds regions (see utils.make_region) to the store.
+
+        Returns:
+            List of the stored indices
+        """
+        return [
+            self.append(region['contour'], region['area'])
+            for region in regions
+        ]
+
+    def contour(self, index):
+        """
+        Returns a stored contour as an (N, 1, 2) OpenCV contour, which is a
+        view into the coordinate buffer.
+        """
+        start = self._offsets[index]
+        end = self._offsets[index + 1]
+
+        return self._coords[start:end].reshape(-1, 1, 2)
+
+    def rectangle(self, index):
+        """
+        Returns the bounding rectangle (x, y, width, height) of a contour
+        """
+        return tuple(int(v) for v in self._rectangles[index])
+
+    def area(self, index):
+        """
+        Returns the area of a contour
+        """
+        return float(self._areas[index])
+
+    def region(self, index):
+        """
+        Returns a region dictionary (see utils.make_region) for a stored
+        contour
+        """
+        return {
+            'contour': self.contour(index),
+            'rectangle': self.rectangle(index),
+            'area': self.area(index)
+        }
+
+    def iter_regions(self, indices=None):
+        """
+        Yields region dictionaries for the given indices (or all contours)
+        """
+        if indices is None:
+            indices = range(self._count)
+
+        for index in indices:
+            yield self.region(index)
+
+    def local_mask(self, index):
+        """
+        Rasterizes a contour into a mask the size of its bounding rectangle.
+
+        Returns:
+            2-D NumPy array (unsigned 8-bit integers) with 255 inside the
+            contour and 0 elsewhere
+        """
+        x, y, width, height = self.rectangle(index)
+
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.drawContours(
+            mask,
+            [self.contour(index)],
+            0,
+            255,
+            -1,
+            offset=(-x, -y)
+        )
+
+        return mask
+
+    def pack(self, delta=False):
+        """
+        Returns the stored data as a dictionary of arrays for saving.
+
+        Args:
+            delta: if True, points are delta-encoded as int16 (each
+                contour's first point relative to its rectangle), which
+                halves the coordinate size. Falls back to int32 absolute
+                coordinates if any step doesn't fit in an int16.
+
+        Returns:
+            Dictionary with 'coords', 'offsets', 'rectangles' & 'areas'
+        """
+        coords = self.coords
+        offsets = self.offsets
+        rectangles = self.rectangles
+
+        if delta and len(coords) > 0:
+            deltas = np.empty_like(coords)
+            deltas[1:] = coords[1:] - coords[:-1]
+
+            starts = offsets[:-1]
+            deltas[starts] = coords[starts] - rectangles[:, :2]
+
+            if np.abs(deltas).max() <= INT16_MAX:
+                coords = deltas.astype(np.int16)
+
+        return {
+            'coords': coords,
+            'offsets': offsets,
+            'rectangles': rectangles,
+            'areas': self.areas
+        }
+
+    @classmethod
+    def unpack(cls, data, tolerance=None):
+        """
+        Creates a store from a dictionary of arrays returned by pack.
+        """
+        coords = np.asarray(data['coords'])
+        offsets = np.asarray(data['offsets'], dtype=np.int64)
+        rectangles = np.asarray(data['rectangles'], dtype=np.int32)
+
+        if coords.dtype == np.int16:
+            # undo delta encoding, restarting the running sum for each
+            # contour at its rectangle's origin
+            lengths = np.diff(offsets)
+            running = np.cumsum(coords, axis=0, dtype=np.int64)
+            before = np.vstack(
+                [np.zeros((1, 2), dtype=np.int64), running]
+            )[offsets[:-1]]
+            origins = rectangles[:, :2].astype(np.int64)
+            coords = running + np.repeat(origins - before, lengths, axis=0)
+
+        store = cls(tolerance=tolerance)
+        store._coords = np.ascontiguousarray(coords, dtype=np.int32)
+        store._offsets = offsets.copy()
+        store._rectangles = rectangles.copy()
+        store._areas = np.asarray(data['areas'], dtype=np.float64).copy()
+        store._count = len(store._areas)
+
+        if len(store._coords) == 0:
+            store._coords = np.empty((INITIAL_CAPACITY, 2), dtype=np.int32)
+
+        return store
+
+
+class RegionHistory(object):
+    """
+    Undo/redo history of edits to the set of active regions in a
+    ContourStore.
+
+    Regions are never removed from the store. Which ones are active is kept
+    as a boolean array over the store's indices, and each edit only records
+    the indices it changed, so deleting a single region costs O(1) memory
+    and undoing an edit needs no re-detection.
+    """
+
+    def __init__(self, count):
+        self.active = np.ones(count, dtype=np.bool_)
+
+        # each edit is an (indices, active) tuple of the changed indices &
+        # their new state
+        self._undo = []
+        self._redo = []
+
+    def __len__(self):
+        """
+        Number of active regions
+        """
+        return int(np.count_nonzero(self.active))
+
+    @property
+    def can_undo(self):
+        return len(self._undo) > 0
+
+    @property
+    def can_redo(self):
+        return len(self._redo) > 0
+
+    def active_indices(self):
+        """
+        Returns the indices of the active regions
+        """
+        return np.flatnonzero(self.active)
+
+    def set_active(self, indices, active):
+        """
+        Activates or deactivates regions as a single undoable edit.
+
+        Returns:
+            Array of the indices whose state changed
+        """
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        indices = indices[self.active[indices] != active]
+
+        if len(indices) == 0:
+            return indices
+
+        self.active[indices] = active
+        self._undo.append((indices, active))
+        self._redo = []
+
+        return indices
+
+    def remove(self, indices):
+        """
+        Deactivates regions, see set_active
+        """
+        return self.set_active(indices, False)
+
+    def clear(self):
+        """
+        Deactivates all regions, see set_active
+        """
+        return self.set_active(self.active_indices(), False)
+
+    def undo(self):
+        """
+        Reverts the last edit.
+
+        Returns:
+            Tuple of the changed indices & their new state, or None if
+            there is nothing to undo
+        """
+        if not self._undo:
+            return None
+
+        indices, active = self._undo.pop()
+        self.active[indices] = not active
+        self._redo.append((indices, active))
+
+        return indices, not active
+
+    def redo(self):
+        """
+        Re-applies the last undone edit.
+
+        Returns:
+            Tuple of the changed indices & their new state, or None if
+            there is nothing to redo
+        """
+        if not self._redo:
+            return None
+
+        indices, active = self._redo.pop()
+        self.active[indices] = active
+        self._undo.append((indices, active))
+
+        return indices, active
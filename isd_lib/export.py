@@ -0,0 +1,157 @@
+import os
+import re
+import cv2
+import numpy as np
+import PIL.Image
+
+EXPORT_FORMATS = ['numpy', 'tiff', 'both']
+
+
+def get_output_filename(image_name, x, y):
+    """
+    Returns the base file name (without extension) for a region exported
+    from the named image at the given top left coordinates.
+    """
+    match = re.search(r'(.+)\.(.+)$', image_name)
+
+    return "".join(
+        [
+            match.groups()[0],
+            '_',
+            str(x),
+            ',',
+            str(y)
+        ]
+    )
+
+
+def get_masked_region(hsv_img, region, region_labels=None):
+    """
+    Extracts a region's pixels from an HSV image, masked by its contour.
+
+    Args:
+        hsv_img: 3-D NumPy array of pixels in HSV
+        region: region dictionary with 'contour' & 'rectangle' entries,
+            and a 'label' entry if it's in region_labels
+        region_labels: optional region label image (see
+            utils.get_region_labels). The mask of a region with a 'label'
+            is taken from it, other regions have their contour rasterized.
+
+    Returns:
+        3-D NumPy array (signed 16-bit integers) of the region's bounding
+        rectangle, where pixels outside the contour are set to -1
+    """
+    x1, y1, width, height = region['rectangle']
+
+    # extract sub-region from original image using rectangle
+    hsv_region = hsv_img[y1:y1 + height, x1:x1 + width]
+
+    if region_labels is not None and 'label' in region:
+        mask = region_labels[y1:y1 + height, x1:x1 + width] == region['label']
+        mask = mask.view(np.uint8)
+    else:
+        # create a mask from the contour, offset by the rect coordinates
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.drawContours(
+            mask,
+            [region['contour']],
+            0,
+            1,
+            -1,
+            offset=(-x1, -y1)
+        )
+
+    # copy the contour pixels into an int16 array initialized to -1, so
+    # non-contour pixels are -1
+    masked_region = np.full(hsv_region.shape, -1, dtype=np.int16)
+    np.copyto(masked_region, hsv_region, where=mask.astype(bool)[..., None])
+
+    return masked_region
+
+
+def export_regions(
+        regions,
+        image_name,
+        output_dir,
+        hsv_img,
+        rgb_img=None,
+        export_format='numpy',
+        offset=(0, 0),
+        region_labels=None
+):
+    """
+    Exports regions to files, one at a time, so regions can be streamed
+    from a generator (e.g. utils.iter_regions) without holding them all
+    in memory.
+
+    Args:
+        regions: iterable of region dictionaries with 'contour' &
+            'rectangle' entries
+        image_name: file name of the source image, used to build the
+            output file names
+        output_dir: directory to save the files in, created if needed
+        hsv_img: 3-D NumPy array of pixels in HSV (source image)
+        rgb_img: 3-D NumPy array of pixels in RGB (source image), required
+            for the 'tiff' & 'both' formats. 16-bit images (see
+            loader.load_rgb) are exported as 16-bit TIFFs.
+        export_format: 'numpy', 'tiff' or 'both'
+        offset: (x, y) position of the given images within the source
+            image, when they were cropped from it (e.g. to an ROI). Only
+            used to name the output files.
+        region_labels: optional region label image (see
+            utils.get_region_labels) to take the masks of regions with a
+            'label' entry from, instead of rasterizing their contours
+
+    Returns:
+        Number of regions exported
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: %s" % export_format)
+
+    if export_format in ('tiff', 'both') and rgb_img is None:
+        raise ValueError("An RGB image is required to export TIFF files")
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    count = 0
+
+    for region in regions:
+        x1, y1, width, height = region['rectangle']
+
+        # build base file name for output files
+        output_filename = get_output_filename(
+            image_name,
+            x1 + offset[0],
+            y1 + offset[1]
+        )
+
+        if export_format == 'tiff' or export_format == 'both':
+            rgb_region = rgb_img[y1:y1 + height, x1:x1 + width]
+            tif_filename = ".".join([output_filename, 'tif'])
+            tif_file_path = "/".join([output_dir, tif_filename])
+
+            if rgb_region.dtype == np.uint8:
+                PIL.Image.fromarray(rgb_region, 'RGB').save(tif_file_path)
+            else:
+                # PIL doesn't support 3-channel 16-bit images
+                cv2.imwrite(
+                    tif_file_path,
+                    cv2.cvtColor(rgb_region, cv2.COLOR_RGB2BGR)
+                )
+
+        if export_format == 'numpy' or export_format == 'both':
+            masked_region = get_masked_region(
+                hsv_img,
+                region,
+                region_labels
+            )
+
+            # save sub-region to file as NumPy array
+            npy_filename = ".".join([output_filename, 'npy'])
+            npy_file_path = "/".join([output_dir, npy_filename])
+            np.save(npy_file_path, masked_region)
+
+        count += 1
+
+    return count
@@ -0,0 +1,134 @@
+"""
+Image loading that decodes each file once.
+
+Files are decoded at their native bit depth. 8-bit images are used as
+is. 16-bit images are scaled to 8 bits in one vectorized pass, exactly
+as OpenCV's own 8-bit decoding would (see to_8bit), and the 16-bit data
+can optionally be kept for export. The BGR to RGB swap is
+done in place, so loading an image allocates one 8-bit array. Consumers
+(the GUI canvas, selections, exports) take views of that array instead
+of making their own copies.
+"""
+import cv2
+import numpy as np
+
+# scale mapping the full 16-bit range onto the full 8-bit range, with
+# rounding this matches OpenCV's own 16 to 8-bit TIFF conversion
+SCALE_16_TO_8 = 255.0 / 65535.0
+
+# leading bytes of (Big)TIFF files, in little & big endian byte order
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+
+def is_tiff(header):
+    """
+    Returns True if the first bytes of an encoded image are a TIFF header.
+    """
+    return bytes(header[:4]) in TIFF_SIGNATURES
+
+
+def to_8bit(img, rounding=False):
+    """
+    Converts an image to unsigned 8-bit integers.
+
+    16-bit data is converted like OpenCV decodes it as 8-bit: PNG, PNM &
+    JPEG 2000 decoders drop the low byte, the TIFF decoder scales &
+    rounds (rounding=True).
+
+    Args:
+        img: NumPy array of 8-bit or 16-bit unsigned integers (in any
+            byte order), or floats in the range 0 to 1
+        rounding: scale 16-bit data by 255 / 65535 & round, instead of
+            dropping the low byte
+
+    Returns:
+        NumPy array (unsigned 8-bit integers), the given array itself if
+        it's already 8-bit
+    """
+    if img.dtype == np.uint8:
+        return img
+
+    if img.dtype.kind == 'u' and img.dtype.itemsize == 2:
+        if img.dtype != np.uint16:
+            # big endian data, e.g. from PIL
+            img = img.astype(np.uint16)
+
+        if rounding:
+            return cv2.convertScaleAbs(img, alpha=SCALE_16_TO_8)
+
+        img_8bit = np.empty(img.shape, dtype=np.uint8)
+        np.right_shift(img, 8, out=img_8bit, casting='unsafe')
+
+        return img_8bit
+
+    if img.dtype.kind == 'f':
+        return cv2.convertScaleAbs(img, alpha=255.0)
+
+    raise ValueError("Unsupported image data type: %s" % img.dtype)
+
+
+def read_image(file_path, keep_16bit=False):
+    """
+    Decodes an image file as BGR once, at its native bit depth.
+
+    Args:
+        file_path: image file path
+        keep_16bit: also return the 16-bit data of 16-bit images
+
+    Returns:
+        Tuple of the BGR image as a C-contiguous NumPy array (unsigned
+        8-bit integers), and the 16-bit BGR image if keep_16bit is True &
+        the file is 16-bit (else None)
+
+    Raises:
+        IOError: if the file can't be read
+    """
+    img = cv2.imread(file_path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_COLOR)
+    if img is None:
+        raise IOError("Could not read image: %s" % file_path)
+
+    rounding = False
+    img_16bit = None
+    if img.dtype == np.uint16:
+        with open(file_path, 'rb') as f:
+            rounding = is_tiff(f.read(4))
+
+        if keep_16bit:
+            img_16bit = img
+
+    return to_8bit(img, rounding), img_16bit
+
+
+def load_rgb(file_path, keep_16bit=False):
+    """
+    Loads an image file as RGB, decoding it once.
+
+    The channels are swapped in place, so no array beyond the decoded
+    image (and its 8-bit conversion for 16-bit files) is allocated.
+
+    Args:
+        file_path: image file path
+        keep_16bit: also return the 16-bit data of 16-bit images
+
+    Returns:
+        Tuple of the RGB image as a C-contiguous NumPy array (unsigned
+        8-bit integers), and the 16-bit RGB image if keep_16bit is True &
+        the file is 16-bit (else None)
+    """
+    img, img_16bit = read_image(file_path, keep_16bit)
+
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+    if img_16bit is not None:
+        img_16bit = cv2.cvtColor(img_16bit, cv2.COLOR_BGR2RGB, dst=img_16bit)
+
+    return img, img_16bit
+
+
+def load_hsv(file_path):
+    """
+    Loads an image file as HSV (see utils.get_color_labels), decoding it
+    once & converting it in place.
+    """
+    img = read_image(file_path)[0]
+
+    return cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=img)
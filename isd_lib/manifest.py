@@ -0,0 +1,362 @@
+"""
+Batch manifests for resumable & chunked batch runs.
+
+A manifest is a JSON Lines file with one record per processed image: its
+path, the hash of the parameters it was processed with, the status
+('done' or 'failed'), the # of regions, the output directory & the
+error of a failed image. Records are only ever appended (and flushed to
+disk one at a time), so a run that dies loses at most the image it was
+working on, and the latest record of an image & parameters hash in a
+file wins when it's read back.
+
+A batch can be split into chunks run on several machines sharing a
+filesystem. Each chunk appends to its own part file next to the
+manifest (e.g. batch.2of4.jsonl for batch.jsonl), so no two processes
+write the same file, while every run reads the records of all parts.
+Images are recorded by their path relative to the manifest's directory,
+so machines mounting the filesystem at different paths agree on them.
+The clocks of different machines aren't compared, if the parts disagree
+on an image processed with the same parameters a 'done' record wins over
+a 'failed' one.
+"""
+import glob
+import json
+import os
+import re
+import socket
+import time
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def parse_chunk(text):
+    """
+    Parses an 'I/N' chunk argument (the I-th of N chunks, 1-based).
+
+    Returns:
+        Tuple of the 0-based chunk index & the # of chunks
+
+    Raises:
+        ValueError: if the chunk isn't valid
+    """
+    try:
+        index, count = (int(v) for v in text.split('/'))
+    except ValueError:
+        raise ValueError("chunk must be given as I/N, e.g. 2/4")
+
+    if not 1 <= index <= count:
+        raise ValueError("chunk %d/%d is out of range" % (index, count))
+
+    return index - 1, count
+
+
+def get_image_key(image_path, base_dir):
+    """
+    Returns the path of an image relative to a directory, with '/'
+    separators, e.g. to the directory of a manifest.
+    """
+    key = os.path.relpath(os.path.abspath(image_path), base_dir)
+
+    return key.replace(os.sep, '/')
+
+
+def select_chunk(image_paths, index, count, key=None):
+    """
+    Returns the image paths of one chunk of a batch.
+
+    Images are dealt out round robin by their sorted keys, so every
+    machine given the same images (in any order) selects disjoint chunks
+    of about the same size.
+
+    Args:
+        image_paths: iterable of image file paths
+        index: 0-based chunk index
+        count: # of chunks
+        key: optional function returning the sort key of an image path,
+            e.g. Manifest.key so machines that mount the images at
+            different paths deal out the same chunks. By default the
+            paths as given are sorted.
+    """
+    return sorted(image_paths, key=key)[index::count]
+
+
+def get_part_path(file_path, chunk=None):
+    """
+    Returns the file a run appends its records to, the manifest itself or
+    for a (index, count) chunk its part file.
+    """
+    if chunk is None:
+        return file_path
+
+    root, ext = os.path.splitext(file_path)
+
+    return '%s.%dof%d%s' % (root, chunk[0] + 1, chunk[1], ext)
+
+
+def get_status_rank(record):
+    """
+    Returns the rank of a record's status when records of an image in
+    different files disagree, higher ranks win.
+    """
+    return 1 if record.get('status') == STATUS_DONE else 0
+
+
+class Manifest(object):
+    """
+    Reads & appends the records of a batch manifest.
+
+    Args:
+        file_path: manifest file path, created when the first record is
+            written
+        chunk: optional (index, count) chunk this run processes, its
+            records are written to the chunk's part file
+
+    Attributes:
+        records: dictionary of the record of each image & parameters
+            hash, by (image key, parameters hash) (see key)
+    """
+
+    def __init__(self, file_path, chunk=None):
+        self.file_path = file_path
+        self.part_path = get_part_path(file_path, chunk)
+        self.base_dir = os.path.dirname(os.path.abspath(file_path))
+        self.records = {}
+
+        self._file = None
+
+        self.load()
+
+    def _iter_paths(self):
+        root, ext = os.path.splitext(self.file_path)
+
+        part_pattern = re.compile(r'\.\d+of\d+$')
+        part_paths = glob.glob('%s.*of*%s' % (glob.escape(root), ext))
+
+        paths = [self.file_path]
+        for path in sorted(part_paths):
+            if part_pattern.search(os.path.splitext(path)[0]):
+                paths.append(path)
+
+        return paths
+
+    def key(self, image_path):
+        """
+        Returns the key an image is recorded by, its path relative to the
+        manifest's directory.
+        """
+        return get_image_key(image_path, self.base_dir)
+
+    def load(self):
+        """
+        (Re-)reads the records of the manifest & all its part files.
+        Lines that can't be parsed, e.g. one cut off when a run was
+        killed, are ignored.
+
+        Records are kept per image & parameters hash, so records made
+        with other parameters never decide an image's status. Within a
+        file the latest record wins. Between files, which may be written
+        by machines with different clocks, a 'done' record wins over a
+        'failed' one.
+        """
+        records = {}
+
+        for path in self._iter_paths():
+            try:
+                f = open(path)
+            except (IOError, OSError):
+                continue
+
+            # records are appended by a single run, so in write order
+            file_records = {}
+            with f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if isinstance(record, dict) and 'image' in record:
+                        # manifests written before images were recorded
+                        # by relative path have absolute ones
+                        if os.path.isabs(record['image']):
+                            record['image'] = self.key(record['image'])
+
+                        file_records[
+                            (record['image'], record.get('params'))
+                        ] = record
+
+            for key, record in file_records.items():
+                current = records.get(key)
+                if current is None or (
+                        get_status_rank(record) >= get_status_rank(current)
+                ):
+                    records[key] = record
+
+        self.records = records
+
+    def get(self, image_path, params_hash):
+        """
+        Returns the record of an image processed with the given
+        parameters, or None.
+        """
+        return self.records.get((self.key(image_path), params_hash))
+
+    def is_done(self, image_path, params_hash):
+        """
+        Returns True if an image was processed successfully with the given
+        parameters.
+        """
+        record = self.get(image_path, params_hash)
+
+        return record is not None and record.get('status') == STATUS_DONE
+
+    def pending(self, image_paths, params_hash, retry_failed=True):
+        """
+        Returns the image paths that still need to be processed, images
+        done with other parameters are processed again.
+
+        Args:
+            image_paths: iterable of image file paths
+            params_hash: hash of the batch parameters (see
+                cache.hash_params)
+            retry_failed: also return images whose latest attempt with
+                these parameters failed
+        """
+        pending = []
+
+        for image_path in image_paths:
+            record = self.get(image_path, params_hash)
+
+            if record is not None:
+                status = record.get('status')
+                if status == STATUS_DONE:
+                    continue
+                if status == STATUS_FAILED and not retry_failed:
+                    continue
+
+            pending.append(image_path)
+
+        return pending
+
+    def record(
+            self,
+            image_path,
+            params_hash,
+            status,
+            regions=None,
+            output=None,
+            error=None
+    ):
+        """
+        Appends a record for an image & flushes it to disk.
+
+        Args:
+            image_path: image file path
+            params_hash: hash of the batch parameters
+            status: STATUS_DONE or STATUS_FAILED
+            regions: # of regions found
+            output: directory the regions were exported to, if any
+            error: error message of a failed image
+
+        Returns:
+            The record dictionary
+        """
+        key = self.key(image_path)
+
+        attempts = 1
+        previous = self.records.get((key, params_hash))
+        if previous is not None:
+            attempts += previous.get('attempts', 1)
+
+        record = {
+            'image': key,
+            'params': params_hash,
+            'status': status,
+            'regions': regions,
+            'output': os.path.abspath(output) if output else None,
+            'error': error,
+            'attempts': attempts,
+            'host': socket.gethostname(),
+            'time': time.time()
+        }
+
+        if self._file is None:
+            self._file = self._open_part()
+
+        # one write per line, so a killed run leaves at most one partial
+        # line behind
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        self.records[(key, params_hash)] = record
+
+        return record
+
+    def record_result(
+            self,
+            image_path,
+            params_hash,
+            regions,
+            error,
+            output=None
+    ):
+        """
+        Records the outcome of a batch image (see pipeline.run_batch).
+
+        Args:
+            image_path: image file path
+            params_hash: hash of the batch parameters
+            regions: list of the image's regions, None if it failed
+            error: exception raised for the image, or None
+            output: directory the regions were exported to, if any
+
+        Returns:
+            The record dictionary
+        """
+        if error is not None:
+            return self.record(
+                image_path,
+                params_hash,
+                STATUS_FAILED,
+                error='%s: %s' % (type(error).__name__, error)
+            )
+
+        return self.record(
+            image_path,
+            params_hash,
+            STATUS_DONE,
+            regions=len(regions),
+            output=output
+        )
+
+    def _open_part(self):
+        # end a line cut off by a killed run, so the next record isn't
+        # appended to it
+        cut_off = False
+        try:
+            with open(self.part_path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    cut_off = f.read(1) != b'\n'
+        except (IOError, OSError):
+            pass
+
+        f = open(self.part_path, 'a')
+        if cut_off:
+            f.write('\n')
+
+        return f
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,436 @@
+"""
+Staged, pipelined batch processing.
+
+Each stage runs in its own thread(s) and stages are connected by bounded
+queues, so reading the next images, detecting regions & writing exported
+files overlap instead of taking turns. OpenCV & NumPy release the GIL for
+the heavy work (decoding, color conversion, morphology, file I/O), so
+threads are enough to keep the disk and the CPU busy at the same time.
+"""
+import os
+import queue
+import threading
+import time
+
+DEFAULT_DEPTH = 4  # max # of items waiting between two stages
+
+_DONE = object()
+
+
+class StageStats(object):
+    """
+    Throughput & utilization statistics for one pipeline stage.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.start_time = None
+        self.end_time = None
+
+        self._lock = threading.Lock()
+
+    def record(self, seconds, error=False):
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += seconds
+            if error:
+                self.errors += 1
+
+    @property
+    def wall_seconds(self):
+        if self.start_time is None:
+            return 0.0
+
+        end_time = self.end_time
+        if end_time is None:
+            end_time = time.perf_counter()
+
+        return end_time - self.start_time
+
+    @property
+    def throughput(self):
+        """
+        Items processed per second of wall time
+        """
+        if self.wall_seconds <= 0:
+            return 0.0
+
+        return self.items / self.wall_seconds
+
+    @property
+    def utilization(self):
+        """
+        Fraction of the stage's worker time spent processing items, the
+        rest was spent waiting on the neighbouring stages
+        """
+        if self.wall_seconds <= 0:
+            return 0.0
+
+        return self.busy_seconds / (self.wall_seconds * self.workers)
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'items': self.items,
+            'errors': self.errors,
+            'busy_seconds': self.busy_seconds,
+            'wall_seconds': self.wall_seconds,
+            'throughput': self.throughput,
+            'utilization': self.utilization
+        }
+
+    def __str__(self):
+        return "%-8s %5d items  %7.2f items/s  %5.1f%% busy" % (
+            self.name,
+            self.items,
+            self.throughput,
+            100.0 * self.utilization
+        )
+
+
+class Pipeline(object):
+    """
+    Runs items through a sequence of stages.
+
+    Args:
+        stages: list of (name, function) or (name, function, workers)
+            tuples. Each function takes the previous stage's result (the
+            input item for the first stage) & returns its own result.
+        depth: maximum # of results queued between two stages
+    """
+
+    def __init__(self, stages, depth=DEFAULT_DEPTH):
+        self.stages = []
+        for stage in stages:
+            if len(stage) == 2:
+                stage = (stage[0], stage[1], 1)
+            self.stages.append(stage)
+
+        self.depth = depth
+        self.stats = [
+            StageStats(name, workers) for name, func, workers in self.stages
+        ]
+
+    def run(self, items):
+        """
+        Runs the items through all stages.
+
+        Yields:
+            (item, result, error) tuples in completion order, where error is
+            the exception raised by the first failing stage (later stages
+            are skipped for that item) or None
+        """
+        queues = [
+            queue.Queue(maxsize=self.depth)
+            for i in range(len(self.stages) + 1)
+        ]
+
+        threads = [
+            threading.Thread(
+                target=self._feed,
+                args=(items, queues[0], self.stages[0][2])
+            )
+        ]
+
+        for i, (name, func, workers) in enumerate(self.stages):
+            if i + 1 < len(self.stages):
+                next_workers = self.stages[i + 1][2]
+            else:
+                next_workers = 1
+
+            remaining = [workers]
+            lock = threading.Lock()
+
+            for w in range(workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(
+                            func,
+                            self.stats[i],
+                            queues[i],
+                            queues[i + 1],
+                            remaining,
+                            lock,
+                            next_workers
+                        )
+                    )
+                )
+
+        start_time = time.perf_counter()
+        for stats in self.stats:
+            stats.start_time = start_time
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            unit = queues[-1].get()
+            if unit is _DONE:
+                break
+
+            yield unit[0], unit[1], unit[2]
+
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def _feed(items, out_queue, workers):
+        for item in items:
+            # each unit is [item, current value, error]
+            out_queue.put([item, item, None])
+
+        for w in range(workers):
+            out_queue.put(_DONE)
+
+    @staticmethod
+    def _work(
+            func,
+            stats,
+            in_queue,
+            out_queue,
+            remaining,
+            lock,
+            next_workers
+    ):
+        while True:
+            unit = in_queue.get()
+
+            if unit is _DONE:
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+
+                if last:
+                    stats.end_time = time.perf_counter()
+                    for w in range(next_workers):
+                        out_queue.put(_DONE)
+
+                return
+
+            if unit[2] is None:
+                start = time.perf_counter()
+                try:
+                    unit[1] = func(unit[1])
+                except Exception as e:
+                    unit[1] = None
+                    unit[2] = e
+                stats.record(time.perf_counter() - start, unit[2] is not None)
+
+            out_queue.put(unit)
+
+
+def run_batch(
+        image_paths,
+        target_img,
+        bg_colors=None,
+        pre_erode=0,
+        dilate=2,
+        min_area=0.5,
+        max_area=2.0,
+        min_score=None,
+        use_shape=False,
+        label=None,
+        export_format='numpy',
+        roi=None,
+        depth=DEFAULT_DEPTH,
+        detect_workers=1,
+        reuse_buffers=True,
+        manifest=None,
+        params_hash=None,
+        on_result=None
+):
+    """
+    Finds & exports regions for a batch of images as a pipeline of read,
+    detect & write stages.
+
+    Args:
+        image_paths: iterable of image file paths
+        target_img: 3-D NumPy array of pixels in HSV (target image)
+        bg_colors: list of background color names, if None the dominant
+            color of each image is used
+        pre_erode, dilate, min_area, max_area, min_score, use_shape: see
+            utils.find_regions
+        label: export label, regions are exported to a directory with this
+            name next to each image. If None nothing is exported.
+        export_format: 'numpy', 'tiff' or 'both'
+        roi: optional analysis region of interest (see utils.get_roi),
+            images are cropped to its bounding rectangle as they are read
+        depth: maximum # of images queued between stages
+        detect_workers: # of detection threads
+        reuse_buffers: give each detection thread a workspace.Workspace,
+            so same sized images reuse its mask buffers
+        manifest: optional manifest.Manifest, each image's outcome is
+            recorded in it as soon as the image is finished. Selecting
+            the images still to do is up to the caller (see
+            manifest.Manifest.pending).
+        params_hash: hash of the batch parameters recorded with each
+            image, required with a manifest
+        on_result: optional function called with the image path, the list
+            of region dictionaries (None if it failed) & the error (or
+            None) of each image as soon as the image is finished. The
+            regions aren't kept after the call, so memory doesn't grow
+            with the batch.
+
+    Returns:
+        Tuple of a list of (image_path, # of regions, error) tuples, where
+        the # of regions is None for failed images, & the list of
+        StageStats for the read, detect & write stages
+    """
+    import cv2
+    from isd_lib import export
+    from isd_lib import loader
+    from isd_lib import utils
+    from isd_lib import workspace
+
+    keep_rgb = label is not None and export_format in ('tiff', 'both')
+    keep_bgr = label is not None or min_score is not None
+    targets = {}
+    targets_lock = threading.Lock()
+
+    # workspaces can't be shared between threads
+    local = threading.local()
+
+    def get_workspace():
+        if not reuse_buffers:
+            return None
+
+        if not hasattr(local, 'workspace'):
+            local.workspace = workspace.Workspace()
+        return local.workspace
+
+    def get_target(colors):
+        key = tuple(colors)
+        with targets_lock:
+            if key not in targets:
+                targets[key] = utils.prepare_target(
+                    target_img,
+                    colors,
+                    pre_erode,
+                    dilate
+                )
+            return targets[key]
+
+    def read(image_path):
+        bgr_img = loader.read_image(image_path)[0]
+
+        bgr_img, offset, roi_mask = utils.crop_roi(bgr_img, roi)
+
+        local_roi = None
+        if roi is not None:
+            local_roi = utils.offset_roi(roi, (-offset[0], -offset[1]))
+
+        # detection only needs the color labels, which are looked up
+        # straight from BGR. HSV (& RGB) is only converted for exports.
+        return {
+            'path': image_path,
+            'offset': offset,
+            'roi': local_roi,
+            'labels': utils.get_rgb_color_labels(bgr_img, order='bgr'),
+            'bgr': bgr_img if keep_bgr else None
+        }
+
+    def detect(image):
+        colors = bg_colors
+        if colors is None:
+            colors = [
+                utils.estimate_dominant_color(
+                    utils.crop_roi(image['labels'], image['roi'])[0]
+                )[0]
+            ]
+
+        target = get_target(colors)
+        image['regions'] = list(
+            utils.iter_target_regions(
+                image['labels'],
+                target,
+                min_area=min_area,
+                max_area=max_area,
+                roi=image['roi'],
+                workspace=get_workspace()
+            )
+        )
+
+        # scoring needs the HSV pixels, which the export can reuse
+        image['hsv'] = None
+        if min_score is not None:
+            image['hsv'] = cv2.cvtColor(image['bgr'], cv2.COLOR_BGR2HSV)
+
+            ranked = utils.rank_regions(
+                image['hsv'],
+                [r['contour'] for r in image['regions']],
+                target['image'],
+                target['mask'],
+                min_score=min_score,
+                use_shape=use_shape
+            )
+            image['regions'] = [utils.make_region(c) for c, score in ranked]
+
+        return image
+
+    def write(image):
+        if label is not None:
+            bgr_img = image['bgr']
+
+            hsv_img = image['hsv']
+            if hsv_img is None and export_format != 'tiff':
+                hsv_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2HSV)
+
+            rgb_img = None
+            if keep_rgb:
+                rgb_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
+
+            export.export_regions(
+                image['regions'],
+                os.path.basename(image['path']),
+                os.path.join(os.path.dirname(image['path']), label),
+                hsv_img,
+                rgb_img=rgb_img,
+                export_format=export_format,
+                offset=image['offset']
+            )
+
+        # only the regions are kept, so finished images can be freed
+        return [
+            utils.offset_region(r, image['offset'])
+            for r in image['regions']
+        ]
+
+    pipeline = Pipeline(
+        [
+            ('read', read),
+            ('detect', detect, detect_workers),
+            ('write', write)
+        ],
+        depth=depth
+    )
+
+    results = []
+    for image_path, regions, error in pipeline.run(image_paths):
+        results.append(
+            (image_path, None if regions is None else len(regions), error)
+        )
+
+        if on_result is not None:
+            on_result(image_path, regions, error)
+
+        if manifest is not None:
+            output = None
+            if label is not None:
+                output = os.path.join(os.path.dirname(image_path), label)
+
+            manifest.record_result(
+                image_path,
+                params_hash,
+                regions,
+                error,
+                output=output
+            )
+
+    return results, pipeline.stats
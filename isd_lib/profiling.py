@@ -0,0 +1,310 @@
+"""
+Latency profiling of interactive event handlers.
+
+A Profiler records how long each handler call takes into per-handler
+latency histograms, keeps the calls that took longer than one frame as
+slow events, and can run cProfile while handlers run (but not while the
+event loop idles). The results can be written as a text report, a
+cProfile stats file (for pstats, snakeviz, gprof2dot or flameprof) and a
+Chrome trace event file, which chrome://tracing & Perfetto show as a
+flame chart of the handler calls.
+
+Handlers are measured with the profiled decorator on methods of an
+object with a 'profiler' attribute. A disabled profiler costs one
+attribute check per call.
+"""
+import bisect
+import collections
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+
+# upper bounds (ms) of the latency histogram bins, the last bin holds all
+# slower calls
+HISTOGRAM_BOUNDS_MS = (1, 2, 4, 8, 16, 33, 66, 133, 266, 533, 1000)
+
+# a handler call taking longer than one frame at 60 Hz is a slow frame
+SLOW_FRAME_MS = 1000.0 / 60.0
+
+MAX_SAMPLES = 4096  # latencies kept per handler for percentiles
+MAX_EVENTS = 100000  # handler calls kept for the trace
+
+
+class HandlerStats(object):
+    """
+    Latency statistics for one handler.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.slow_calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+
+        self._samples = collections.deque(maxlen=MAX_SAMPLES)
+
+    def record(self, ms, slow=False):
+        self.calls += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.histogram[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, ms)] += 1
+        self._samples.append(ms)
+        if slow:
+            self.slow_calls += 1
+
+    @property
+    def mean_ms(self):
+        if self.calls == 0:
+            return 0.0
+
+        return self.total_ms / self.calls
+
+    def percentile(self, q):
+        """
+        Returns the q-th percentile (0 to 100) of the recent latencies (ms)
+        """
+        if not self._samples:
+            return 0.0
+
+        samples = sorted(self._samples)
+        index = int(round(q / 100.0 * (len(samples) - 1)))
+
+        return samples[index]
+
+    def as_dict(self):
+        return {
+            'handler': self.name,
+            'calls': self.calls,
+            'slow_calls': self.slow_calls,
+            'mean_ms': self.mean_ms,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'max_ms': self.max_ms,
+            'histogram_bounds_ms': list(HISTOGRAM_BOUNDS_MS),
+            'histogram': list(self.histogram)
+        }
+
+    def __str__(self):
+        return (
+            "%-24s %6d calls  mean %7.1f  p50 %7.1f  p95 %7.1f  "
+            "max %7.1f ms  %5d slow" % (
+                self.name,
+                self.calls,
+                self.mean_ms,
+                self.percentile(50),
+                self.percentile(95),
+                self.max_ms,
+                self.slow_calls
+            )
+        )
+
+
+class Profiler(object):
+    """
+    Records handler latencies while enabled.
+
+    Args:
+        slow_ms: calls taking longer than this many milliseconds are
+            recorded as slow events
+        listener: optional function called with the handler name &
+            latency (ms) after each outermost handler call, e.g. to show
+            the latest timing in the GUI
+    """
+
+    def __init__(self, slow_ms=SLOW_FRAME_MS, listener=None):
+        self.slow_ms = slow_ms
+        self.listener = listener
+        self.enabled = False
+
+        self.stats = collections.OrderedDict()
+        self.slow_events = collections.deque(maxlen=MAX_EVENTS)
+
+        self._events = collections.deque(maxlen=MAX_EVENTS)
+        self._profile = None
+        self._depth = 0
+        self._start_time = time.perf_counter()
+        self._thread_id = threading.get_ident()
+
+    def enable(self, use_cprofile=True):
+        """
+        Starts recording, discarding any earlier results.
+
+        Args:
+            use_cprofile: also run cProfile during handler calls
+        """
+        self.stats = collections.OrderedDict()
+        self.slow_events.clear()
+        self._events.clear()
+        self._profile = cProfile.Profile() if use_cprofile else None
+        self._depth = 0
+        self._start_time = time.perf_counter()
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stops recording, the results are kept until the next enable.
+        """
+        self.enabled = False
+
+    def measure(self, name, func, *args, **kwargs):
+        """
+        Calls a function, recording its latency under the given name.
+
+        Calls from other threads & calls made while the profiler is
+        disabled are not recorded.
+        """
+        if not self.enabled or threading.get_ident() != self._thread_id:
+            return func(*args, **kwargs)
+
+        outermost = self._depth == 0
+        self._depth += 1
+        if outermost and self._profile is not None:
+            self._profile.enable()
+
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+
+            self._depth -= 1
+            if outermost and self._profile is not None:
+                self._profile.disable()
+
+            self._record(name, start, end, outermost)
+
+    def record_interval(self, name, start, end=None):
+        """
+        Records a latency that isn't a single call, e.g. from an input
+        event to the redraw showing it. start & end are time.perf_counter
+        values, end defaults to now.
+        """
+        if not self.enabled:
+            return
+
+        if end is None:
+            end = time.perf_counter()
+
+        self._record(name, start, end, True, notify=False)
+
+    def _record(self, name, start, end, outermost, notify=True):
+        ms = (end - start) * 1000.0
+
+        # only whole event handler calls count as frames, nested handler
+        # calls are part of their caller's frame
+        slow = outermost and ms > self.slow_ms
+
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = HandlerStats(name)
+            self.stats[name] = stats
+        stats.record(ms, slow)
+
+        event = (name, start - self._start_time, end - start)
+        self._events.append(event)
+        if slow:
+            self.slow_events.append(event)
+
+        if outermost and notify and self.listener is not None:
+            self.listener(name, ms)
+
+    def report(self):
+        """
+        Returns a text report of the handler statistics & slowest calls.
+        """
+        lines = [
+            "handler latencies (slow: over %.1f ms)" % self.slow_ms
+        ]
+        lines.extend(str(stats) for stats in self.stats.values())
+
+        bounds = ['<=%d' % b for b in HISTOGRAM_BOUNDS_MS]
+        bounds.append('>%d' % HISTOGRAM_BOUNDS_MS[-1])
+        lines.append('')
+        lines.append("%-24s %s" % ('histogram (ms)', ' '.join(
+            '%6s' % b for b in bounds
+        )))
+        for stats in self.stats.values():
+            lines.append("%-24s %s" % (stats.name, ' '.join(
+                '%6d' % count for count in stats.histogram
+            )))
+
+        slowest = sorted(self.slow_events, key=lambda e: -e[2])[:10]
+        if slowest:
+            lines.append('')
+            lines.append("slowest frames")
+            for name, start, seconds in slowest:
+                lines.append(
+                    "%-24s %8.1f ms at %8.3f s" % (
+                        name, seconds * 1000.0, start
+                    )
+                )
+
+        return '\n'.join(lines)
+
+    def write_trace(self, file_path):
+        """
+        Writes the recorded handler calls in the Chrome trace event format.
+        """
+        events = [
+            {
+                'name': name,
+                'ph': 'X',
+                'ts': start * 1e6,
+                'dur': seconds * 1e6,
+                'pid': os.getpid(),
+                'tid': self._thread_id
+            }
+            for name, start, seconds in self._events
+        ]
+
+        with open(file_path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+    def dump(self, base_path):
+        """
+        Writes the report ('.txt'), the trace ('.trace.json') & the
+        cProfile stats ('.prof', if cProfile was used) next to each other.
+
+        Args:
+            base_path: file path without extension
+
+        Returns:
+            List of the written file paths
+        """
+        paths = [base_path + '.txt', base_path + '.trace.json']
+
+        with open(paths[0], 'w') as f:
+            f.write(self.report())
+            f.write('\n')
+
+        self.write_trace(paths[1])
+
+        if self._profile is not None:
+            paths.append(base_path + '.prof')
+            self._profile.dump_stats(paths[-1])
+
+        return paths
+
+
+def profiled(method):
+    """
+    Decorates a method so its calls are measured by the 'profiler'
+    attribute of its object (see Profiler.measure), under the method's
+    name.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = self.profiler
+        if profiler is None or not profiler.enabled:
+            return method(self, *args, **kwargs)
+
+        return profiler.measure(name, method, self, *args, **kwargs)
+
+    return wrapper
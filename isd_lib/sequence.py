@@ -0,0 +1,541 @@
+"""
+Region detection in image sequences (time-lapse stacks, frame directories
+& videos) with state reused from frame to frame.
+
+Consecutive frames of a time-lapse differ very little, so a
+SequenceDetector keeps the prepared target, the last frame's color
+labels & its regions:
+
+- each frame is compared with the pixels the labels were computed from
+  in tiles of TILE_SIZE pixels, and only the tiles where some pixel
+  changed by more than a threshold have their color labels recomputed
+- if no tile changed, the last frame's regions are reused as they are,
+  otherwise regions are found in the updated labels
+- regions keep a 'track' ID across frames (see RegionTracker)
+
+With a change threshold of 0, the regions of every frame are exactly
+those found by detecting it on its own.
+"""
+import os
+
+import cv2
+import numpy as np
+
+TILE_SIZE = 64
+
+# a tile is relabeled if any of its pixel channel values differs by more
+# than this from the frame its labels were computed from
+CHANGE_THRESHOLD = 8
+
+# if more than this fraction of tiles changed, the whole frame is
+# relabeled in one pass, which is faster than tile by tile
+FULL_RELABEL_FRACTION = 0.5
+
+# regions whose bounding rectangles overlap by at least this fraction
+# (intersection over union) in consecutive frames can keep their track
+MIN_OVERLAP = 0.3
+
+IMAGE_EXTENSIONS = (
+    '.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff'
+)
+STACK_EXTENSIONS = ('.tif', '.tiff')
+
+
+def iter_stack_frames(file_path):
+    """
+    Yields the pages of a (multi-page) TIFF file as BGR NumPy arrays
+    (unsigned 8-bit integers). 16-bit pages are converted like
+    loader.read_image converts a single page TIFF.
+
+    OpenCV 3.4 only decodes all pages of a file at once, each page is
+    released once it's converted.
+
+    Raises:
+        IOError: if the file can't be read
+    """
+    from isd_lib import loader
+
+    ok, pages = cv2.imreadmulti(
+        file_path,
+        flags=cv2.IMREAD_ANYDEPTH | cv2.IMREAD_COLOR
+    )
+    if not ok or len(pages) == 0:
+        raise IOError("Could not read image stack: %s" % file_path)
+
+    pages = list(reversed(pages))
+    while pages:
+        yield loader.to_8bit(pages.pop(), rounding=True)
+
+
+def iter_video_frames(file_path):
+    """
+    Yields the frames of a video file as BGR NumPy arrays.
+
+    Raises:
+        IOError: if the file can't be opened
+    """
+    capture = cv2.VideoCapture(file_path)
+    if not capture.isOpened():
+        raise IOError("Could not open video: %s" % file_path)
+
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+
+            yield frame
+    finally:
+        capture.release()
+
+
+def list_frame_files(dir_path):
+    """
+    Returns the image files in a directory, sorted by name.
+    """
+    return [
+        os.path.join(dir_path, file_name)
+        for file_name in sorted(os.listdir(dir_path))
+        if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS
+    ]
+
+
+def iter_frames(source):
+    """
+    Yields the frames of a sequence one at a time, as BGR NumPy arrays
+    (unsigned 8-bit integers).
+
+    Args:
+        source: a directory of frame images (in file name order), a
+            multi-page TIFF stack or a video file
+
+    Raises:
+        IOError: if a frame can't be read
+    """
+    if os.path.isdir(source):
+        from isd_lib import loader
+
+        for file_path in list_frame_files(source):
+            yield loader.read_image(file_path)[0]
+
+    elif os.path.splitext(source)[1].lower() in STACK_EXTENSIONS:
+        for frame in iter_stack_frames(source):
+            yield frame
+
+    else:
+        for frame in iter_video_frames(source):
+            yield frame
+
+
+def get_changed_tiles(diff, tile_size, threshold):
+    """
+    Finds the tiles of an absolute difference image with any pixel
+    channel value above a threshold.
+
+    Args:
+        diff: 3-D NumPy array (unsigned 8-bit integers), e.g. from
+            cv2.absdiff of two frames
+        tile_size: tile width & height in pixels
+        threshold: largest difference of an unchanged tile
+
+    Returns:
+        2-D boolean NumPy array with one entry per tile
+    """
+    height, width = diff.shape[:2]
+    channels = diff.shape[2] if diff.ndim == 3 else 1
+    rows = diff.reshape(height, width * channels)
+
+    # reduce each band of tile rows to its column maxima, then each tile
+    # of the band to its maximum
+    band_max = np.empty(
+        (len(range(0, height, tile_size)), width * channels),
+        dtype=diff.dtype
+    )
+    for i, y in enumerate(range(0, height, tile_size)):
+        np.max(rows[y:y + tile_size], axis=0, out=band_max[i])
+
+    tile_max = np.maximum.reduceat(
+        band_max,
+        np.arange(0, width * channels, tile_size * channels),
+        axis=1
+    )
+
+    return tile_max > threshold
+
+
+def count_tiles(shape, tile_size):
+    """
+    Returns the # of tiles covering an image of the given shape.
+    """
+    rows = (shape[0] + tile_size - 1) // tile_size
+    cols = (shape[1] + tile_size - 1) // tile_size
+
+    return rows * cols
+
+
+def iter_tile_runs(changed, tile_size, shape):
+    """
+    Yields the (x, y, width, height) pixel rectangles of the horizontal
+    runs of changed tiles, so neighbouring tiles are processed together.
+    """
+    height, width = shape[:2]
+
+    for row in range(changed.shape[0]):
+        # run starts & ends are where the padded row changes value
+        edges = np.flatnonzero(
+            np.diff(np.pad(changed[row].view(np.int8), 1))
+        )
+        y = row * tile_size
+        for start, end in zip(edges[::2], edges[1::2]):
+            x = start * tile_size
+            yield (
+                x,
+                y,
+                min(end * tile_size, width) - x,
+                min(tile_size, height - y)
+            )
+
+
+def get_rect_overlaps(rects_a, rects_b):
+    """
+    Computes the intersection over union of every pair of rectangles.
+
+    Args:
+        rects_a: N x 4 NumPy array of (x, y, width, height) rectangles
+        rects_b: M x 4 NumPy array of (x, y, width, height) rectangles
+
+    Returns:
+        N x M NumPy array (floats) of overlaps between 0 & 1
+    """
+    a = rects_a[:, None, :].astype(np.float64)
+    b = rects_b[None, :, :].astype(np.float64)
+
+    overlap_width = np.clip(
+        np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) -
+        np.maximum(a[..., 0], b[..., 0]),
+        0,
+        None
+    )
+    overlap_height = np.clip(
+        np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) -
+        np.maximum(a[..., 1], b[..., 1]),
+        0,
+        None
+    )
+    intersection = overlap_width * overlap_height
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+
+    return intersection / np.maximum(union, 1.0)
+
+
+class RegionTracker(object):
+    """
+    Assigns regions of consecutive frames track IDs, so a region keeps its
+    ID while it moves or changes shape a little.
+
+    Regions found in unchanged parts of a frame come out exactly as in the
+    frame before, so they're matched by their rectangle & area with a
+    dictionary lookup. Only the remaining regions are compared by the
+    overlap of their bounding rectangles, matching the most overlapping
+    pairs first.
+
+    Args:
+        min_overlap: minimum intersection over union of the bounding
+            rectangles of a region in consecutive frames to keep its track
+    """
+
+    # max # of overlaps computed at once, bounding the temporary memory
+    MAX_BLOCK_SIZE = 2 ** 20
+
+    def __init__(self, min_overlap=MIN_OVERLAP):
+        self.min_overlap = min_overlap
+        self.next_track = 0
+
+        # the previous frame's tracks by region key & its rectangles
+        self._tracks = {}
+        self._rects = []
+
+    @staticmethod
+    def _key(region):
+        return tuple(region['rectangle']), float(region['area'])
+
+    def update(self, regions):
+        """
+        Sets the 'track' entry of the regions of the next frame.
+
+        Args:
+            regions: list of region dictionaries (see utils.make_region)
+
+        Returns:
+            The given regions
+        """
+        previous = self._tracks
+        used = set()
+        unmatched = []
+
+        for region in regions:
+            region.pop('track', None)
+
+            track = previous.get(self._key(region))
+            if track is not None and track not in used:
+                region['track'] = track
+                used.add(track)
+            else:
+                unmatched.append(region)
+
+        candidates = [
+            (rect, track) for rect, track in self._rects
+            if track not in used
+        ]
+        if unmatched and candidates:
+            self._match_overlapping(unmatched, candidates, used)
+
+        for region in regions:
+            if 'track' not in region:
+                region['track'] = self.next_track
+                self.next_track += 1
+
+        self._tracks = {self._key(r): r['track'] for r in regions}
+        self._rects = [(r['rectangle'], r['track']) for r in regions]
+
+        return regions
+
+    def _match_overlapping(self, regions, candidates, used):
+        rects = np.array([r['rectangle'] for r in regions])
+        candidate_rects = np.array([rect for rect, track in candidates])
+
+        pairs = []
+        block_size = max(1, self.MAX_BLOCK_SIZE // len(candidates))
+        for start in range(0, len(regions), block_size):
+            overlaps = get_rect_overlaps(
+                rects[start:start + block_size],
+                candidate_rects
+            )
+            rows, cols = np.nonzero(overlaps >= self.min_overlap)
+            pairs.extend(zip(overlaps[rows, cols], rows + start, cols))
+
+        pairs.sort(key=lambda p: -p[0])
+        for overlap, i, j in pairs:
+            track = candidates[j][1]
+            if 'track' in regions[i] or track in used:
+                continue
+
+            regions[i]['track'] = track
+            used.add(track)
+
+
+class SequenceDetector(object):
+    """
+    Finds regions matching a target in the frames of a sequence, reusing
+    the prepared target, the color labels of unchanged tiles & the regions
+    of unchanged frames (see the module description).
+
+    Args:
+        target_img: 3-D NumPy array of pixels in HSV (target image)
+        bg_colors: list of background color names, if None the dominant
+            color of the first frame is used for the whole sequence
+        pre_erode, dilate, min_area, max_area, min_score, use_shape: see
+            utils.find_regions, candidates are scored against the frame
+            itself (not its reused labels)
+        roi: optional analysis region of interest (see utils.get_roi),
+            frames are cropped to its bounding rectangle
+        tile_size: width & height of the change detection tiles in pixels
+        change_threshold: a tile's color labels are only recomputed if
+            any of its pixel channel values changed by more than this
+            since they were computed, 0 recomputes every changed pixel
+        min_overlap: see RegionTracker
+
+    Attributes:
+        target: the prepared target (see utils.prepare_target), once the
+            first frame was processed
+        frames: # of frames processed
+        reused_frames: # of frames whose regions were reused unchanged
+        tiles: # of tiles compared
+        changed_tiles: # of tiles whose color labels were recomputed
+    """
+
+    def __init__(
+            self,
+            target_img,
+            bg_colors=None,
+            pre_erode=0,
+            dilate=2,
+            min_area=0.5,
+            max_area=2.0,
+            min_score=None,
+            use_shape=False,
+            roi=None,
+            tile_size=TILE_SIZE,
+            change_threshold=CHANGE_THRESHOLD,
+            min_overlap=MIN_OVERLAP
+    ):
+        from isd_lib import workspace
+
+        self.target_img = target_img
+        self.bg_colors = bg_colors
+        self.pre_erode = pre_erode
+        self.dilate = dilate
+        self.min_area = min_area
+        self.max_area = max_area
+        self.min_score = min_score
+        self.use_shape = use_shape
+        self.roi = roi
+        self.tile_size = tile_size
+        self.change_threshold = change_threshold
+
+        self.target = None
+        self.tracker = RegionTracker(min_overlap)
+        self.workspace = workspace.Workspace()
+
+        self.frames = 0
+        self.reused_frames = 0
+        self.tiles = 0
+        self.changed_tiles = 0
+
+        # the pixels the color labels were computed from, tile by tile
+        self._reference = None
+        self._labels = None
+        self._regions = []
+
+    def _update_labels(self, frame):
+        """
+        Recomputes the color labels of the changed tiles of a frame.
+
+        Returns:
+            # of changed tiles
+        """
+        from isd_lib import utils
+
+        if self._reference is None or self._reference.shape != frame.shape:
+            self._reference = frame.copy()
+            self._labels = utils.get_rgb_color_labels(frame, order='bgr')
+
+            return count_tiles(frame.shape, self.tile_size)
+
+        diff = cv2.absdiff(
+            frame,
+            self._reference,
+            dst=self.workspace.like('frame_diff', frame)
+        )
+        changed = get_changed_tiles(
+            diff,
+            self.tile_size,
+            self.change_threshold
+        )
+        changed_count = int(np.count_nonzero(changed))
+
+        if changed_count > FULL_RELABEL_FRACTION * changed.size:
+            np.copyto(self._reference, frame)
+            self._labels = utils.get_rgb_color_labels(frame, order='bgr')
+
+            return changed_count
+
+        for x, y, width, height in iter_tile_runs(
+                changed,
+                self.tile_size,
+                frame.shape
+        ):
+            tile = frame[y:y + height, x:x + width]
+
+            self._reference[y:y + height, x:x + width] = tile
+            self._labels[y:y + height, x:x + width] = (
+                utils.get_rgb_color_labels(tile, order='bgr')
+            )
+
+        return changed_count
+
+    def _prepare_target(self, roi):
+        from isd_lib import utils
+
+        colors = self.bg_colors
+        if colors is None:
+            colors = [
+                utils.estimate_dominant_color(
+                    utils.crop_roi(self._labels, roi)[0]
+                )[0]
+            ]
+
+        self.target = utils.prepare_target(
+            self.target_img,
+            colors,
+            self.pre_erode,
+            self.dilate
+        )
+
+    def detect(self, bgr_img):
+        """
+        Finds the regions of the next frame.
+
+        Args:
+            bgr_img: 3-D NumPy array (unsigned 8-bit integers) of pixels
+                in BGR, all frames must have the same size
+
+        Returns:
+            List of region dictionaries (see utils.make_region) in frame
+            coordinates, with a 'track' entry (see RegionTracker)
+        """
+        from isd_lib import utils
+
+        frame, offset, roi_mask = utils.crop_roi(bgr_img, self.roi)
+
+        roi = None
+        if self.roi is not None:
+            roi = utils.offset_roi(self.roi, (-offset[0], -offset[1]))
+
+        changed = self._update_labels(frame)
+
+        self.frames += 1
+        self.tiles += count_tiles(frame.shape, self.tile_size)
+        self.changed_tiles += changed
+
+        if self.target is None:
+            self._prepare_target(roi)
+        elif changed == 0:
+            self.reused_frames += 1
+            return list(self._regions)
+
+        regions = list(
+            utils.iter_target_regions(
+                self._labels,
+                self.target,
+                min_area=self.min_area,
+                max_area=self.max_area,
+                roi=roi,
+                workspace=self.workspace
+            )
+        )
+
+        if self.min_score is not None:
+            ranked = utils.rank_regions(
+                cv2.cvtColor(frame, cv2.COLOR_BGR2HSV),
+                [r['contour'] for r in regions],
+                self.target['image'],
+                self.target['mask'],
+                min_score=self.min_score,
+                use_shape=self.use_shape
+            )
+            regions = [utils.make_region(c) for c, score in ranked]
+
+        regions = [utils.offset_region(r, offset) for r in regions]
+        self._regions = self.tracker.update(regions)
+
+        return list(regions)
+
+    def as_dict(self):
+        return {
+            'frames': self.frames,
+            'reused_frames': self.reused_frames,
+            'tiles': self.tiles,
+            'changed_tiles': self.changed_tiles
+        }
+
+    def __str__(self):
+        changed = 0.0
+        if self.tiles > 0:
+            changed = 100.0 * self.changed_tiles / self.tiles
+
+        return "%d frames  %d reused  %5.1f%% of tiles relabeled" % (
+            self.frames,
+            self.reused_frames,
+            changed
+        )
@@ -0,0 +1,802 @@
+"""
+Local HTTP detection service.
+
+Detection runs in a pool of warm worker processes, which keep NumPy &
+OpenCV loaded and cache prepared targets between requests. Only the
+standard library is used for the HTTP side.
+
+Endpoints (all responses are JSON):
+
+    GET  /health
+        server status, number of workers & pending requests
+
+    POST /targets
+        registers a target region, returns {"target_id": ...}. The body is
+        either JSON {"image": <path>, "rect": [x, y, width, height]}
+        (rect is optional) or raw encoded image bytes of the target
+
+    DELETE /targets/<target_id>
+        unregisters a target & frees its shared memory
+
+    POST /detect
+        finds regions matching a registered target. The body is either
+        JSON {"image": <path>, "target_id": ..., <options>} or raw encoded
+        image bytes with the options given as query parameters. Options
+        are bg_colors (comma separated), erode, dilate, min_area, max_area,
+        min_score, use_shape, contours, and for JSON bodies an optional
+        "export": {"dir": <path>, "format": "numpy"|"tiff"|"both"}
+
+Uploaded image bytes & registered targets are handed to the workers in
+shared memory blocks (see shm), so only small descriptors are pickled.
+
+Requests beyond the number of workers are queued, up to max_pending in
+total. Past that the server responds with 503 & a Retry-After header so
+clients back off instead of piling up work. The slot is taken before an
+upload is read, so a busy server doesn't buffer uploads it will reject.
+
+At most MAX_TARGETS targets taking up to MAX_TARGET_BYTES are kept, the
+least recently used ones are unregistered to make room for new ones.
+"""
+import collections
+import contextlib
+import json
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_MAX_PENDING = 16
+MAX_BODY_BYTES = 1024 ** 3  # 1 GiB
+
+RETRY_AFTER_SECONDS = 1
+
+# limits of the registered targets kept in shared memory
+MAX_TARGETS = 256
+MAX_TARGET_BYTES = 256 * 1024 ** 2  # 256 MiB
+
+# maximum # of prepared targets each worker keeps
+WORKER_TARGET_CACHE_SIZE = 32
+
+# per worker process cache of prepared targets
+_prepared_targets = {}
+
+# per worker process work buffers, reused by every detection
+_workspace = None
+
+# per worker process view of the server's job start flags (see
+# DetectionServer.run)
+_started_jobs = None
+
+
+def _init_worker(started_jobs=None):
+    """
+    Warms up a worker process by importing the detection modules & running
+    a tiny detection, so the first real request doesn't pay for it.
+
+    Args:
+        started_jobs: shared array of flags the worker sets when it starts
+            a job, by the job's 'started_flag' index
+    """
+    global _started_jobs
+    _started_jobs = started_jobs
+
+    import numpy as np
+    from isd_lib import utils
+
+    img = np.zeros((8, 8, 3), dtype=np.uint8)
+    img[2:6, 2:6] = (0, 255, 255)
+    utils.find_regions(img, img, bg_colors=['black'])
+
+
+def _noop(value):
+    return value
+
+
+def decode_image(data):
+    """
+    Decodes encoded image bytes (PNG, TIFF, etc.) to a BGR NumPy array.
+    """
+    import cv2
+    import numpy as np
+    from isd_lib import loader
+
+    bgr_img = cv2.imdecode(
+        np.frombuffer(data, dtype=np.uint8),
+        cv2.IMREAD_ANYDEPTH | cv2.IMREAD_COLOR
+    )
+    if bgr_img is None:
+        raise ValueError("Could not decode image data")
+
+    return loader.to_8bit(bgr_img, loader.is_tiff(data[:4]))
+
+
+def read_image(image_path=None, image_data=None, image_shm=None):
+    """
+    Reads a BGR image from a file path, from encoded image bytes, or from
+    encoded image bytes in shared memory (a shm.SharedArray descriptor).
+    """
+    from isd_lib import loader
+
+    if image_shm is not None:
+        from isd_lib import shm
+
+        with shm.attach(image_shm) as data:
+            return decode_image(data)
+
+    if image_data is not None:
+        return decode_image(image_data)
+
+    try:
+        return loader.read_image(image_path)[0]
+    except IOError as e:
+        raise ValueError(str(e))
+
+
+def _get_prepared_target(target_id, target, bg_colors, erode, dilate):
+    from isd_lib import shm
+    from isd_lib import utils
+
+    key = (target_id, tuple(bg_colors), erode, dilate)
+
+    if key not in _prepared_targets:
+        if len(_prepared_targets) >= WORKER_TARGET_CACHE_SIZE:
+            # drop the oldest entry
+            _prepared_targets.pop(next(iter(_prepared_targets)))
+
+        # the target is only copied out of shared memory when it isn't
+        # cached yet, the cache keeps the copy
+        _prepared_targets[key] = utils.prepare_target(
+            shm.read_array(target),
+            bg_colors,
+            erode,
+            dilate
+        )
+
+    return _prepared_targets[key]
+
+
+def _get_workspace():
+    global _workspace
+
+    if _workspace is None:
+        from isd_lib import workspace
+        _workspace = workspace.Workspace()
+
+    return _workspace
+
+
+def _run_job(job):
+    # lets the server tell jobs that were running when a worker died
+    # apart from jobs still queued
+    _started_jobs[job['started_flag']] = 1
+
+    return run_detection(job)
+
+
+def run_detection(job):
+    """
+    Runs a detection job in a worker process.
+
+    Args:
+        job: dictionary with the image ('image' path, 'image_data'
+            bytes or 'image_shm' descriptor of the bytes in shared memory),
+            the 'target_id' & the shm.SharedArray descriptor of the HSV
+            'target' image, and the detection options
+
+    Returns:
+        Dictionary with the 'regions' found as JSON serializable dicts
+    """
+    import cv2
+    from isd_lib import cli
+    from isd_lib import utils
+
+    bgr_img = read_image(
+        job.get('image'),
+        job.get('image_data'),
+        job.get('image_shm')
+    )
+    hsv_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2HSV)
+
+    bg_colors = job['bg_colors']
+    if bg_colors is None:
+        bg_colors = [utils.estimate_dominant_color(hsv_img)[0]]
+
+    target = _get_prepared_target(
+        job['target_id'],
+        job['target'],
+        bg_colors,
+        job['erode'],
+        job['dilate']
+    )
+
+    regions = list(
+        utils.iter_target_regions(
+            hsv_img,
+            target,
+            min_area=job['min_area'],
+            max_area=job['max_area'],
+            workspace=_get_workspace()
+        )
+    )
+
+    if job['min_score'] is not None:
+        ranked = utils.rank_regions(
+            hsv_img,
+            [r['contour'] for r in regions],
+            target['image'],
+            target['mask'],
+            min_score=job['min_score'],
+            use_shape=job['use_shape']
+        )
+        regions = [utils.make_region(c) for c, score in ranked]
+
+    export_options = job.get('export')
+    if export_options:
+        from isd_lib import export
+
+        if job.get('image') is not None:
+            image_name = os.path.basename(job['image'])
+        else:
+            image_name = export_options.get('name', 'upload.tif')
+
+        export.export_regions(
+            regions,
+            image_name,
+            export_options['dir'],
+            hsv_img,
+            rgb_img=cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB),
+            export_format=export_options.get('format', 'numpy')
+        )
+
+    return {
+        'regions': [
+            cli.region_to_json(r, include_contour=job['contours'])
+            for r in regions
+        ]
+    }
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def parse_options(options):
+    """
+    Parses detection options from a JSON body or query parameters.
+    """
+    from isd_lib import cli
+
+    bg_colors = options.get('bg_colors')
+    if isinstance(bg_colors, str):
+        bg_colors = cli.parse_colors(bg_colors)
+
+    min_score = options.get('min_score')
+    if min_score is not None:
+        min_score = float(min_score)
+
+    return {
+        'bg_colors': bg_colors or None,
+        'erode': int(options.get('erode', 0)),
+        'dilate': int(options.get('dilate', 2)),
+        'min_area': float(options.get('min_area', 0.5)),
+        'max_area': float(options.get('max_area', 2.0)),
+        'min_score': min_score,
+        'use_shape': parse_bool(options.get('use_shape', False)),
+        'contours': parse_bool(options.get('contours', False))
+    }
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class DetectionRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body too large")
+
+        return self.rfile.read(length)
+
+    def read_shared_body(self):
+        """
+        Reads the request body straight into a shared memory block.
+
+        Returns:
+            shm.SharedArray of the body bytes, or None if there's not
+            enough shared memory for it
+        """
+        from isd_lib import shm
+
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body too large")
+
+        try:
+            body = shm.SharedArray((length,))
+        except MemoryError:
+            return None
+
+        view = memoryview(body.array)
+        try:
+            read = 0
+            while read < length:
+                n = self.rfile.readinto(view[read:])
+                if not n:
+                    raise ValueError("Request body is incomplete")
+                read += n
+        except Exception:
+            view.release()
+            body.close()
+            raise
+
+        view.release()
+
+        return body
+
+    def is_json(self):
+        content_type = self.headers.get('Content-Type', '')
+        return content_type.split(';')[0].strip() == 'application/json'
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        self.send_json(200, self.server.status())
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        prefix = '/targets/'
+
+        if not path.startswith(prefix):
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        target_id = path[len(prefix):]
+        if self.server.remove_target(target_id):
+            self.send_json(200, {'target_id': target_id})
+        else:
+            self.send_json(
+                404,
+                {'error': "Unknown target_id: %s" % target_id}
+            )
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        routes = {
+            '/targets': self.post_target,
+            '/detect': self.post_detect
+        }
+
+        if url.path not in routes:
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        query = dict(
+            (k, v[-1]) for k, v in parse_qs(url.query).items()
+        )
+
+        try:
+            status, data = routes[url.path](query)
+        except HTTPError as e:
+            status, data = e.status, {'error': str(e)}
+        except (KeyError, ValueError, IOError) as e:
+            status, data = 400, {'error': str(e)}
+        except Exception as e:
+            status, data = 500, {'error': str(e)}
+
+        headers = None
+        if status == 503:
+            headers = {'Retry-After': str(RETRY_AFTER_SECONDS)}
+
+        self.send_json(status, data, headers)
+
+    def post_target(self, query):
+        import cv2
+
+        body = self.read_body()
+
+        if self.is_json():
+            options = json.loads(body.decode('utf-8'))
+            bgr_img = read_image(image_path=options['image'])
+
+            rect = options.get('rect')
+            if rect is not None:
+                x, y, width, height = [int(v) for v in rect]
+                bgr_img = bgr_img[y:y + height, x:x + width]
+        else:
+            bgr_img = decode_image(body)
+
+        if bgr_img.size == 0:
+            raise ValueError("Target region is empty")
+
+        target_id = self.server.add_target(
+            cv2.cvtColor(bgr_img, cv2.COLOR_BGR2HSV)
+        )
+
+        return 200, {'target_id': target_id}
+
+    def post_detect(self, query):
+        # the slot is taken before the body is read, so uploads beyond
+        # capacity are rejected before they're buffered
+        with self.server.reserve():
+            return self.detect(query)
+
+    def detect(self, query):
+        shared_body = None
+
+        if self.is_json():
+            options = json.loads(self.read_body().decode('utf-8'))
+            job = parse_options(options)
+            job['image'] = options['image']
+            job['export'] = options.get('export')
+        else:
+            options = query
+            job = parse_options(options)
+
+            # fail unknown targets before reading the upload
+            self.server.get_target(options.get('target_id'))
+
+            # uploads are passed to the worker in shared memory, falling
+            # back to pickling the bytes when there isn't enough of it
+            shared_body = self.read_shared_body()
+            if shared_body is None:
+                job['image_data'] = self.read_body()
+            else:
+                job['image_shm'] = shared_body.descriptor
+
+        # the block is unlinked after the job, even if the worker crashed
+        try:
+            target_id = options.get('target_id')
+            job['target_id'] = target_id
+
+            with self.server.use_target(target_id) as target:
+                job['target'] = target
+
+                return 200, self.server.run(job)
+        finally:
+            if shared_body is not None:
+                shared_body.close()
+
+
+class DetectionServer(ThreadingHTTPServer):
+    """
+    HTTP server handing detection jobs to a pool of warm worker processes.
+
+    Args:
+        address: (host, port) to listen on, port 0 picks a free port
+        workers: # of worker processes, i.e. concurrent detections
+        max_pending: maximum # of requests queued or running at once
+        verbose: log each request to stderr
+    """
+    daemon_threads = True
+
+    def __init__(
+            self,
+            address=(DEFAULT_HOST, DEFAULT_PORT),
+            workers=None,
+            max_pending=DEFAULT_MAX_PENDING,
+            verbose=False
+    ):
+        ThreadingHTTPServer.__init__(self, address, DetectionRequestHandler)
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        self.workers = workers
+        self.max_pending = max(max_pending, workers)
+        self.verbose = verbose
+
+        # blocks of servers that were killed before they could clean up
+        from isd_lib import shm
+        shm.remove_stale_blocks()
+
+        # one flag per job that can run at once, set by the worker when
+        # the job starts (see run). Spawned workers get the array when
+        # they're started, as an initializer argument.
+        self._started_jobs = multiprocessing.get_context('spawn').RawArray(
+            'b',
+            self.max_pending
+        )
+        self._free_flags = list(range(self.max_pending))
+
+        self.executor = self._create_executor()
+
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        # held while the worker pool is replaced, so only one request
+        # replaces a broken pool & the others wait for the new one
+        self._executor_lock = threading.Lock()
+        self._pending = 0
+        # registered targets in least recently used order, each entry is
+        # [shm.SharedArray, # of jobs using it, unregistered flag]
+        self._targets = collections.OrderedDict()
+        self._target_bytes = 0
+
+        # # of times the worker pool was replaced after a worker died
+        self.restarts = 0
+
+    def _create_executor(self):
+        # spawned workers don't inherit the server's threads or locks
+        executor = futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self._started_jobs,)
+        )
+
+        # start the workers now rather than on the first request, each one
+        # runs the warm up initializer as soon as it is spawned
+        list(
+            executor.map(_noop, range(self.workers))
+        )
+
+        return executor
+
+    def _replace_broken_executor(self, executor):
+        """
+        Replaces the worker pool after one of its processes died (e.g.
+        killed for running out of memory), which leaves a
+        ProcessPoolExecutor unusable. Requests that saw the same broken
+        pool only replace it once.
+        """
+        with self._executor_lock:
+            if self.executor is not executor:
+                return
+
+            executor.shutdown(wait=False)
+            self.executor = self._create_executor()
+
+            with self._lock:
+                self.restarts += 1
+
+    def _run(self, job):
+        executor = self.executor
+        try:
+            return executor.submit(_run_job, job).result()
+        except BrokenProcessPool:
+            self._replace_broken_executor(executor)
+            raise
+
+    def status(self):
+        with self._lock:
+            pending = self._pending
+
+        return {
+            'status': 'ok',
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'pending': pending,
+            'restarts': self.restarts,
+            'targets': len(self._targets),
+            'target_bytes': self._target_bytes
+        }
+
+    def add_target(self, target_img):
+        """
+        Registers an HSV target image, which is kept in shared memory for
+        the workers until it's removed, evicted to make room for newer
+        targets (see MAX_TARGETS & MAX_TARGET_BYTES) or the server is
+        closed.
+
+        Returns:
+            ID of the target
+        """
+        from isd_lib import shm
+
+        target_id = uuid.uuid4().hex
+        shared = shm.SharedArray.copy_of(target_img)
+
+        with self._lock:
+            self._targets[target_id] = [shared, 0, False]
+            self._target_bytes += shared.nbytes
+
+            while len(self._targets) > 1 and (
+                    len(self._targets) > MAX_TARGETS or
+                    self._target_bytes > MAX_TARGET_BYTES
+            ):
+                oldest_id = next(iter(self._targets))
+                self._unregister_target(oldest_id)
+
+        return target_id
+
+    def _unregister_target(self, target_id):
+        # called with the lock held, the block is unlinked once no job
+        # uses it anymore
+        entry = self._targets.pop(target_id)
+        self._target_bytes -= entry[0].nbytes
+
+        entry[2] = True
+        if entry[1] == 0:
+            entry[0].close()
+
+    def remove_target(self, target_id):
+        """
+        Unregisters a target.
+
+        Returns:
+            True if the target was registered
+        """
+        with self._lock:
+            if target_id not in self._targets:
+                return False
+
+            self._unregister_target(target_id)
+
+        return True
+
+    def get_target(self, target_id):
+        """
+        Returns the shm.SharedArray descriptor of a registered target.
+
+        Raises:
+            HTTPError: with status 404 if the target isn't registered
+        """
+        with self._lock:
+            entry = self._targets.get(target_id)
+
+        if entry is None:
+            raise HTTPError(404, "Unknown target_id: %s" % target_id)
+
+        return entry[0].descriptor
+
+    @contextlib.contextmanager
+    def use_target(self, target_id):
+        """
+        Marks a target as recently used & keeps its shared memory block
+        alive while a job uses it, even if it's unregistered meanwhile.
+
+        Yields:
+            shm.SharedArray descriptor of the target
+
+        Raises:
+            HTTPError: with status 404 if the target isn't registered
+        """
+        with self._lock:
+            entry = self._targets.get(target_id)
+            if entry is None:
+                raise HTTPError(404, "Unknown target_id: %s" % target_id)
+
+            self._targets.move_to_end(target_id)
+            entry[1] += 1
+
+        try:
+            yield entry[0].descriptor
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0 and entry[2]:
+                    entry[0].close()
+
+    @contextlib.contextmanager
+    def reserve(self):
+        """
+        Takes one of the max_pending request slots for the with block.
+
+        Raises:
+            HTTPError: with status 503 if the server is at capacity
+        """
+        if not self._slots.acquire(blocking=False):
+            raise HTTPError(503, "Server busy, retry later")
+
+        with self._lock:
+            self._pending += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+    def run(self, job):
+        """
+        Runs a detection job on the worker pool & waits for its result,
+        the caller holds a request slot (see reserve).
+
+        If a worker process dies, the pool is replaced. A job that was
+        still queued is retried once on the new pool. A job that had
+        started isn't, as it may be the one that killed its worker (e.g.
+        by running out of memory) & would take the new pool down too.
+
+        Raises:
+            HTTPError: with status 503 if the job had started when a
+                worker died, or a worker died again after the retry
+        """
+        with self._lock:
+            flag = self._free_flags.pop()
+
+        job = dict(job, started_flag=flag)
+        try:
+            self._started_jobs[flag] = 0
+            try:
+                return self._run(job)
+            except BrokenProcessPool:
+                if self._started_jobs[flag]:
+                    raise HTTPError(
+                        503,
+                        "Worker process died running the job, retry later"
+                    )
+
+            try:
+                return self._run(job)
+            except BrokenProcessPool:
+                raise HTTPError(503, "Worker process died, retry later")
+        finally:
+            with self._lock:
+                self._free_flags.append(flag)
+
+    def submit(self, job):
+        """
+        Runs a detection job in a request slot (see reserve & run).
+
+        Raises:
+            HTTPError: with status 503 if the server is at capacity
+        """
+        with self.reserve():
+            return self.run(job)
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self.executor.shutdown(wait=True)
+
+        with self._lock:
+            targets = self._targets
+            self._targets = collections.OrderedDict()
+            self._target_bytes = 0
+
+        for entry in targets.values():
+            entry[0].close()
+
+
+def serve(
+        host=DEFAULT_HOST,
+        port=DEFAULT_PORT,
+        workers=None,
+        max_pending=DEFAULT_MAX_PENDING,
+        verbose=True
+):
+    """
+    Runs the detection server until interrupted.
+    """
+    server = DetectionServer(
+        (host, port),
+        workers=workers,
+        max_pending=max_pending,
+        verbose=verbose
+    )
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,113 @@
+"""
+Saving & loading detection sessions.
+
+A session file is an uncompressed NumPy .npz archive holding the found
+regions as packed ContourStore arrays, which regions are active (after
+deletes), the HSV target crop & ROI, plus a JSON 'meta' entry with the
+image path & content hash and the detection parameters. Loading it only
+reads a handful of flat arrays, so no detection has to be re-run.
+"""
+import json
+import os
+
+import numpy as np
+
+from isd_lib import contours
+
+SESSION_VERSION = 1
+
+
+def save_session(
+        file_path,
+        image_path,
+        contour_store,
+        active=None,
+        target=None,
+        roi=None,
+        params=None,
+        file_hash=None
+):
+    """
+    Saves a detection session.
+
+    Args:
+        file_path: session file path, '.npz' is appended by NumPy if
+            missing
+        image_path: path of the source image
+        contour_store: contours.ContourStore of the found regions
+        active: optional boolean array of the active regions (see
+            contours.RegionHistory), all regions are active if None
+        target: optional 3-D NumPy array of pixels in HSV (target image)
+        roi: optional analysis region of interest (see utils.get_roi)
+        params: optional dictionary of JSON serializable detection
+            parameters
+        file_hash: optional content hash of the source image (see
+            cache.hash_file), used to detect a changed image on load
+    """
+    if active is None:
+        active = np.ones(len(contour_store), dtype=np.bool_)
+
+    meta = {
+        'version': SESSION_VERSION,
+        'image_path': os.path.abspath(image_path),
+        'file_hash': file_hash,
+        'params': params or {}
+    }
+
+    arrays = contour_store.pack(delta=True)
+    arrays['active'] = np.asarray(active, dtype=np.bool_)
+    arrays['meta'] = np.array(json.dumps(meta))
+
+    if target is not None:
+        arrays['target'] = target
+    if roi is not None:
+        arrays['roi'] = np.asarray(roi)
+
+    # the arrays are small & already compact, compression would only
+    # slow down loading
+    np.savez(file_path, **arrays)
+
+
+def load_session(file_path):
+    """
+    Loads a detection session saved by save_session.
+
+    Returns:
+        Dictionary with the 'image_path', 'file_hash', 'params',
+        'contour_store' (contours.ContourStore), 'active' boolean array,
+        and the 'target' & 'roi' (None if not saved)
+
+    Raises:
+        ValueError: if the file isn't a supported session file
+    """
+    with np.load(file_path) as data:
+        if 'meta' not in data:
+            raise ValueError("Not a session file: %s" % file_path)
+
+        meta = json.loads(str(data['meta']))
+        if meta.get('version') != SESSION_VERSION:
+            raise ValueError(
+                "Unsupported session version: %s" % meta.get('version')
+            )
+
+        session = {
+            'image_path': meta['image_path'],
+            'file_hash': meta.get('file_hash'),
+            'params': meta.get('params', {}),
+            'contour_store': contours.ContourStore.unpack(data),
+            'active': data['active'],
+            'target': data['target'] if 'target' in data else None,
+            'roi': data['roi'] if 'roi' in data else None
+        }
+
+    return session
+
+
+def iter_active_regions(session):
+    """
+    Yields region dictionaries (see utils.make_region) for the active
+    regions of a loaded session.
+    """
+    return session['contour_store'].iter_regions(
+        np.flatnonzero(session['active'])
+    )
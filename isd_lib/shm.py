@@ -0,0 +1,221 @@
+"""
+Passing NumPy arrays to worker processes through shared memory.
+
+Pickling an image for a worker process copies it twice (into the pickle
+& out of it) and pushes it through a pipe. A SharedArray instead holds
+the array in a multiprocessing.shared_memory block, so only a small
+descriptor (block name, shape & type) is sent & the worker maps the same
+memory with attach.
+
+Lifecycle: the process creating a SharedArray owns its block & unlinks
+it when the SharedArray is closed (or garbage collected). Workers only
+map & unmap it, so a crashed worker leaks nothing: its mapping goes away
+with the process & the owner still unlinks the block. If the owner
+itself dies, multiprocessing's resource tracker unlinks its blocks, and
+remove_stale_blocks removes blocks left over by owners that were killed
+together with their resource tracker.
+"""
+import contextlib
+import errno
+import os
+import uuid
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# shared memory block names start with this & the owner's process ID
+BLOCK_PREFIX = 'isd_'
+
+# directory holding the POSIX shared memory blocks on Linux
+SHM_DIR = '/dev/shm'
+
+
+def _block_name():
+    return '%s%d_%s' % (BLOCK_PREFIX, os.getpid(), uuid.uuid4().hex[:16])
+
+
+def _unlink(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # views of the block are still alive, the mapping is released
+        # when they are
+        pass
+
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def available_bytes():
+    """
+    Returns the free space for shared memory blocks in bytes, or None if
+    unknown.
+
+    On Linux, blocks live in a size limited tmpfs (often only 64 MB in
+    containers) whose space is only taken when written, so a block larger
+    than the free space can be created but crashes the process (SIGBUS)
+    when it's filled.
+    """
+    try:
+        stats = os.statvfs(SHM_DIR)
+    except (AttributeError, OSError):
+        return None
+
+    return stats.f_bavail * stats.f_frsize
+
+
+def can_share(nbytes):
+    """
+    Returns True if a shared memory block of nbytes should fit.
+    """
+    available = available_bytes()
+
+    return available is None or nbytes <= available
+
+
+class SharedArray(object):
+    """
+    A NumPy array in a shared memory block owned by this process.
+
+    Args:
+        shape: shape of the array
+        dtype: NumPy data type of the array
+
+    Attributes:
+        array: the NumPy array, a view into the block
+        descriptor: dictionary to pass to worker processes (see attach)
+
+    Raises:
+        MemoryError: if there's not enough free shared memory
+    """
+
+    def __init__(self, shape, dtype=np.uint8):
+        shape = tuple(int(n) for n in shape)
+        dtype = np.dtype(dtype)
+
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if not can_share(nbytes):
+            raise MemoryError(
+                "Not enough shared memory for %d bytes" % nbytes
+            )
+
+        # blocks can't be empty
+        self._shm = shared_memory.SharedMemory(
+            name=_block_name(),
+            create=True,
+            size=max(nbytes, 1)
+        )
+        self._finalizer = weakref.finalize(self, _unlink, self._shm)
+
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        self.descriptor = {
+            'name': self._shm.name,
+            'shape': shape,
+            'dtype': dtype.str
+        }
+
+    @classmethod
+    def copy_of(cls, arr):
+        """
+        Returns a new SharedArray holding a copy of a NumPy array.
+        """
+        shared = cls(arr.shape, arr.dtype)
+        np.copyto(shared.array, arr)
+
+        return shared
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def close(self):
+        """
+        Unmaps & unlinks the block. Workers still attached keep their
+        mapping until they detach.
+        """
+        self.array = None
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@contextlib.contextmanager
+def attach(descriptor):
+    """
+    Maps a shared array in a worker process.
+
+    The array must not be used after the with block, copy anything that
+    needs to be kept (e.g. in a cache).
+
+    Args:
+        descriptor: SharedArray.descriptor of the owning process
+
+    Yields:
+        NumPy array, a view into the shared memory block
+    """
+    shm = shared_memory.SharedMemory(name=descriptor['name'])
+    try:
+        yield np.ndarray(
+            descriptor['shape'],
+            dtype=np.dtype(descriptor['dtype']),
+            buffer=shm.buf
+        )
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+
+def read_array(descriptor):
+    """
+    Returns a private copy of a shared array.
+    """
+    with attach(descriptor) as arr:
+        return arr.copy()
+
+
+def remove_stale_blocks():
+    """
+    Unlinks shared memory blocks of this library whose owner process no
+    longer exists (POSIX systems with a shared memory directory only).
+
+    Returns:
+        Number of blocks removed
+    """
+    if not os.path.isdir(SHM_DIR):
+        return 0
+
+    removed = 0
+
+    for name in os.listdir(SHM_DIR):
+        if not name.startswith(BLOCK_PREFIX):
+            continue
+
+        try:
+            pid = int(name[len(BLOCK_PREFIX):].split('_')[0])
+        except ValueError:
+            continue
+
+        try:
+            os.kill(pid, 0)
+            continue
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                # the process exists, but belongs to another user
+                continue
+
+        try:
+            os.unlink(os.path.join(SHM_DIR, name))
+            removed += 1
+        except OSError:
+            pass
+
+    return removed
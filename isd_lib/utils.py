@@ -82,6 +82,10 @@ HSV_RANGES = {
     ]
 }
 
+# color names in label order, a color label image stores the index of each
+# pixel's color range in this list
+COLOR_LABELS = list(HSV_RANGES.keys())
+
 
 def find_regions(
         src_img,
@@ -90,13 +94,20 @@ def find_regions(
         pre_erode=0,
         dilate=2,
         min_area=0.5,
-        max_area=2.0
+        max_area=2.0,
+        min_score=None,
+        use_shape=False,
+        roi=None,
+        workspace=None,
+        stats=None
 ):
     """
     Finds regions in source image that are similar to the target image.
 
     Args:
-        src_img: 3-D NumPy array of pixels in HSV (source image)
+        src_img: 3-D NumPy array of pixels in HSV (source image), or if
+            min_score is None a 2-D color label image (see
+            get_color_labels & get_rgb_color_labels)
         target_img: 3-D NumPy array of pixels in HSV (target image)
         bg_colors: list of color names to use for background colors, if
             None the dominant color in the source image will be used
@@ -107,59 +118,493 @@ def find_regions(
             for returning matching sub-regions
         max_area: maximum area cutoff percentage (compared to target image)
             for returning matching sub-regions
+        min_score: if not None, candidate regions are scored against the
+            target signature (see score_regions), those scoring below
+            min_score are dropped & the rest are returned best first
+        use_shape: include shape moments in the score (only used when
+            min_score is not None)
+        roi: optional analysis region of interest, a rectangle
+            (x, y, width, height) or polygon (see get_roi). Only pixels
+            inside it are searched.
+        workspace: optional workspace.Workspace whose buffers are reused
+            for the image sized masks instead of allocating new ones
+        stats: optional dictionary the # of candidates removed by each
+            filter stage are added to (see iter_blobs_by_size), plus the
+            # 'score_filtered' if min_score is given
 
     Returns:
-        Sub-region mask as 2-D NumPy array (unsigned 8-bit integers) with the
-        same width and height as the source image. Matching sub-regions have
-        pixel values of 255 and non-matching pixels are 0.
+        List of OpenCV contours of the matching sub-regions
 
     Raises:
         tbd
     """
 
-    # if no bg colors are specified, determine dominant color range
-    # for the 'background' in the source image
+    # if no bg colors are specified, estimate dominant color range
+    # for the 'background' in the source image from a pixel sample
+    if bg_colors is None:
+        bg_colors = [estimate_dominant_color(crop_roi(src_img, roi)[0])[0]]
+
+    target = prepare_target(target_img, bg_colors, pre_erode, dilate)
+
+    contours = [
+        region['contour'] for region in iter_target_regions(
+            src_img,
+            target,
+            min_area=min_area,
+            max_area=max_area,
+            roi=roi,
+            workspace=workspace,
+            stats=stats
+        )
+    ]
+
+    # optionally rank the candidates by similarity to the target
+    if min_score is not None:
+        ranked = rank_regions(
+            src_img,
+            contours,
+            target_img,
+            target['mask'],
+            min_score=min_score,
+            use_shape=use_shape
+        )
+        if stats is not None:
+            stats['score_filtered'] = (
+                stats.get('score_filtered', 0) + len(contours) - len(ranked)
+            )
+        contours = [c for c, score in ranked]
+
+    # return contours
+    return contours
+
+
+def iter_regions(
+        src_img,
+        target_img,
+        bg_colors=None,
+        pre_erode=0,
+        dilate=2,
+        min_area=0.5,
+        max_area=2.0,
+        roi=None,
+        workspace=None,
+        stats=None
+):
+    """
+    Generator version of find_regions (without scoring), yielding each
+    matching region as soon as it passes the size filter so callers can
+    consume the results with bounded memory.
+
+    Args:
+        see find_regions
+
+    Yields:
+        Region dictionaries (see make_region)
+    """
+    if bg_colors is None:
+        bg_colors = [estimate_dominant_color(crop_roi(src_img, roi)[0])[0]]
+
+    target = prepare_target(target_img, bg_colors, pre_erode, dilate)
+
+    for region in iter_target_regions(
+            src_img,
+            target,
+            min_area=min_area,
+            max_area=max_area,
+            roi=roi,
+            workspace=workspace,
+            stats=stats
+    ):
+        yield region
+
+
+def find_regions_multi(
+        src_img,
+        targets,
+        bg_colors=None,
+        pre_erode=0,
+        dilate=2,
+        roi=None,
+        workspace=None
+):
+    """
+    Finds regions in source image similar to any of several target images
+    in a single pass over the source image.
+
+    The source color label image is computed once, and the masks,
+    morphology & contours are computed once per distinct set of feature
+    colors, then shared by all targets with that set of colors.
+
+    Args:
+        src_img: 3-D NumPy array of pixels in HSV (source image), or a
+            2-D color label image (see get_color_labels)
+        targets: list of target dictionaries, each with an 'image' entry
+            (3-D NumPy array of pixels in HSV) and optional 'min_area' &
+            'max_area' entries (defaults 0.5 & 2.0, see find_regions)
+        bg_colors: list of color names to use for background colors, if
+            None the dominant color in the source image will be used
+        pre_erode: # of erosion iterations performed on masked images
+        dilate: # of dilation iterations performed on masked images
+        roi: optional analysis region of interest (see get_roi)
+        workspace: optional workspace.Workspace for the image sized buffers
+
+    Returns:
+        List with a list of region dictionaries (see make_region) for each
+        target, in the same order as targets. Each region dictionary also
+        has a 'target' entry with the index of its target.
+    """
+    src_img, offset, roi_mask = crop_roi(src_img, roi)
+
     if bg_colors is None:
-        bg_colors = [find_dominant_color(src_img)]
+        bg_colors = [estimate_dominant_color(src_img)[0]]
+
+    prepared = [
+        prepare_target(t['image'], bg_colors, pre_erode, dilate)
+        for t in targets
+    ]
+
+    if src_img.ndim == 2:
+        labels = src_img
+    else:
+        labels = get_color_labels(src_img, workspace)
+    blobs_by_colors = {}
+
+    results = []
+
+    for i, (target, target_opts) in enumerate(zip(prepared, targets)):
+        colors = frozenset(target['feature_colors'])
+
+        if colors not in blobs_by_colors:
+            mask = process_mask(
+                create_label_mask(labels, colors, workspace),
+                pre_erode,
+                dilate,
+                roi_mask,
+                workspace
+            )
+
+            blobs_by_colors[colors] = list(
+                iter_blobs_by_size(
+                    mask,
+                    0,
+                    np.inf,
+                    offset=offset,
+                    workspace=workspace
+                )
+            )
+
+        min_pixels = int(target['area'] * target_opts.get('min_area', 0.5))
+        max_pixels = int(target['area'] * target_opts.get('max_area', 2.0))
+
+        regions = []
+        for contour, area in blobs_by_colors[colors]:
+            if min_pixels <= area <= max_pixels:
+                region = make_region(contour, area)
+                region['target'] = i
+                regions.append(region)
 
+        results.append(regions)
+
+    return results
+
+
+def prepare_target(target_img, bg_colors, pre_erode=0, dilate=2):
+    """
+    Computes the source independent state of a target used for finding
+    regions, so it can be reused for multiple source images.
+
+    Args:
+        target_img: 3-D NumPy array of pixels in HSV (target image)
+        bg_colors: list of color names to use for background colors
+        pre_erode: # of erosion iterations performed on masked images
+        dilate: # of dilation iterations performed on masked images
+
+    Returns:
+        Dictionary with the target 'image', its 'feature_colors', the
+        largest blob 'mask' & its 'area' in pixels, and the 'pre_erode'
+        & 'dilate' iterations to apply to source masks
+    """
     # determine # of pixels of each color range found in the target
     target_color_profile = get_color_profile(target_img)
 
     # find common color ranges in target (excluding the bg_colors)
     feature_colors = get_common_colors(target_color_profile, bg_colors)
 
-    # create masks from feature colors
-    mask = create_mask(src_img, feature_colors)
-    target_mask = create_mask(target_img, feature_colors)
+    target_mask = create_feature_mask(
+        target_img,
+        feature_colors,
+        pre_erode,
+        dilate
+    )
+
+    # select largest blob from target mask
+    target_mask = filter_largest_blob(target_mask)
 
-    # define kernel used for erosion & dilation
-    kernel = np.ones((3, 3), np.uint8)
+    return {
+        'image': target_img,
+        'feature_colors': feature_colors,
+        'mask': target_mask,
+        'area': np.sum(target_mask) / 255,
+        'pre_erode': pre_erode,
+        'dilate': dilate
+    }
 
-    # erode masks
-    mask = cv2.erode(mask, kernel, iterations=pre_erode)
-    target_mask = cv2.erode(target_mask, kernel, iterations=pre_erode)
 
-    # dilate masks
-    mask = cv2.dilate(mask, kernel, iterations=dilate)
-    target_mask = cv2.dilate(target_mask, kernel, iterations=dilate)
+def iter_target_regions(
+        src_img,
+        target,
+        min_area=0.5,
+        max_area=2.0,
+        roi=None,
+        workspace=None,
+        stats=None
+):
+    """
+    Yields regions in source image matching a prepared target.
 
-    # fill holes in mask using contours
-    mask = fill_holes(mask)
-    target_mask = fill_holes(target_mask)
+    Args:
+        src_img: 3-D NumPy array of pixels in HSV (source image), or a
+            2-D color label image (see get_color_labels)
+        target: target dictionary from prepare_target
+        min_area: minimum area cutoff percentage (compared to target area)
+        max_area: maximum area cutoff percentage (compared to target area)
+        roi: optional analysis region of interest (see get_roi), only the
+            pixels inside it are processed
+        workspace: optional workspace.Workspace for the image sized buffers
+        stats: optional dictionary the candidate counts of each filter
+            stage are added to (see iter_blobs_by_size)
 
-    # select largest blob from target mask
-    target_mask = filter_largest_blob(target_mask)
+    Yields:
+        Region dictionaries (see make_region), in source image coordinates
+    """
+    src_img, offset, roi_mask = crop_roi(src_img, roi)
 
-    # determine target mask area
-    feature_area = np.sum(target_mask) / 255
+    mask = create_feature_mask(
+        src_img,
+        target['feature_colors'],
+        target['pre_erode'],
+        target['dilate'],
+        roi_mask=roi_mask,
+        workspace=workspace
+    )
 
     # remove contours below min_area and above max_area
-    min_pixels = int(feature_area * min_area)
-    max_pixels = int(feature_area * max_area)
-    contours = filter_blobs_by_size(mask, min_pixels, max_pixels)
+    min_pixels = int(target['area'] * min_area)
+    max_pixels = int(target['area'] * max_area)
 
-    # return contours
-    return contours
+    # the feature mask's holes are filled
+    for contour, area in iter_blobs_by_size(
+            mask,
+            min_pixels,
+            max_pixels,
+            offset=offset,
+            workspace=workspace,
+            filled=True,
+            stats=stats
+    ):
+        yield make_region(contour, area)
+
+
+def make_region(contour, area=None):
+    """
+    Creates a region dictionary with the 'contour', its bounding
+    'rectangle' (x, y, width, height) & its 'area'.
+    """
+    if area is None:
+        area = cv2.contourArea(contour)
+
+    return {
+        'contour': contour,
+        'rectangle': cv2.boundingRect(contour),
+        'area': area
+    }
+
+
+def offset_region(region, offset):
+    """
+    Returns a copy of a region dictionary moved by an (x, y) offset, e.g.
+    to map regions found in a cropped image back to the full image.
+    """
+    x, y, width, height = region['rectangle']
+
+    moved = dict(region)
+    moved['contour'] = region['contour'] + np.array(offset, dtype=np.int32)
+    moved['rectangle'] = (x + offset[0], y + offset[1], width, height)
+
+    return moved
+
+
+def get_roi(roi, shape):
+    """
+    Resolves an analysis region of interest for an image.
+
+    Args:
+        roi: rectangle as (x, y, width, height), or polygon as an (N, 2)
+            array-like of (x, y) vertices
+        shape: shape of the image
+
+    Returns:
+        Tuple of the ROI's bounding rectangle (x, y, width, height),
+        clipped to the image, and for polygons a 2-D NumPy array (unsigned
+        8-bit integers) the size of the rectangle which is 255 inside the
+        polygon & 0 outside. For rectangles the mask is None.
+    """
+    roi = np.asarray(roi)
+    height, width = shape[:2]
+
+    if roi.ndim == 1 and len(roi) == 4:
+        polygon = None
+        x, y, w, h = [int(v) for v in roi]
+    else:
+        polygon = roi.reshape(-1, 2).astype(np.int32)
+        x, y, w, h = cv2.boundingRect(polygon)
+
+    x1 = min(max(x, 0), width)
+    y1 = min(max(y, 0), height)
+    x2 = min(max(x + w, 0), width)
+    y2 = min(max(y + h, 0), height)
+
+    roi_mask = None
+    if polygon is not None:
+        roi_mask = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+        cv2.fillPoly(roi_mask, [polygon], 255, offset=(-x1, -y1))
+
+    return (x1, y1, x2 - x1, y2 - y1), roi_mask
+
+
+def offset_roi(roi, offset):
+    """
+    Returns an ROI (see get_roi) moved by an (x, y) offset.
+    """
+    roi = np.asarray(roi)
+
+    if roi.ndim == 1 and len(roi) == 4:
+        x, y, width, height = [int(v) for v in roi]
+        return (x + offset[0], y + offset[1], width, height)
+
+    return roi.reshape(-1, 2) + np.array(offset, dtype=roi.dtype)
+
+
+def load_roi(file_path):
+    """
+    Loads an ROI from a file, either a NumPy .npy file or a JSON file
+    holding a rectangle [x, y, width, height] or a list of [x, y]
+    polygon vertices.
+    """
+    if file_path.lower().endswith('.npy'):
+        roi = np.load(file_path)
+    else:
+        import json
+
+        with open(file_path) as roi_file:
+            roi = np.array(json.load(roi_file))
+
+    if not (roi.shape == (4,) or (roi.ndim == 2 and roi.shape[1] == 2)):
+        raise ValueError("Invalid ROI in file: %s" % file_path)
+
+    return roi
+
+
+def crop_roi(img, roi):
+    """
+    Crops an image to a region of interest's bounding rectangle.
+
+    Returns:
+        Tuple of the cropped image (a view, no pixels are copied), the
+        (x, y) offset of the crop and the ROI polygon mask (see get_roi).
+        If roi is None the image is returned as is.
+    """
+    if roi is None:
+        return img, (0, 0), None
+
+    (x, y, width, height), roi_mask = get_roi(roi, img.shape)
+
+    return img[y:y + height, x:x + width], (x, y), roi_mask
+
+
+def create_feature_mask(
+        hsv_img,
+        feature_colors,
+        pre_erode=0,
+        dilate=2,
+        roi_mask=None,
+        workspace=None
+):
+    """
+    Creates a binary mask from the feature colors of an HSV image, eroded,
+    dilated & with its holes filled. A 2-D color label image (see
+    get_color_labels) may be given instead of the HSV image.
+    """
+    if hsv_img.ndim == 2:
+        mask = create_label_mask(hsv_img, feature_colors, workspace)
+    else:
+        mask = create_mask(hsv_img, feature_colors, workspace)
+
+    return process_mask(mask, pre_erode, dilate, roi_mask, workspace)
+
+
+def process_mask(
+        mask,
+        pre_erode=0,
+        dilate=2,
+        roi_mask=None,
+        workspace=None
+):
+    """
+    Erodes, dilates & fills holes in a binary color mask. If an ROI mask
+    is given, the result is limited to the pixels inside it.
+    """
+    if roi_mask is not None:
+        mask = cv2.bitwise_and(
+            mask,
+            roi_mask,
+            dst=get_mask_buffer(workspace, mask.shape, avoid=mask)
+        )
+
+    mask = erode_mask(mask, pre_erode, workspace)
+    mask = dilate_mask(mask, dilate, workspace)
+
+    # dilation can grow blobs past the ROI boundary
+    if roi_mask is not None:
+        mask = cv2.bitwise_and(
+            mask,
+            roi_mask,
+            dst=get_mask_buffer(workspace, mask.shape, avoid=mask)
+        )
+
+    # fill holes in mask using contours
+    return fill_holes(mask, workspace)
+
+
+# the mask processing steps alternate between these workspace buffers
+MASK_BUFFERS = ('mask_a', 'mask_b')
+
+
+def get_buffer(workspace, name, shape, dtype=np.uint8):
+    """
+    Returns a named work buffer from a workspace (see
+    workspace.Workspace.get), or a new array if workspace is None.
+    """
+    if workspace is None:
+        return np.empty(shape, dtype=dtype)
+
+    return workspace.get(name, shape, dtype)
+
+
+def get_mask_buffer(workspace, shape, avoid=None):
+    """
+    Returns a 2-D unsigned 8-bit work buffer for a mask processing step,
+    which doesn't overlap the step's input (avoid). Successive steps take
+    turns between two buffers, so a whole chain of steps only needs two
+    image sized masks.
+    """
+    if workspace is None:
+        return np.empty(shape, dtype=np.uint8)
+
+    for name in MASK_BUFFERS:
+        buf = workspace.get(name, shape)
+        if avoid is None or not np.may_share_memory(buf, avoid):
+            return buf
 
 
 def find_dominant_color(hsv_img):
@@ -181,6 +626,92 @@ def find_dominant_color(hsv_img):
     return dominant_color
 
 
+# default number of pixels sampled when estimating the dominant color
+DEFAULT_SAMPLE_SIZE = 65536
+
+
+def sample_pixels(img, sample_size=DEFAULT_SAMPLE_SIZE):
+    """
+    Returns a strided sample of roughly sample_size pixels from an image.
+
+    The sample is taken on a regular grid so it is a view into the given
+    array and no pixel data is copied or converted.
+
+    Args:
+        img: 3-D NumPy array of pixels (any color space)
+        sample_size: approximate maximum number of pixels to sample
+
+    Returns:
+        3-D NumPy array of the sampled pixels
+    """
+    height, width = img.shape[:2]
+    total = height * width
+
+    if sample_size is None or total <= sample_size:
+        return img
+
+    # rows & columns of a grid with the image's aspect ratio & at most
+    # sample_size points, an image too thin for that gets all its rows or
+    # columns & the rest of the sample along its length
+    rows = int(np.sqrt(float(sample_size) * height / width))
+    rows = min(max(rows, 1), height, sample_size)
+    cols = min(max(sample_size // rows, 1), width)
+
+    row_step = -(-height // rows)
+    col_step = -(-width // cols)
+
+    # offset the grid by half a step so it is centered within the image
+    y = min(row_step // 2, height - 1)
+    x = min(col_step // 2, width - 1)
+
+    return img[y::row_step, x::col_step]
+
+
+def estimate_dominant_color(
+        hsv_img,
+        sample_size=DEFAULT_SAMPLE_SIZE,
+        z_score=1.96
+):
+    """
+    Estimates dominant color in given HSV image array from a pixel sample
+
+    Args:
+        hsv_img: HSV pixel data (3-D NumPy array), or a 2-D color label
+            image (see get_color_labels)
+        sample_size: approximate number of pixels to sample, if None all
+            pixels are used
+        z_score: z-score of the confidence bound, the default of 1.96 gives
+            a ~95% confidence interval
+
+    Returns:
+        Tuple of the dominant color range (from HSV_RANGES keys), the
+        estimated fraction of pixels in that range, and the margin of the
+        confidence bound around that fraction
+
+    Raises:
+        ValueError: if the image has no pixels
+    """
+    sample = sample_pixels(hsv_img, sample_size)
+    n = sample.shape[0] * sample.shape[1]
+    if n == 0:
+        raise ValueError("Can't estimate the dominant color of no pixels")
+
+    if sample.ndim == 2:
+        color_profile = get_label_color_profile(sample)
+    else:
+        color_profile = get_color_profile(sample)
+    dominant_color = max(color_profile, key=lambda k: color_profile[k])
+
+    fraction = float(color_profile[dominant_color]) / n
+    if sample is hsv_img:
+        # every pixel was counted, there is no sampling error
+        margin = 0.0
+    else:
+        margin = float(z_score * np.sqrt(fraction * (1.0 - fraction) / n))
+
+    return dominant_color, fraction, margin
+
+
 def get_color_profile(hsv_img):
     """
     Finds color profile as pixel counts for color ranges in HSV_RANGES
@@ -222,6 +753,289 @@ def get_color_profile(hsv_img):
     return color_profile
 
 
+def get_color_labels(hsv_img, workspace=None):
+    """
+    Classifies every pixel of an HSV image into one of the HSV_RANGES colors
+
+    Args:
+        hsv_img: HSV pixel data (3-D NumPy array)
+        workspace: optional workspace.Workspace for the image sized buffers
+
+    Returns:
+        2-D NumPy array (unsigned 8-bit integers) of indices into
+        COLOR_LABELS with the same width and height as the HSV image
+    """
+    shape = hsv_img.shape[:2]
+
+    labels = get_buffer(workspace, 'labels', shape)
+    labels.fill(0)
+
+    in_range = get_mask_buffer(workspace, shape)
+    selected = get_mask_buffer(workspace, shape, avoid=in_range)
+    selected = selected.view(np.bool_)
+
+    # the color ranges partition the HSV space, so each pixel is
+    # matched by exactly one range
+    for i, color in enumerate(COLOR_LABELS):
+        for color_range in HSV_RANGES[color]:
+            in_range = cv2.inRange(
+                hsv_img,
+                color_range['lower'],
+                color_range['upper'],
+                dst=in_range
+            )
+            np.greater(in_range, 0, out=selected)
+            np.copyto(labels, i, where=selected)
+
+    return labels
+
+
+# rows of an image converted to color labels at a time by
+# get_rgb_color_labels, bounding its temporary memory
+RGB_LABEL_STRIP_ROWS = 256
+
+# color label of every 24-bit RGB color, built on first use
+_rgb_label_table = None
+
+
+def get_rgb_label_table():
+    """
+    Returns a table of the color label (see get_color_labels) of every
+    24-bit RGB color, indexed by R + (G << 8) + (B << 16).
+
+    The table is built once per process by converting all 2^24 colors to
+    HSV with OpenCV & classifying them with HSV_RANGES, so looking up a
+    color gives exactly the label of the HSV path.
+
+    Returns:
+        1-D NumPy array (unsigned 8-bit integers) of 2^24 labels
+    """
+    global _rgb_label_table
+
+    if _rgb_label_table is None:
+        # every color as one pixel of a 4096 x 4096 image, the low three
+        # bytes of each little endian uint32 are its R, G & B values
+        colors = np.arange(1 << 24, dtype='<u4').view(np.uint8)
+        colors = colors.reshape(4096, 4096, 4)[:, :, :3]
+
+        hsv_img = cv2.cvtColor(
+            np.ascontiguousarray(colors),
+            cv2.COLOR_RGB2HSV
+        )
+        _rgb_label_table = get_color_labels(hsv_img).ravel()
+
+    return _rgb_label_table
+
+
+def get_rgb_color_labels(img, order='rgb', verify=False, workspace=None):
+    """
+    Classifies every pixel of an RGB (or BGR) image into one of the
+    HSV_RANGES colors with a lookup table (see get_rgb_label_table),
+    without creating an HSV image.
+
+    The image is converted in strips of RGB_LABEL_STRIP_ROWS rows, each
+    expanded to 4 bytes per pixel so its pixels can be read as table
+    indices.
+
+    Args:
+        img: 3-D NumPy array (unsigned 8-bit integers) of pixels in RGB
+        order: 'rgb' or 'bgr' channel order of img
+        verify: also classify the image through HSV (see
+            get_color_labels) & raise a ValueError if any label differs
+        workspace: optional workspace.Workspace for the labels buffer
+
+    Returns:
+        2-D NumPy array (unsigned 8-bit integers) of indices into
+        COLOR_LABELS, identical to get_color_labels of the HSV image
+    """
+    if order == 'rgb':
+        to_rgba, to_hsv = cv2.COLOR_RGB2RGBA, cv2.COLOR_RGB2HSV
+    elif order == 'bgr':
+        to_rgba, to_hsv = cv2.COLOR_BGR2RGBA, cv2.COLOR_BGR2HSV
+    else:
+        raise ValueError("Unknown channel order: %s" % order)
+
+    table = get_rgb_label_table()
+    height, width = img.shape[:2]
+
+    labels = get_buffer(workspace, 'labels', (height, width))
+
+    for y in range(0, height, RGB_LABEL_STRIP_ROWS):
+        rgba = cv2.cvtColor(img[y:y + RGB_LABEL_STRIP_ROWS], to_rgba)
+
+        # drop the alpha byte, leaving R + (G << 8) + (B << 16)
+        indices = rgba.view('<u4')[:, :, 0]
+        np.bitwise_and(indices, 0xFFFFFF, out=indices)
+
+        np.take(table, indices, out=labels[y:y + RGB_LABEL_STRIP_ROWS])
+
+    if verify:
+        expected = get_color_labels(cv2.cvtColor(img, to_hsv))
+        mismatches = np.count_nonzero(labels != expected)
+
+        if mismatches > 0:
+            raise ValueError(
+                "%d pixels differ from the HSV color labels" % mismatches
+            )
+
+    return labels
+
+
+def create_label_mask(labels, colors, workspace=None):
+    """
+    Creates a binary mask from a color label image using given colors,
+    identical to create_mask on the HSV image the labels came from.
+    """
+    lut = np.zeros(256, dtype=np.uint8)
+    for color in colors:
+        lut[COLOR_LABELS.index(color)] = 255
+
+    return cv2.LUT(
+        labels,
+        lut,
+        dst=get_mask_buffer(workspace, labels.shape)
+    )
+
+
+def get_label_color_profile(labels):
+    """
+    Finds color profile as pixel counts from a color label image
+    """
+    counts = np.bincount(labels.ravel(), minlength=len(COLOR_LABELS))
+
+    return {color: counts[i] for i, color in enumerate(COLOR_LABELS)}
+
+
+# side of the square tiles counted by get_label_integrals, a rectangle's
+# partial tiles along its edges are counted from the color labels
+LABEL_TILE_SIZE = 64
+
+
+def get_label_integrals(labels, tile_size=LABEL_TILE_SIZE):
+    """
+    Computes a summed-area table (integral image) for each color label over
+    the counts of square tiles of the label image, so the color counts of
+    any rectangle can be looked up without counting all of its pixels (see
+    get_rect_color_profile).
+
+    The table has one entry per tile instead of one per pixel, so it stays
+    small for very large images. It's built one band of tiles at a time,
+    bounding the temporary memory.
+
+    Args:
+        labels: 2-D NumPy array of color label indices (see
+            get_color_labels)
+        tile_size: side of the tiles in pixels
+
+    Returns:
+        3-D NumPy array (signed 64-bit integers) of shape
+        (# of tile rows + 1, # of tile columns + 1, # of COLOR_LABELS),
+        where [ty, tx, i] is the # of pixels with label i above & to the
+        left of pixel (tx * tile_size, ty * tile_size). The counts of all
+        colors at a corner are next to each other in memory.
+    """
+    n_colors = len(COLOR_LABELS)
+    height, width = labels.shape[:2]
+    n_rows = -(-height // tile_size)
+    n_cols = -(-width // tile_size)
+
+    # bin of each pixel's color in a band, per tile column
+    col_bins = np.repeat(
+        np.arange(n_cols, dtype=np.intp) * n_colors,
+        tile_size
+    )[:width]
+
+    integrals = np.zeros((n_rows + 1, n_cols + 1, n_colors), dtype=np.int64)
+
+    for ty in range(n_rows):
+        band = labels[ty * tile_size:(ty + 1) * tile_size]
+        counts = np.bincount(
+            (band + col_bins).ravel(),
+            minlength=n_cols * n_colors
+        )
+        np.cumsum(
+            counts.reshape(n_cols, n_colors),
+            axis=0,
+            out=integrals[ty + 1, 1:]
+        )
+        integrals[ty + 1] += integrals[ty]
+
+    return integrals
+
+
+def get_rect_color_profile(
+        labels,
+        integrals,
+        rect,
+        tile_size=LABEL_TILE_SIZE
+):
+    """
+    Finds color profile as pixel counts for a rectangle of a color label
+    image. The whole tiles inside the rectangle are looked up in their
+    summed-area table, only the pixels of the partial tiles along its
+    edges are counted, so the time grows with the rectangle's perimeter
+    rather than its area.
+
+    Args:
+        labels: 2-D NumPy array of color label indices (see
+            get_color_labels)
+        integrals: summed-area table of labels from get_label_integrals
+        rect: rectangle as (x, y, width, height), clipped to the image
+        tile_size: tile size integrals was computed with
+
+    Returns:
+        Dictionary of pixel counts by color name
+    """
+    n_colors = len(COLOR_LABELS)
+    height, width = labels.shape[:2]
+
+    x, y, w, h = rect
+    x1 = min(max(x, 0), width)
+    y1 = min(max(y, 0), height)
+    x2 = min(max(x + w, x1), width)
+    y2 = min(max(y + h, y1), height)
+
+    # whole tiles inside the rectangle
+    tx1 = -(-x1 // tile_size)
+    ty1 = -(-y1 // tile_size)
+    tx2 = x2 // tile_size
+    ty2 = y2 // tile_size
+
+    # the image's last tiles may be partial, they're whole if they end at
+    # the image's edge
+    if x2 == width:
+        tx2 = integrals.shape[1] - 1
+    if y2 == height:
+        ty2 = integrals.shape[0] - 1
+
+    if tx1 >= tx2 or ty1 >= ty2:
+        strips = [labels[y1:y2, x1:x2]]
+        counts = np.zeros(n_colors, dtype=np.int64)
+    else:
+        ix1 = tx1 * tile_size
+        iy1 = ty1 * tile_size
+        ix2 = min(tx2 * tile_size, width)
+        iy2 = min(ty2 * tile_size, height)
+        strips = [
+            labels[y1:iy1, x1:x2],
+            labels[iy2:y2, x1:x2],
+            labels[iy1:iy2, x1:ix1],
+            labels[iy1:iy2, ix2:x2]
+        ]
+        counts = (
+            integrals[ty2, tx2] -
+            integrals[ty1, tx2] -
+            integrals[ty2, tx1] +
+            integrals[ty1, tx1]
+        )
+
+    for strip in strips:
+        if strip.size > 0:
+            counts = counts + np.bincount(strip.ravel(), minlength=n_colors)
+
+    return {color: int(counts[i]) for i, color in enumerate(COLOR_LABELS)}
+
+
 def get_hsv(hsv_img):
     """
     Returns flattened hue, saturation, and values from given HSV image.
@@ -252,28 +1066,130 @@ def get_common_colors(color_profile, bg_colors, prevalence=0.1):
     return common_colors
 
 
-def create_mask(hsv_img, colors):
+def create_mask(hsv_img, colors, workspace=None):
     """
     Creates a binary mask from HSV image using given colors.
     """
-    mask = np.zeros((hsv_img.shape[0], hsv_img.shape[1]), dtype=np.uint8)
+    shape = hsv_img.shape[:2]
 
+    mask = get_mask_buffer(workspace, shape)
+    mask.fill(0)
+
+    in_range = None
     for color in colors:
         for color_range in HSV_RANGES[color]:
-            mask += cv2.inRange(
+            if in_range is None:
+                in_range = get_mask_buffer(workspace, shape, avoid=mask)
+
+            in_range = cv2.inRange(
                 hsv_img,
                 color_range['lower'],
-                color_range['upper']
+                color_range['upper'],
+                dst=in_range
             )
+            np.add(mask, in_range, out=mask)
 
     return mask
 
 
-def fill_holes(mask):
+# at or above this # of iterations, erosion & dilation use a distance
+# transform, whose cost doesn't depend on the # of iterations
+MORPH_DISTANCE_THRESHOLD = 128
+
+
+def erode_mask(mask, iterations, workspace=None):
+    """
+    Erodes a binary mask in a single operation, with results identical to
+    the given # of iterations of erosion with a 3x3 kernel.
+
+    N iterations with a 3x3 square kernel equal one erosion with a
+    (2N + 1) square kernel, which OpenCV applies as separable row & column
+    passes. For large N, the chessboard distance to the nearest background
+    pixel is thresholded instead.
+
+    Args:
+        mask: 2-D NumPy array (unsigned 8-bit integers) with values 0 & 255
+        iterations: # of equivalent 3x3 erosion iterations
+        workspace: optional workspace.Workspace for the output buffers
+
+    Returns:
+        Eroded mask, or the given mask itself if iterations is 0
+    """
+    if iterations <= 0:
+        return mask
+
+    eroded = get_mask_buffer(workspace, mask.shape, avoid=mask)
+
+    if iterations < MORPH_DISTANCE_THRESHOLD:
+        size = 2 * iterations + 1
+        return cv2.erode(
+            mask,
+            np.ones((size, size), np.uint8),
+            dst=eroded
+        )
+
+    distance = cv2.distanceTransform(
+        mask,
+        cv2.DIST_C,
+        3,
+        dst=get_buffer(workspace, 'distance', mask.shape, np.float32)
+    )
+
+    return cv2.compare(distance, iterations, cv2.CMP_GT, dst=eroded)
+
+
+def dilate_mask(mask, iterations, workspace=None):
+    """
+    Dilates a binary mask in a single operation, with results identical to
+    the given # of iterations of dilation with a 3x3 kernel.
+
+    See erode_mask, for large N the chessboard distance to the nearest
+    foreground pixel is thresholded.
+
+    Args:
+        mask: 2-D NumPy array (unsigned 8-bit integers) with values 0 & 255
+        iterations: # of equivalent 3x3 dilation iterations
+        workspace: optional workspace.Workspace for the output buffers
+
+    Returns:
+        Dilated mask, or the given mask itself if iterations is 0
+    """
+    if iterations <= 0:
+        return mask
+
+    dilated = get_mask_buffer(workspace, mask.shape, avoid=mask)
+
+    if iterations < MORPH_DISTANCE_THRESHOLD:
+        size = 2 * iterations + 1
+        return cv2.dilate(
+            mask,
+            np.ones((size, size), np.uint8),
+            dst=dilated
+        )
+
+    # the background is written to the output buffer first, it's only
+    # needed until the distance transform has run
+    distance = cv2.distanceTransform(
+        cv2.compare(mask, 0, cv2.CMP_EQ, dst=dilated),
+        cv2.DIST_C,
+        3,
+        dst=get_buffer(workspace, 'distance', mask.shape, np.float32)
+    )
+
+    return cv2.compare(distance, iterations, cv2.CMP_LE, dst=dilated)
+
+
+def fill_holes(mask, workspace=None):
     """
     Fills holes in a given binary mask.
     """
-    ret, thresh = cv2.threshold(mask, 1, 255, cv2.THRESH_BINARY)
+    ret, thresh = cv2.threshold(
+        mask,
+        1,
+        255,
+        cv2.THRESH_BINARY,
+        dst=get_mask_buffer(workspace, mask.shape, avoid=mask)
+    )
     new_mask, contours, hierarchy = cv2.findContours(
         thresh,
         cv2.RETR_CCOMP,
@@ -313,22 +1229,466 @@ def filter_largest_blob(mask):
     return new_mask
 
 
-def filter_blobs_by_size(mask, min_pixels, max_pixels):
+def filter_blobs_by_size(mask, min_pixels, max_pixels, stats=None):
     """
     Filters a given binary mask keeping blobs within a min & max size
     """
-    ret, thresh = cv2.threshold(mask, 1, 255, cv2.THRESH_BINARY)
+    return [
+        c for c, c_area in iter_blobs_by_size(
+            mask,
+            min_pixels,
+            max_pixels,
+            stats=stats
+        )
+    ]
+
+
+# every n-th mask row is sampled to estimate the # of tiny blobs
+TINY_BLOB_SAMPLE_STEP = 16
+
+# tiny blobs per mask pixel from which removing too small blobs before
+# tracing contours (see remove_small_blobs) is faster than tracing them
+PREFILTER_MIN_DENSITY = 1.0 / 1000
+
+
+def count_tiny_blobs(mask, step=TINY_BLOB_SAMPLE_STEP):
+    """
+    Estimates the # of blobs of up to 4 pixels (e.g. noise speckles) in a
+    binary mask from a sample of its rows, in a fraction of the time of
+    labeling the whole mask.
+    """
+    sample = np.ascontiguousarray(mask[::step])
+    n, labels, cc_stats, centroids = (
+        cv2.connectedComponentsWithStatsWithAlgorithm(
+            sample,
+            8,
+            cv2.CV_32S,
+            cv2.CCL_GRANA
+        )
+    )
+
+    return int(np.count_nonzero(cc_stats[1:, cv2.CC_STAT_AREA] <= 4)) * step
+
+
+def remove_small_blobs(mask, min_pixels, filled=False, workspace=None):
+    """
+    Removes the blobs from a binary mask whose contours are certainly
+    smaller than min_pixels, in place, with one connected components pass.
+
+    A contour runs through the centers of its blob's border pixels, so its
+    area is at most (width - 1) * (height - 1) of the blob's bounding box,
+    and less than the blob's pixel count if the blob has no holes. There's
+    no such bound for blobs that are too large (a thin blob has many
+    pixels but hardly any area), so those can't be removed here.
+
+    The contours of the remaining blobs are unchanged, as blobs don't
+    touch each other.
+
+    Args:
+        mask: 2-D NumPy array (unsigned 8-bit integers) with 0 & 255
+        min_pixels: minimum contour area
+        filled: True if the mask has no holes (see fill_holes), allowing
+            the tighter pixel count bound
+        workspace: optional workspace.Workspace for the label image
+
+    Returns:
+        Tuple of the # of blobs & the # of blobs removed
+    """
+    components, labels, cc_stats, centroids = (
+        cv2.connectedComponentsWithStatsWithAlgorithm(
+            mask,
+            8,
+            cv2.CV_32S,
+            cv2.CCL_GRANA,
+            labels=get_buffer(workspace, 'blob_labels', mask.shape, np.int32)
+        )
+    )
+
+    max_area = (
+        (cc_stats[:, cv2.CC_STAT_WIDTH] - 1) *
+        (cc_stats[:, cv2.CC_STAT_HEIGHT] - 1)
+    )
+    if filled:
+        max_area = np.minimum(max_area, cc_stats[:, cv2.CC_STAT_AREA])
+
+    # label 0 is the background
+    too_small = max_area < min_pixels
+    too_small[0] = True
+    removed = int(np.count_nonzero(too_small)) - 1
+
+    if removed > 0:
+        keep = np.where(too_small, 0, 255).astype(np.uint8)
+        np.take(keep, labels, out=mask, mode='clip')
+
+    return components - 1, removed
+
+
+def iter_blobs_by_size(
+        mask,
+        min_pixels,
+        max_pixels,
+        offset=(0, 0),
+        workspace=None,
+        filled=False,
+        prefilter=None,
+        stats=None
+):
+    """
+    Yields (contour, area) for blobs in a given binary mask within a min &
+    max size. The optional (x, y) offset is added to the contour points.
+
+    In masks with many tiny blobs (noise speckles), blobs that are
+    certainly too small are removed before any contours are traced (see
+    remove_small_blobs), which is exact: the same contours are yielded.
+
+    Args:
+        mask: 2-D NumPy array (unsigned 8-bit integers), non-zero pixels
+            are blob pixels
+        min_pixels: minimum contour area
+        max_pixels: maximum contour area
+        offset: (x, y) offset added to the contour points
+        workspace: optional workspace.Workspace for the image sized buffers
+        filled: True if the mask has no holes (see fill_holes)
+        prefilter: True or False to always or never remove too small blobs
+            before tracing contours, if None they're removed when the mask
+            has enough tiny blobs (see PREFILTER_MIN_DENSITY)
+        stats: optional dictionary, the # of labeled 'components' (0 if
+            not prefiltered), of those 'prefiltered' blobs (removed before
+            tracing), traced 'contours', of those 'area_filtered'
+            (outside the size range by their exact area) & 'kept' are
+            added to its entries
+
+    Yields:
+        Tuples of an OpenCV contour & its area
+    """
+    ret, thresh = cv2.threshold(
+        mask,
+        1,
+        255,
+        cv2.THRESH_BINARY,
+        dst=get_mask_buffer(workspace, mask.shape, avoid=mask)
+    )
+
+    if prefilter is None:
+        prefilter = (
+            min_pixels > 0 and
+            count_tiny_blobs(thresh) >= thresh.size * PREFILTER_MIN_DENSITY
+        )
+
+    components = 0
+    prefiltered = 0
+    if prefilter and min_pixels > 0:
+        components, prefiltered = remove_small_blobs(
+            thresh,
+            min_pixels,
+            filled,
+            workspace
+        )
+
     new_mask, contours, hierarchy = cv2.findContours(
         thresh,
         cv2.RETR_CCOMP,
+        cv2.CHAIN_APPROX_SIMPLE,
+        offset=offset
+    )
+
+    kept = 0
+    area_filtered = 0
+    try:
+        for c in contours:
+            c_area = cv2.contourArea(c)
+            if min_pixels <= c_area <= max_pixels:
+                kept += 1
+                yield c, c_area
+            else:
+                area_filtered += 1
+    finally:
+        if stats is not None:
+            counts = {
+                'components': components,
+                'prefiltered': prefiltered,
+                'contours': len(contours),
+                'area_filtered': area_filtered,
+                'kept': kept
+            }
+            for key, count in counts.items():
+                stats[key] = stats.get(key, 0) + count
+
+
+# number of bins per channel used for HSV histogram signatures
+HIST_BINS = (18, 4, 4)
+
+
+def get_hist_bins(hsv_img, bins=HIST_BINS):
+    """
+    Returns the flat HSV histogram bin index for every pixel in an HSV image
+    (or any array of HSV pixels along its last axis).
+    """
+    h_bins, s_bins, v_bins = bins
+
+    # per channel lookup tables of each value's share of the flat index
+    values = np.arange(256, dtype=np.int32)
+    h_lut = values * h_bins // 181 * (s_bins * v_bins)
+    s_lut = values * s_bins // 256 * v_bins
+    v_lut = values * v_bins // 256
+
+    return (
+        np.take(h_lut, hsv_img[..., 0]) +
+        np.take(s_lut, hsv_img[..., 1]) +
+        np.take(v_lut, hsv_img[..., 2])
+    )
+
+
+def get_hu_moments(moments):
+    """
+    Returns the first two Hu moment invariants from an OpenCV moments dict.
+    """
+    nu20 = moments['nu20']
+    nu02 = moments['nu02']
+    nu11 = moments['nu11']
+
+    # products instead of ** 2, which rounds differently for Python floats
+    # than for NumPy arrays (see get_contour_hu_moments)
+    diff = nu20 - nu02
+
+    return nu20 + nu02, diff * diff + 4 * nu11 * nu11
+
+
+def get_contour_hu_moments(contours):
+    """
+    Returns the first two Hu moment invariants of each contour, the same as
+    get_hu_moments(cv2.moments(c)) for every contour c, but computed from
+    all polygon vertices at once.
+
+    Args:
+        contours: non-empty list of OpenCV contours
+
+    Returns:
+        2-D NumPy array with a row of both invariants per contour
+    """
+    lengths = np.array([len(c) for c in contours])
+    starts = np.cumsum(lengths) - lengths
+
+    # sums over the polygon edges (Green's theorem), from each vertex's
+    # predecessor (the last vertex for the first one), with the same
+    # float64 operations in the same order as cv2.moments, so the results
+    # are identical (reducing a points x sums array along its first axis
+    # adds one point after another, like OpenCV's loop)
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+    prev_idx = np.arange(-1, len(points) - 1)
+    prev_idx[starts] = starts + lengths - 1
+    x, y = points[:, 0], points[:, 1]
+    px, py = points[prev_idx, 0], points[prev_idx, 1]
+
+    dxy = px * y - x * py
+    xii = px + x
+    yii = py + y
+    terms = np.empty((len(points), 6), dtype=np.float64)
+    terms[:, 0] = dxy
+    terms[:, 1] = dxy * xii
+    terms[:, 2] = dxy * yii
+    terms[:, 3] = dxy * (px * xii + x * x)
+    terms[:, 4] = dxy * (px * (yii + py) + x * (yii + y))
+    terms[:, 5] = dxy * (py * yii + y * y)
+    sums = np.add.reduceat(terms, starts, axis=0).T
+
+    # orient all contours counter-clockwise & scale the sums the way
+    # cv2.moments does, to get the same rounding, contours without area
+    # have all moments 0
+    sign = np.where(sums[0] < 0, -1.0, 1.0)
+    sign[np.abs(sums[0]) <= np.finfo(np.float32).eps] = 0
+    m00 = sums[0] * (sign * 0.5)
+    m10 = sums[1] * (sign * (1.0 / 6))
+    m01 = sums[2] * (sign * (1.0 / 6))
+    m20 = sums[3] * (sign * (1.0 / 12))
+    m11 = sums[4] * (sign * (1.0 / 24))
+    m02 = sums[5] * (sign * (1.0 / 12))
+
+    # central moments normalized by m00^2
+    nonzero = np.abs(m00) > np.finfo(np.float64).eps
+    inv_m00 = np.divide(1.0, m00, out=np.zeros_like(m00), where=nonzero)
+    cx, cy = m10 * inv_m00, m01 * inv_m00
+    s2 = inv_m00 * inv_m00
+    nu20 = (m20 - m10 * cx) * s2
+    nu11 = (m11 - m10 * cy) * s2
+    nu02 = (m02 - m01 * cy) * s2
+
+    return np.column_stack(
+        get_hu_moments({'nu20': nu20, 'nu02': nu02, 'nu11': nu11})
+    )
+
+
+def get_region_labels(shape, contours, workspace=None):
+    """
+    Rasterizes regions into a region label image.
+
+    Each contour is filled once into a shared image, so the mask of any
+    region is afterwards a comparison of its bounding rectangle with its
+    label, without rasterizing it again. The contours must not overlap,
+    which holds for the regions found in a single mask (e.g. those of
+    iter_target_regions or of one find_regions_multi target).
+
+    Args:
+        shape: (height, width) of the image the contours are in
+        contours: list of OpenCV contours
+        workspace: optional workspace.Workspace for the label image
+
+    Returns:
+        2-D NumPy array where the pixels of the i-th contour are i + 1 &
+        all other pixels 0, unsigned 16-bit integers if there are fewer
+        than 2^16 contours, else signed 32-bit integers
+    """
+    dtype = np.uint16 if len(contours) < 2 ** 16 else np.int32
+
+    labels = get_buffer(workspace, 'region_labels', shape[:2], dtype)
+    labels.fill(0)
+    for i, c in enumerate(contours):
+        cv2.drawContours(labels, [c], 0, i + 1, -1)
+
+    return labels
+
+
+def get_largest_contour(mask):
+    """
+    Returns the outer contour of the largest blob in a binary mask, or a
+    single point contour if the mask is empty.
+    """
+    ret, thresh = cv2.threshold(mask, 1, 255, cv2.THRESH_BINARY)
+    thresh, contours, hierarchy = cv2.findContours(
+        thresh,
+        cv2.RETR_EXTERNAL,
         cv2.CHAIN_APPROX_SIMPLE
     )
 
-    good_contours = []
+    if len(contours) == 0:
+        return np.zeros((1, 1, 2), dtype=np.int32)
+
+    return max(contours, key=cv2.contourArea)
+
+
+# a target's 2nd Hu invariant is ignored below this fraction of its 1st
+# invariant squared (see score_regions), e.g. for circles & squares
+CIRCULAR_HU_RATIO = 1e-3
 
-    for c in contours:
-        c_area = cv2.contourArea(c)
-        if min_pixels <= c_area <= max_pixels:
-            good_contours.append(c)
 
-    return good_contours
+def score_regions(
+        hsv_img,
+        contours,
+        target_img,
+        target_mask,
+        use_shape=False,
+        bins=HIST_BINS
+):
+    """
+    Scores candidate regions by their similarity to the target signature.
+
+    All candidates are rasterized into a single label image and their HSV
+    histograms are accumulated in one vectorized pass, so apart from one
+    drawContours call per candidate the cost is proportional to the image
+    & candidate pixels and not to the number of candidates.
+
+    Args:
+        hsv_img: 3-D NumPy array of pixels in HSV (source image)
+        contours: list of OpenCV contours of the candidate regions
+        target_img: 3-D NumPy array of pixels in HSV (target image)
+        target_mask: 2-D NumPy array (unsigned 8-bit integers) selecting the
+            target feature pixels, e.g. the largest blob of the target mask
+        use_shape: if True, the histogram score is multiplied by a shape
+            similarity score from the first two Hu moment invariants
+        bins: number of hue, saturation & value histogram bins
+
+    Returns:
+        1-D NumPy array of scores between 0.0 and 1.0, one per contour
+    """
+    count = len(contours)
+    if count == 0:
+        return np.zeros(0, dtype=np.float64)
+
+    n_bins = bins[0] * bins[1] * bins[2]
+
+    # target signature
+    t_bins = get_hist_bins(target_img, bins)[target_mask > 0]
+    t_hist = np.bincount(t_bins, minlength=n_bins).astype(np.float64)
+    t_hist /= max(t_hist.sum(), 1)
+
+    # rasterize candidates into a label image, 0 is reserved for background
+    labels = get_region_labels(hsv_img.shape, contours).ravel()
+    pixel_idx = np.flatnonzero(labels != 0)
+    pixel_labels = labels[pixel_idx].astype(np.intp) - 1
+    pixel_bins = get_hist_bins(
+        np.take(hsv_img.reshape(-1, 3), pixel_idx, axis=0),
+        bins
+    )
+
+    # histogram intersection, summed over the bins a candidate has pixels
+    # in only (min(0, t) is 0), instead of over all count x n_bins bins
+    hists = np.bincount(
+        pixel_labels * n_bins + pixel_bins,
+        minlength=count * n_bins
+    )
+    hist_idx = np.flatnonzero(hists)
+    hist_labels = hist_idx // n_bins
+    sizes = np.bincount(pixel_labels, minlength=count)
+    scores = np.bincount(
+        hist_labels,
+        weights=np.minimum(
+            hists[hist_idx] / sizes[hist_labels],
+            t_hist[hist_idx % n_bins]
+        ),
+        minlength=count
+    )
+
+    if use_shape:
+        # moments of a contour are computed from its polygon vertices,
+        # which is far cheaper than summing over the region pixels. The
+        # target's are computed the same way from its largest contour,
+        # pixel moments differ from polygon moments for small blobs.
+        t_moments = get_contour_hu_moments(
+            [get_largest_contour(target_mask)]
+        )[0]
+        moments = get_contour_hu_moments(contours)
+
+        eps = np.finfo(np.float64).tiny
+        log_diff = np.abs(
+            np.log(moments + eps) - np.log(t_moments + eps)
+        )
+        # only compare the 2nd invariant when the target isn't circular,
+        # rasterizing a circle leaves a tiny 2nd invariant whose log is
+        # just noise
+        if t_moments[1] < CIRCULAR_HU_RATIO * t_moments[0] * t_moments[0]:
+            log_diff[:, 1] = 0
+
+        scores *= 1.0 / (1.0 + log_diff.sum(axis=1))
+
+    return scores
+
+
+def rank_regions(
+        hsv_img,
+        contours,
+        target_img,
+        target_mask,
+        min_score=0.0,
+        use_shape=False
+):
+    """
+    Ranks candidate regions by their score against the target signature.
+
+    Returns:
+        List of (contour, score) tuples with a score of at least min_score,
+        ordered from best to worst
+    """
+    scores = score_regions(
+        hsv_img,
+        contours,
+        target_img,
+        target_mask,
+        use_shape=use_shape
+    )
+
+    order = np.argsort(-scores, kind='stable')
+
+    return [
+        (contours[i], float(scores[i]))
+        for i in order if scores[i] >= min_score
+    ]
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class Workspace(object):
+    """
+    Reusable work buffers for detection.
+
+    Detection creates several image sized masks (color mask, eroded &
+    dilated masks, thresholded copies, color labels) for every image. When
+    a workspace is passed to the detection functions (see
+    utils.find_regions), these are written into named buffers kept here
+    with OpenCV dst= & NumPy out= arguments instead of being allocated
+    fresh for each image.
+
+    Each buffer keeps its largest allocation, so a smaller image (e.g. an
+    ROI crop) gets a view into the existing memory. Buffers returned by
+    the detection functions are only valid until the workspace is used
+    again, and a workspace must not be shared between threads.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+        # number of buffer (re-)allocations, for measuring reuse
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        """
+        Returns an uninitialized named buffer of the given shape & type.
+
+        Args:
+            name: buffer name, different names never share memory
+            shape: shape of the returned array
+            dtype: NumPy data type of the returned array
+
+        Returns:
+            C-contiguous NumPy array, a view into the named buffer
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+
+        buf = self._buffers.get(name)
+        if buf is None or buf.nbytes < nbytes:
+            buf = np.empty(nbytes, dtype=np.uint8)
+            self._buffers[name] = buf
+            self.allocations += 1
+
+        return buf[:nbytes].view(dtype).reshape(shape)
+
+    def like(self, name, img):
+        """
+        Returns a named buffer with the same shape & type as an image.
+        """
+        return self.get(name, img.shape, img.dtype)
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes held by all buffers
+        """
+        return sum(buf.nbytes for buf in self._buffers.values())
+
+    def clear(self):
+        """
+        Releases all buffers.
+        """
+        self._buffers = {}
@@ -0,0 +1,61 @@
+import os
+import threading
+import time
+import numpy as np
+
+from isd_lib import cache
+
+
+def test_concurrent_saves_of_one_key(tmpdir):
+    derived = cache.DerivedDataCache(str(tmpdir))
+    key = derived.key('0' * 40, 'labels')
+    arrays = [np.full((256, 256), i, np.uint8) for i in range(8)]
+
+    threads = [
+        threading.Thread(target=derived.save, args=(key, array))
+        for array in arrays
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # one of the writers wins, without mixing its data with another's
+    array = derived.load(key)
+    assert array is not None
+    assert any(np.array_equal(array, a) for a in arrays)
+    assert not [p for p in os.listdir(str(tmpdir))
+                if p.endswith(cache.TMP_SUFFIX)]
+
+
+def test_evict_removes_stale_tmp_files(tmpdir):
+    derived = cache.DerivedDataCache(str(tmpdir))
+
+    stale_path = str(tmpdir.join('a-killed' + cache.TMP_SUFFIX))
+    fresh_path = str(tmpdir.join('a-writing' + cache.TMP_SUFFIX))
+    for path in (stale_path, fresh_path):
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 1024)
+
+    stale_time = time.time() - cache.STALE_TMP_SECONDS - 60
+    os.utime(stale_path, (stale_time, stale_time))
+
+    derived.evict()
+
+    assert not os.path.exists(stale_path)
+    # might still be written by a live process
+    assert os.path.exists(fresh_path)
+
+
+def test_load_entry_evicted_meanwhile(tmpdir, monkeypatch):
+    derived = cache.DerivedDataCache(str(tmpdir))
+    key = derived.key('0' * 40, 'hsv')
+    derived.save(key, np.arange(12, dtype=np.uint8))
+
+    def evicted(path, times):
+        raise OSError("No such file or directory: %r" % path)
+
+    monkeypatch.setattr(cache.os, 'utime', evicted)
+
+    array = derived.load(key)
+    assert np.array_equal(array, np.arange(12))
@@ -0,0 +1,126 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import image_subregion_detector  # noqa: E402
+from isd_lib import export  # noqa: E402
+from isd_lib import workspace  # noqa: E402
+
+
+class Var(object):
+    def __init__(self, value=None):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+class Canvas(object):
+    """
+    Stands in for the Tk canvas, which needs a display
+    """
+    def __init__(self):
+        self.items = {}
+
+    def create_rectangle(self, *coords, **kwargs):
+        item = len(self.items) + 1
+        self.items[item] = list(coords)
+        return item
+
+    def coords(self, item):
+        return self.items[item]
+
+    def delete(self, item):
+        self.items.pop(item, None)
+
+    def itemconfigure(self, item, **kwargs):
+        pass
+
+
+def make_app(hsv_img):
+    app = image_subregion_detector.Application.__new__(
+        image_subregion_detector.Application
+    )
+    app.profiler = None
+    app.canvas = Canvas()
+    app.image = object()
+    app.image_name = 'test.png'
+    app.image_dir = '.'
+    app.hsv_img = hsv_img
+    app.rgb_img = cv2.cvtColor(hsv_img, cv2.COLOR_HSV2RGB)
+    app.rgb_img_16bit = None
+    app.rect = None
+    app.roi = None
+    app.targets = []
+    app.workspace = workspace.Workspace()
+    app.regions = None
+    app.region_items = None
+    app.region_history = None
+    app.contour_store = None
+    app.region_labels = None
+    app.use_region_labels = False
+    app.auto_bg_color = Var(0)
+    app.bg_color_vars = {
+        color: Var(1 if color == 'white' else 0)
+        for color in image_subregion_detector.COLOR_NAMES
+    }
+    app.color_profile_vars = {
+        color: Var() for color in image_subregion_detector.COLOR_NAMES
+    }
+    app.erode_iter = Var(0)
+    app.dilate_iter = Var(2)
+    app.min_area = Var(0.5)
+    app.max_area = Var(2.0)
+    app.min_score = Var('')
+    app.use_shape = Var(0)
+    app.export_string = Var('regions')
+    app.export_format = Var('numpy')
+    for name in ['region_count', 'region_min', 'region_max', 'region_avg']:
+        setattr(app, name, Var(0))
+
+    return app
+
+
+def test_export_after_empty_single_target_run(monkeypatch):
+    # two red blobs on white, found by two targets with the same colors, so
+    # every blob is found twice & the regions overlap
+    hsv_img = np.zeros((100, 100, 3), dtype=np.uint8)
+    hsv_img[..., 2] = 255
+    hsv_img[20:40, 20:40] = (0, 255, 255)
+    hsv_img[60:80, 60:80] = (0, 255, 255)
+
+    app = make_app(hsv_img)
+    app.targets = [
+        {'image': hsv_img[15:45, 15:45], 'min_area': 0.5, 'max_area': 2.0},
+        {'image': hsv_img[55:85, 55:85], 'min_area': 0.5, 'max_area': 2.0}
+    ]
+    app.find_regions()
+    assert len(app.contour_store) == 4
+
+    # no blob is large enough for the single target, so nothing is found
+    app.targets = []
+    app.rect = app.canvas.create_rectangle(15, 15, 45, 45)
+    app.min_area = Var(10.0)
+    app.find_regions()
+    assert app.region_count.get() == 0
+
+    exported = []
+
+    def export_regions(regions, *args, **kwargs):
+        exported.append((list(regions), kwargs['region_labels']))
+
+    monkeypatch.setattr(export, 'export_regions', export_regions)
+    app.export_sub_regions()
+
+    # the overlapping regions are still masked by their own contours
+    regions, region_labels = exported[0]
+    assert len(regions) == 4
+    assert region_labels is None
+    assert all('label' not in region for region in regions)
@@ -0,0 +1,41 @@
+import cv2
+import numpy as np
+import pytest
+
+from isd_lib import loader
+from isd_lib import server
+
+
+def make_16bit_image():
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 65536, (40, 50, 3)).astype(np.uint16)
+
+
+@pytest.mark.parametrize('ext', ['.png', '.tif', '.ppm'])
+def test_16bit_images_match_opencv_8bit_decoding(tmp_path, ext):
+    file_path = str(tmp_path / ('img' + ext))
+    cv2.imwrite(file_path, make_16bit_image())
+
+    expected = cv2.imread(file_path, cv2.IMREAD_COLOR)
+    assert expected.dtype == np.uint8
+
+    bgr_img, bgr_img_16bit = loader.read_image(file_path, keep_16bit=True)
+    assert np.array_equal(bgr_img, expected)
+    assert bgr_img_16bit.dtype == np.uint16
+
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    assert np.array_equal(server.decode_image(data), expected)
+
+
+def test_to_8bit_big_endian():
+    img = make_16bit_image()
+
+    assert np.array_equal(
+        loader.to_8bit(img.astype('>u2')),
+        loader.to_8bit(img)
+    )
+    assert np.array_equal(
+        loader.to_8bit(img.astype('>u2'), rounding=True),
+        loader.to_8bit(img, rounding=True)
+    )
@@ -0,0 +1,96 @@
+import json
+import os
+
+from isd_lib import manifest
+
+
+def test_records_are_shared_across_mount_paths(tmpdir):
+    share = tmpdir.mkdir('share')
+    images = [str(share.join('img%d.png' % i)) for i in range(6)]
+
+    # another machine mounting the same share at a different path
+    other_mount = str(tmpdir.join('mnt'))
+    os.symlink(str(share), other_mount)
+    other_images = [
+        os.path.join(other_mount, os.path.basename(p)) for p in images
+    ]
+
+    manifest_path = str(share.join('batch.jsonl'))
+    other_manifest_path = os.path.join(other_mount, 'batch.jsonl')
+
+    with manifest.Manifest(manifest_path, chunk=(0, 2)) as first:
+        chunk = manifest.select_chunk(images, 0, 2, key=first.key)
+        for image_path in chunk:
+            first.record(image_path, 'params', manifest.STATUS_DONE)
+
+    with manifest.Manifest(other_manifest_path, chunk=(1, 2)) as second:
+        # chunks are dealt the same, given relative paths in another order
+        relative = [
+            os.path.relpath(p) for p in reversed(other_images)
+        ]
+        other_chunk = manifest.select_chunk(relative, 1, 2, key=second.key)
+        assert (
+            set(second.key(p) for p in chunk) &
+            set(second.key(p) for p in other_chunk)
+        ) == set()
+
+        # the first chunk is done, seen from the other mount path
+        pending = second.pending(other_images, 'params')
+        assert sorted(second.key(p) for p in pending) == sorted(
+            second.key(p) for p in other_chunk
+        )
+
+
+def test_done_record_wins_over_failed_in_another_part(tmpdir):
+    manifest_path = str(tmpdir.join('batch.jsonl'))
+    image_path = str(tmpdir.join('img.png'))
+
+    with manifest.Manifest(manifest_path, chunk=(0, 2)) as first:
+        first.record(image_path, 'params', manifest.STATUS_DONE)
+
+    # a later failed record of another machine, e.g. one whose clock is
+    # ahead or that ran the image again & ran out of memory
+    with manifest.Manifest(manifest_path, chunk=(1, 2)) as second:
+        second.record(image_path, 'params', manifest.STATUS_FAILED)
+
+    assert manifest.Manifest(manifest_path).is_done(image_path, 'params')
+
+
+def test_absolute_paths_of_older_manifests(tmpdir):
+    manifest_path = str(tmpdir.join('batch.jsonl'))
+    image_path = str(tmpdir.join('img.png'))
+
+    with open(manifest_path, 'w') as f:
+        f.write(json.dumps({
+            'image': image_path,
+            'params': 'params',
+            'status': manifest.STATUS_DONE
+        }) + '\n')
+
+    assert manifest.Manifest(manifest_path).is_done(image_path, 'params')
+
+
+def test_stale_params_part_does_not_override_current_manifest(tmpdir):
+    manifest_path = str(tmpdir.join('batch.jsonl'))
+    done_path = str(tmpdir.join('done.png'))
+    failed_path = str(tmpdir.join('failed.png'))
+
+    # an earlier chunked run with other parameters finished both images
+    with manifest.Manifest(manifest_path, chunk=(0, 1)) as stale:
+        stale.record(done_path, 'old', manifest.STATUS_DONE)
+        stale.record(failed_path, 'old', manifest.STATUS_DONE)
+
+    # the current, unchunked run with new parameters
+    with manifest.Manifest(manifest_path) as current:
+        current.record(done_path, 'new', manifest.STATUS_DONE)
+        current.record(failed_path, 'new', manifest.STATUS_FAILED)
+
+    resumed = manifest.Manifest(manifest_path)
+    assert resumed.is_done(done_path, 'new')
+    assert not resumed.is_done(failed_path, 'new')
+    assert resumed.pending([done_path, failed_path], 'new') == [failed_path]
+    assert resumed.pending(
+        [done_path, failed_path],
+        'new',
+        retry_failed=False
+    ) == []
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+
+from isd_lib import pipeline
+from isd_lib import utils
+
+
+def make_image(seed):
+    rng = np.random.RandomState(seed)
+    img = np.full((300, 300, 3), 235, dtype=np.uint8)
+    for i in range(12):
+        x, y = rng.randint(20, 280, 2)
+        radius = int(rng.randint(8, 14))
+        # red disks, some with a blue core to score lower
+        cv2.circle(img, (int(x), int(y)), radius, (30, 30, 200), -1)
+        if i % 3 == 0:
+            cv2.circle(img, (int(x), int(y)), radius // 2, (200, 30, 30), -1)
+
+    return img
+
+
+def test_run_batch_scores_regions(tmp_path):
+    image_paths = []
+    for seed in range(3):
+        image_path = str(tmp_path / ('img%d.png' % seed))
+        cv2.imwrite(image_path, make_image(seed))
+        image_paths.append(image_path)
+
+    target = cv2.cvtColor(
+        np.full((30, 30, 3), 235, dtype=np.uint8),
+        cv2.COLOR_BGR2HSV
+    )
+    cv2.circle(target, (15, 15), 11, (0, 217, 200), -1)
+
+    options = {
+        'bg_colors': ['white'],
+        'min_score': 0.9,
+        'use_shape': True
+    }
+
+    finished = []
+    results, stats = pipeline.run_batch(
+        image_paths,
+        target,
+        on_result=lambda *result: finished.append(result),
+        **options
+    )
+
+    # only the # of regions is returned, the regions go to on_result
+    assert sorted(results) == sorted(
+        (image_path, len(regions), error)
+        for image_path, regions, error in finished
+    )
+
+    for image_path, regions, error in finished:
+        assert error is None
+
+        hsv_img = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2HSV)
+        expected = utils.find_regions(hsv_img, target, **options)
+
+        assert 0 < len(expected) < len(utils.find_regions(
+            hsv_img,
+            target,
+            bg_colors=['white']
+        ))
+        assert [r['rectangle'] for r in regions] == [
+            cv2.boundingRect(c) for c in expected
+        ]
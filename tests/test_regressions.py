@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), 'benchmarks')
+)
+
+import check_regressions  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    return check_regressions.load_corpus()
+
+
+def test_golden_outputs(corpus):
+    failures = []
+
+    assert check_regressions.check_golden(corpus, failures) > 0
+    assert failures == []
+
+
+def test_golden_outputs_record_their_commit():
+    golden = check_regressions.load_golden()
+
+    assert all(entry['commit'] for entry in golden.values())
+
+
+def test_optimized_paths_are_equivalent(corpus):
+    failures = []
+
+    assert check_regressions.check_equivalence(corpus, failures) > 0
+    assert failures == []
@@ -0,0 +1,86 @@
+import cv2
+import numpy as np
+
+from isd_lib import sequence
+from isd_lib import utils
+
+
+def make_frames(count=4):
+    base = np.full((300, 300, 3), 235, dtype=np.uint8)
+    rng = np.random.RandomState(0)
+    for i in range(12):
+        x, y = rng.randint(20, 280, 2)
+        radius = int(rng.randint(8, 14))
+        cv2.circle(base, (int(x), int(y)), radius, (30, 30, 200), -1)
+        if i % 3 == 0:
+            cv2.circle(base, (int(x), int(y)), radius // 2, (200, 30, 30), -1)
+
+    frames = []
+    for t in range(count):
+        frame = base.copy()
+        cv2.circle(frame, (40 + 4 * t, 150), 11, (30, 30, 200), -1)
+        frames.append(frame)
+
+    return frames
+
+
+def make_target():
+    target = cv2.cvtColor(
+        np.full((30, 30, 3), 235, dtype=np.uint8),
+        cv2.COLOR_BGR2HSV
+    )
+    cv2.circle(target, (15, 15), 11, (0, 217, 200), -1)
+
+    return target
+
+
+def test_sequence_scores_regions():
+    target = make_target()
+    options = {
+        'bg_colors': ['white'],
+        'min_score': 0.9,
+        'use_shape': True
+    }
+
+    detector = sequence.SequenceDetector(
+        target,
+        change_threshold=0,
+        **options
+    )
+
+    for frame in make_frames():
+        regions = detector.detect(frame)
+        expected = utils.find_regions(
+            cv2.cvtColor(frame, cv2.COLOR_BGR2HSV),
+            target,
+            **options
+        )
+
+        assert 0 < len(expected)
+        assert [r['rectangle'] for r in regions] == [
+            cv2.boundingRect(c) for c in expected
+        ]
+
+
+def test_16bit_rgb_stack_matches_single_images(tmp_path):
+    from isd_lib import loader
+
+    rng = np.random.RandomState(0)
+    pages = [
+        rng.randint(0, 65536, (30, 40, 3)).astype(np.uint16)
+        for i in range(3)
+    ]
+
+    stack_path = str(tmp_path / 'stack.tif')
+    cv2.imwritemulti(stack_path, pages)
+
+    frames = list(sequence.iter_frames(stack_path))
+    assert len(frames) == len(pages)
+
+    for i, (frame, page) in enumerate(zip(frames, pages)):
+        page_path = str(tmp_path / ('page%d.tif' % i))
+        cv2.imwrite(page_path, page)
+
+        assert frame.dtype == np.uint8
+        assert np.array_equal(frame, loader.read_image(page_path)[0])
+        assert np.array_equal(frame, cv2.imread(page_path, cv2.IMREAD_COLOR))
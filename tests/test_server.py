@@ -0,0 +1,202 @@
+import json
+import os
+import signal
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import cv2
+import numpy as np
+import pytest
+
+from isd_lib import server
+
+
+def make_image():
+    img = np.full((200, 200, 3), 235, dtype=np.uint8)
+    for x, y in [(40, 40), (120, 60), (80, 150)]:
+        cv2.circle(img, (x, y), 12, (30, 30, 200), -1)
+
+    return img
+
+
+def post(url, body, content_type='application/octet-stream'):
+    request = urllib.request.Request(
+        url,
+        data=body,
+        headers={'Content-Type': content_type}
+    )
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+@pytest.fixture
+def detection_server():
+    detection_server = server.DetectionServer(
+        ('127.0.0.1', 0),
+        workers=1,
+        max_pending=1
+    )
+    thread = threading.Thread(target=detection_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield detection_server
+
+    detection_server.shutdown()
+    detection_server.server_close()
+
+
+def test_detect_after_worker_killed(detection_server):
+    base_url = 'http://127.0.0.1:%d' % detection_server.server_address[1]
+
+    img = make_image()
+    image_data = cv2.imencode('.png', img)[1].tobytes()
+    target_data = cv2.imencode('.png', img[20:60, 20:60])[1].tobytes()
+
+    target_id = post(base_url + '/targets', target_data)['target_id']
+    detect_url = base_url + '/detect?target_id=' + target_id
+
+    expected = post(detect_url, image_data)['regions']
+    assert len(expected) == 3
+
+    for pid in list(detection_server.executor._processes):
+        os.kill(pid, signal.SIGKILL)
+
+    # wait for the pool to notice its dead worker
+    deadline = time.time() + 10
+    while not detection_server.executor._broken and time.time() < deadline:
+        time.sleep(0.05)
+
+    assert post(detect_url, image_data)['regions'] == expected
+    assert detection_server.status()['restarts'] == 1
+
+
+def test_job_that_kills_its_worker_is_not_retried(detection_server, tmpdir):
+    base_url = 'http://127.0.0.1:%d' % detection_server.server_address[1]
+
+    img = make_image()
+    image_data = cv2.imencode('.png', img)[1].tobytes()
+    target_id = detection_server.add_target(
+        cv2.cvtColor(img[20:60, 20:60], cv2.COLOR_BGR2HSV)
+    )
+
+    # reading from a FIFO without a writer blocks the worker, standing in
+    # for a job that's running when its worker dies
+    fifo_path = str(tmpdir.join('stuck.png'))
+    os.mkfifo(fifo_path)
+
+    errors = []
+
+    def detect_stuck():
+        try:
+            post(
+                base_url + '/detect',
+                json.dumps(
+                    {'image': fifo_path, 'target_id': target_id}
+                ).encode('utf-8'),
+                content_type='application/json'
+            )
+        except urllib.error.HTTPError as e:
+            errors.append(e.code)
+
+    thread = threading.Thread(target=detect_stuck)
+    thread.start()
+
+    deadline = time.time() + 10
+    while not any(detection_server._started_jobs) and time.time() < deadline:
+        time.sleep(0.05)
+
+    for pid in list(detection_server.executor._processes):
+        os.kill(pid, signal.SIGKILL)
+
+    thread.join(60)
+
+    assert errors == [503]
+    assert detection_server.status()['restarts'] == 1
+
+    # the replacement pool is warmed up like the first one
+    assert len(detection_server.executor._processes) == 1
+
+    regions = post(
+        base_url + '/detect?target_id=' + target_id,
+        image_data
+    )['regions']
+    assert len(regions) == 3
+
+
+def list_blocks():
+    from isd_lib import shm
+
+    return set(
+        name for name in os.listdir(shm.SHM_DIR)
+        if name.startswith(shm.BLOCK_PREFIX)
+    )
+
+
+def test_busy_server_rejects_upload_before_reading(
+        detection_server,
+        monkeypatch
+):
+    base_url = 'http://127.0.0.1:%d' % detection_server.server_address[1]
+
+    reads = []
+    read_shared_body = server.DetectionRequestHandler.read_shared_body
+
+    def counting_read_shared_body(handler):
+        reads.append(handler.path)
+        return read_shared_body(handler)
+
+    monkeypatch.setattr(
+        server.DetectionRequestHandler,
+        'read_shared_body',
+        counting_read_shared_body
+    )
+
+    img = make_image()
+    target_id = detection_server.add_target(
+        cv2.cvtColor(img[20:60, 20:60], cv2.COLOR_BGR2HSV)
+    )
+    blocks = list_blocks()
+
+    with detection_server.reserve():
+        with pytest.raises(urllib.error.HTTPError) as e:
+            post(
+                base_url + '/detect?target_id=' + target_id,
+                cv2.imencode('.png', img)[1].tobytes()
+            )
+
+        assert e.value.code == 503
+        assert reads == []
+        assert list_blocks() == blocks
+
+    assert detection_server.status()['pending'] == 0
+
+
+def test_targets_are_evicted_and_removed(detection_server, monkeypatch):
+    monkeypatch.setattr(server, 'MAX_TARGETS', 2)
+
+    target_img = np.zeros((10, 10, 3), dtype=np.uint8)
+    blocks = list_blocks()
+
+    target_ids = [detection_server.add_target(target_img) for i in range(3)]
+    assert len(list_blocks() - blocks) == 2
+    with pytest.raises(server.HTTPError):
+        detection_server.get_target(target_ids[0])
+
+    # a target in use is only unlinked once its job is done
+    with detection_server.use_target(target_ids[1]):
+        assert detection_server.remove_target(target_ids[1])
+        assert len(list_blocks() - blocks) == 2
+    assert len(list_blocks() - blocks) == 1
+
+    request = urllib.request.Request(
+        'http://127.0.0.1:%d/targets/%s' % (
+            detection_server.server_address[1], target_ids[2]
+        ),
+        method='DELETE'
+    )
+    urllib.request.urlopen(request, timeout=60).close()
+    assert list_blocks() == blocks
+    assert detection_server.status()['target_bytes'] == 0
@@ -0,0 +1,169 @@
+import cv2
+import numpy as np
+import pytest
+
+from isd_lib import utils
+
+
+@pytest.mark.parametrize(
+    'shape',
+    [(2, 1000000, 3), (1000000, 2, 3), (1, 300000, 3), (3, 3, 3)]
+)
+def test_estimate_dominant_color_of_thin_image(shape):
+    hsv_img = np.zeros(shape, dtype=np.uint8)
+    hsv_img[..., 2] = 255
+
+    sample = utils.sample_pixels(hsv_img)
+    assert sample.size > 0
+
+    color, fraction, margin = utils.estimate_dominant_color(hsv_img)
+    assert color == 'white'
+    assert fraction == 1.0
+
+
+@pytest.mark.parametrize(
+    'shape',
+    [(1, 10000000), (10000000, 1), (3, 2000000), (7000, 900), (2000, 2000)]
+)
+def test_sample_pixels_stays_within_sample_size(shape):
+    img = np.lib.stride_tricks.as_strided(
+        np.zeros(1, dtype=np.uint8),
+        shape,
+        (0, 0)
+    )
+
+    count = utils.sample_pixels(img, sample_size=1000).size
+    assert 0 < count <= 1000
+    assert count > 250
+
+
+def test_estimate_dominant_color_of_thin_label_strip():
+    labels = np.full((2, 1000000), utils.COLOR_LABELS.index('red'), np.uint8)
+
+    assert utils.estimate_dominant_color(labels)[0] == 'red'
+
+
+def test_estimate_dominant_color_of_empty_image():
+    with pytest.raises(ValueError):
+        utils.estimate_dominant_color(np.zeros((0, 10, 3), dtype=np.uint8))
+
+
+def test_contour_hu_moments_match_cv2_moments():
+    rng = np.random.RandomState(0)
+    mask = np.zeros((400, 400), dtype=np.uint8)
+    for i in range(60):
+        cv2.ellipse(
+            mask,
+            (int(rng.randint(400)), int(rng.randint(400))),
+            (int(rng.randint(1, 30)), int(rng.randint(1, 12))),
+            float(rng.randint(180)),
+            0,
+            360,
+            255,
+            -1
+        )
+    contours = list(cv2.findContours(
+        mask,
+        cv2.RETR_CCOMP,
+        cv2.CHAIN_APPROX_SIMPLE
+    )[1])
+    # a point, a line & a clockwise square
+    contours += [
+        np.array([[[5, 5]]], dtype=np.int32),
+        np.array([[[1, 1]], [[9, 1]]], dtype=np.int32),
+        np.array([[[0, 0]], [[0, 5]], [[5, 5]], [[5, 0]]], dtype=np.int32)
+    ]
+
+    expected = [utils.get_hu_moments(cv2.moments(c)) for c in contours]
+
+    assert np.array_equal(utils.get_contour_hu_moments(contours), expected)
+
+
+def test_score_regions_of_touching_contours():
+    hsv_img = np.zeros((20, 30, 3), dtype=np.uint8)
+    hsv_img[:, 10:, 2] = 255
+    contours = [
+        np.array([[[0, 0]], [[0, 19]], [[9, 19]], [[9, 0]]], np.int32),
+        np.array([[[10, 0]], [[10, 19]], [[19, 19]], [[19, 0]]], np.int32),
+        np.array([[[5, 5]], [[5, 14]], [[14, 14]], [[14, 5]]], np.int32)
+    ]
+    target_img = np.zeros((10, 10, 3), dtype=np.uint8)
+    target_img[:, 5:, 2] = 255
+    target_mask = np.full((10, 10), 255, dtype=np.uint8)
+
+    scores = utils.score_regions(hsv_img, contours, target_img, target_mask)
+
+    # later contours are drawn over earlier ones, so the last one keeps
+    # all its pixels, half black & half white like the target
+    assert scores[2] == 1.0
+    assert np.allclose(scores[:2], 0.5)
+
+
+@pytest.mark.parametrize('shape', [(300, 200), (128, 64), (1, 700)])
+def test_rect_color_profile_matches_bincount(shape):
+    rng = np.random.RandomState(0)
+    labels = rng.randint(0, len(utils.COLOR_LABELS), shape).astype(np.uint8)
+    height, width = shape
+
+    integrals = utils.get_label_integrals(labels)
+
+    for i in range(200):
+        # a drag from a start point, either way & possibly past the edges,
+        # with its corners sorted like the GUI's selection rectangle
+        start_x = rng.randint(0, width + 1)
+        start_y = rng.randint(0, height + 1)
+        end_x = start_x + rng.randint(-width - 10, width + 10)
+        end_y = start_y + rng.randint(-height - 10, height + 10)
+        x1, x2 = sorted((start_x, end_x))
+        y1, y2 = sorted((start_y, end_y))
+
+        clipped = labels[max(y1, 0):max(y2, 0), max(x1, 0):max(x2, 0)]
+        counts = np.bincount(
+            clipped.ravel(),
+            minlength=len(utils.COLOR_LABELS)
+        )
+        expected = {
+            color: int(counts[i]) for i, color in enumerate(utils.COLOR_LABELS)
+        }
+
+        profile = utils.get_rect_color_profile(
+            labels,
+            integrals,
+            (x1, y1, x2 - x1, y2 - y1)
+        )
+        assert profile == expected
+
+
+def test_score_regions_of_target_copied_from_candidate():
+    hsv_img = np.zeros((120, 200, 3), dtype=np.uint8)
+    hsv_img[..., 2] = 255
+    for center, radius in [((40, 60), 9), ((120, 60), 14)]:
+        cv2.circle(hsv_img, center, radius, (0, 255, 255), -1)
+
+    mask = cv2.inRange(hsv_img, (0, 255, 255), (0, 255, 255))
+    contours = sorted(
+        cv2.findContours(
+            mask,
+            cv2.RETR_EXTERNAL,
+            cv2.CHAIN_APPROX_SIMPLE
+        )[1],
+        key=cv2.contourArea
+    )
+
+    # the target is an exact copy of the small circle
+    x, y, w, h = cv2.boundingRect(contours[0])
+    target_img = hsv_img[y - 5:y + h + 5, x - 5:x + w + 5]
+    target_mask = mask[y - 5:y + h + 5, x - 5:x + w + 5]
+
+    scores = utils.score_regions(
+        hsv_img,
+        contours,
+        target_img,
+        target_mask,
+        use_shape=True
+    )
+
+    assert scores[0] == pytest.approx(1.0)
+
+    # the larger circle only differs in size, which Hu moments ignore
+    assert scores[1] > 0.9